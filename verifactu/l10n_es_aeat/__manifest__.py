@@ -11,7 +11,7 @@
 {
     "name": "AEAT Base",
     "summary": "Modulo base para declaraciones de la AEAT",
-    "version": "18.0.1.0.0",
+    "version": "18.0.1.1.0",
     "author": "Pexego, Acysos S.L., AvanzOSC, Tecnativa, Odoo Community Association (OCA)",
     "license": "AGPL-3",
     "website": "https://github.com/sergiodeveloper5/verifactu",
@@ -26,6 +26,7 @@
         "data/aeat_partner.xml",
         "data/ir_config_parameter.xml",
         "data/aeat_tax_agency_data.xml",
+        "data/ir_cron_data.xml",
         "wizard/export_to_boe_wizard.xml",
         "wizard/compare_boe_file_views.xml",
         "wizard/aeat_certificate_password_view.xml",
@@ -39,6 +40,7 @@
         "views/res_company_view.xml",
         "views/res_partner_view.xml",
         "views/aeat_certificate_view.xml",
+        "views/aeat_nif_validation_view.xml",
         "views/account_journal_view.xml",
         "views/account_move_view.xml",
     ],
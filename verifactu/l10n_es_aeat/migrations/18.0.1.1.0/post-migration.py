@@ -0,0 +1,49 @@
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
+
+import logging
+import os
+
+from cryptography import x509
+from cryptography.hazmat.primitives.serialization import load_pem_private_key
+from openupgradelib import openupgrade
+
+_logger = logging.getLogger(__name__)
+
+
+@openupgrade.migrate()
+def migrate(env, version):
+    """Move the certificates loaded as plain text PEM files under the data
+    directory into the encrypted ``certificate_data`` bundle, and remove the
+    files.
+    """
+    wizard = env["l10n.es.aeat.certificate.password"]
+    certificates = env["l10n.es.aeat.certificate"].search(
+        [
+            ("certificate_data", "=", False),
+            ("public_key", "!=", False),
+            ("private_key", "!=", False),
+        ]
+    )
+    for certificate in certificates:
+        paths = (certificate.private_key, certificate.public_key)
+        try:
+            with open(certificate.private_key, "rb") as key_file:
+                private_key = load_pem_private_key(key_file.read(), None)
+            with open(certificate.public_key, "rb") as certificate_file:
+                public_key = x509.load_pem_x509_certificate(certificate_file.read())
+        except (OSError, ValueError) as e:
+            _logger.warning(
+                "AEAT certificate %s could not be moved to the database, load "
+                "it again: %s",
+                certificate.id,
+                e,
+            )
+            continue
+        certificate.write(
+            wizard._process_certificate_vals(certificate, (private_key, public_key, []))
+        )
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError as e:
+                _logger.warning("Could not remove %s: %s", path, e)
@@ -6,6 +6,7 @@ from . import account_move
 from . import account_tax
 from . import aeat_certificate
 from . import aeat_mixin
+from . import aeat_nif_validation
 from . import aeat_soap
 from . import aeat_tax_agency
 from . import l10n_es_aeat_export_config
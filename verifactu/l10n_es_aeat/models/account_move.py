@@ -57,6 +57,85 @@ class AccountMove(models.Model):
                 line._process_aeat_tax_fee_info(res, tax, sign)
         return res
 
+    def _get_aeat_tax_infos(self):
+        """Set based version of ``_get_aeat_tax_info``: returns the same taxes
+        dictionary for every move of the recordset, keyed by move id.
+
+        Line balances are summed in the database per (move, tax) for the bases
+        and per (move, tax, repartition line) for the fees, so only the taxes
+        and repartition lines involved are read through the ORM. Taxes are
+        inserted in the order the per move loop would find them.
+        """
+        res = {move.id: {} for move in self}
+        if not self:
+            return res
+        line_model = self.env["account.move.line"]
+        tax_field = line_model._fields["tax_ids"]
+        line_model.flush_model(
+            ["move_id", "balance", "tax_ids", "tax_line_id", "tax_repartition_line_id"]
+        )
+        self.env.cr.execute(
+            f"""
+            SELECT aml.move_id, rel.{tax_field.column2}, 0, NULL,
+                SUM(aml.balance), MIN(aml.id)
+            FROM account_move_line aml
+            JOIN {tax_field.relation} rel ON rel.{tax_field.column1} = aml.id
+            WHERE aml.move_id IN %(move_ids)s
+            GROUP BY aml.move_id, rel.{tax_field.column2}
+            UNION ALL
+            SELECT aml.move_id, aml.tax_line_id, 1, aml.tax_repartition_line_id,
+                SUM(aml.balance), MIN(aml.id)
+            FROM account_move_line aml
+            WHERE aml.move_id IN %(move_ids)s AND aml.tax_line_id IS NOT NULL
+            GROUP BY aml.move_id, aml.tax_line_id, aml.tax_repartition_line_id
+            """,
+            {"move_ids": tuple(self.ids)},
+        )
+        rows = self.env.cr.fetchall()
+        taxes = self.env["account.tax"].browse(list({row[1] for row in rows}))
+        repartition_lines = self.env["account.tax.repartition.line"].browse(
+            list({row[3] for row in rows if row[3]})
+        )
+        taxes.mapped("children_tax_ids")
+        taxes.mapped("invoice_repartition_line_ids")
+        taxes.mapped("refund_repartition_line_ids")
+        repartition_lines.mapped("factor_percent")
+        # Rows sorted like the original loop: line order, bases before fees
+        # and then the order of the taxes on the line
+        rows.sort(
+            key=lambda row: (row[5], row[2], taxes.browse(row[1]).sequence, row[1])
+        )
+        moves = {move.id: move for move in self}
+        for move_id, tax_id, is_fee, repartition_line_id, balance, _line_id in rows:
+            move = moves[move_id]
+            tax = taxes.browse(tax_id)
+            sign = -1 if move.move_type[:3] == "out" else 1
+            if is_fee:
+                if "invoice" in move.move_type:
+                    tax_repartition_lines = tax.invoice_repartition_line_ids
+                else:
+                    tax_repartition_lines = tax.refund_repartition_line_ids
+                repartition_line = repartition_lines.browse(repartition_line_id)
+                if (
+                    len(tax_repartition_lines) > 2
+                    and repartition_line.factor_percent < 0
+                ):
+                    # taxes with more than one "tax" repartition line must be discarded
+                    continue
+            amount = float(balance) * sign
+            move_res = res[move_id]
+            for child in tax.amount_type == "group" and tax.children_tax_ids or tax:
+                move_res.setdefault(
+                    child,
+                    {"tax": child, "base": 0, "amount": 0, "deductible_amount": 0},
+                )
+                if is_fee:
+                    move_res[child]["amount"] += amount
+                    move_res[child]["deductible_amount"] += amount
+                else:
+                    move_res[child]["base"] += amount
+        return res
+
 
 class AccountMoveLine(models.Model):
     _inherit = "account.move.line"
@@ -3,11 +3,18 @@
 # (c) 2019 Acysos S.L.
 # License AGPL-3 - See http://www.gnu.org/licenses/agpl-3.0.html
 
+import base64
+import hashlib
+import hmac
+
 from cryptography import x509
 from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives.serialization import Encoding
+from cryptography.hazmat.primitives.serialization import Encoding, pkcs12
 
 from odoo import _, api, exceptions, fields, models
+from odoo.tools import config, ormcache
+
+from .aeat_client import AeatCredentials, clear_client_cache
 
 
 class L10nEsAeatCertificate(models.Model):
@@ -27,6 +34,14 @@ class L10nEsAeatCertificate(models.Model):
     show_public_key = fields.Boolean(store=False)
     public_key_data = fields.Text(readonly=True, store=False)
     private_key = fields.Char(readonly=True)
+    certificate_data = fields.Binary(
+        attachment=False,
+        copy=False,
+        groups="base.group_system",
+        help="PKCS#12 bundle of the certificate, encrypted with a key derived "
+        "from the 'aeat_certificate_secret' server option or, when it is not "
+        "set, from the database secret.",
+    )
     company_id = fields.Many2one(
         comodel_name="res.company",
         string="Company",
@@ -34,16 +49,57 @@ class L10nEsAeatCertificate(models.Model):
         default=lambda self: self.env.company,
     )
 
+    def _clear_certificate_cache(self):
+        """Cached certificate material and the SOAP clients authenticated
+        with it are no longer valid.
+        """
+        self._get_certificate_credentials.clear_cache(self)
+        clear_client_cache()
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        res = super().create(vals_list)
+        self._clear_certificate_cache()
+        return res
+
+    def write(self, vals):
+        res = super().write(vals)
+        self._clear_certificate_cache()
+        return res
+
+    def unlink(self):
+        res = super().unlink()
+        self._clear_certificate_cache()
+        return res
+
     @api.onchange("show_public_key")
     def onchange_public_key_data(self):
         if not self.show_public_key:
             self.public_key_data = ""
             return
+        self.public_key_data = self._get_x509_certificate().public_bytes(Encoding.PEM)
+
+    def _get_x509_certificate(self):
+        self.ensure_one()
+        data = self.sudo().certificate_data
+        if data:
+            return pkcs12.load_key_and_certificates(
+                base64.b64decode(data), self._get_storage_password()
+            )[1]
         with open(self.public_key, "rb") as f:
-            certificate = x509.load_pem_x509_certificate(
-                f.read(), backend=default_backend()
-            )
-        self.public_key_data = certificate.public_bytes(Encoding.PEM)
+            return x509.load_pem_x509_certificate(f.read(), backend=default_backend())
+
+    @api.model
+    def _get_storage_password(self):
+        """Password the PKCS#12 bundles are stored encrypted with."""
+        secret = config.get("aeat_certificate_secret") or self.env[
+            "ir.config_parameter"
+        ].sudo().get_param("database.secret")
+        return (
+            hmac.new(secret.encode(), b"l10n_es_aeat.certificate", hashlib.sha256)
+            .hexdigest()
+            .encode()
+        )
 
     def load_password_wizard(self):
         self.ensure_one()
@@ -65,13 +121,50 @@ class L10nEsAeatCertificate(models.Model):
             config_id.state = "draft"
         self.state = "active"
 
-    def get_certificates(self, company=False):
+    def get_credentials(self, company=False):
+        """Client certificate to authenticate the AEAT calls of the company.
+
+        :return: ``AeatCredentials`` of its active certificate, falling back to
+          the PEM files set in the system parameters.
+        """
         if not company:
             company = self.env.user.company_id
-        today = fields.Date.today()
-        aeat_certificate = self.search(
+        self.check_access_rights("read")
+        credentials = self._get_certificate_credentials(
+            company.id, fields.Date.today()
+        )
+        if not credentials.pkcs12 and not (
+            credentials.public_crt and credentials.private_key
+        ):
+            raise exceptions.UserError(_("Error! There aren't certificates."))
+        return credentials
+
+    def get_certificates(self, company=False):
+        """Paths of the PEM files of the company certificate, only available
+        for certificates loaded before they were kept in the database.
+        """
+        credentials = self.get_credentials(company)
+        if not credentials.public_crt:
+            raise exceptions.UserError(
+                _(
+                    "The active certificate is kept encrypted in the database "
+                    "and has no files on disk."
+                )
+            )
+        return credentials.public_crt, credentials.private_key
+
+    @ormcache("company_id", "today")
+    def _get_certificate_credentials(self, company_id, today):
+        """Key material of the active certificate of the company, cached per
+        day so certificates are picked up or dropped as their validity dates
+        pass. Certificate and system parameter changes clear the cache.
+        """
+        aeat_certificate = self.sudo().search(
             [
-                ("company_id", "=", company.id),
+                ("company_id", "=", company_id),
+                "|",
+                ("certificate_data", "!=", False),
+                "&",
                 ("public_key", "!=", False),
                 ("private_key", "!=", False),
                 "|",
@@ -84,16 +177,21 @@ class L10nEsAeatCertificate(models.Model):
             ],
             limit=1,
         )
-        if aeat_certificate:
-            public_crt = aeat_certificate.public_key
-            private_key = aeat_certificate.private_key
-        else:
-            public_crt = self.env["ir.config_parameter"].get_param(
-                "l10n_es_aeat_certificate.publicCrt", False
+        if aeat_certificate.certificate_data:
+            return AeatCredentials(
+                False,
+                False,
+                base64.b64decode(aeat_certificate.certificate_data),
+                self._get_storage_password(),
             )
-            private_key = self.env["ir.config_parameter"].get_param(
-                "l10n_es_aeat_certificate.privateKey", False
+        if aeat_certificate:
+            return AeatCredentials(
+                aeat_certificate.public_key, aeat_certificate.private_key, False, False
             )
-        if not public_crt or not private_key:
-            raise exceptions.UserError(_("Error! There aren't certificates."))
-        return public_crt, private_key
+        params = self.env["ir.config_parameter"].sudo()
+        return AeatCredentials(
+            params.get_param("l10n_es_aeat_certificate.publicCrt", False),
+            params.get_param("l10n_es_aeat_certificate.privateKey", False),
+            False,
+            False,
+        )
@@ -0,0 +1,414 @@
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+"""Process wide cache of the zeep clients used for AEAT communications.
+
+Building a ``zeep.Client`` downloads and parses the WSDL and all the XSD it
+imports, which is far more expensive than the call itself. Clients (or the
+services bound from them) are kept here per process, keyed by everything that
+makes them different: WSDL, port, address and certificate.
+
+HTTP sessions are pooled the same way, one per certificate, so the TCP
+connection and the mutual TLS handshake are reused between calls, queue
+batches and every client authenticated with that certificate. The client
+certificate is loaded once per process into an ``ssl.SSLContext`` mounted on
+the session adapter, straight from the encrypted PKCS#12 stored in the
+database, so no plain text key is ever written to disk.
+
+Documents that still have to be downloaded (WSDL or XSD not bundled with the
+addons) are persisted in a zeep SQLite cache inside the data directory, so a
+restarted process does not fetch them again.
+
+Calls for several issuers can also be run concurrently with
+``run_async_calls``, which reuses the parsed WSDL of the cached services over
+an asyncio transport.
+
+Both transports hand the bodies they post and receive to ``aeat_metrics``,
+which measures the calls from them instead of serializing the envelopes again.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import secrets
+import ssl
+import tempfile
+import threading
+import time
+from collections import namedtuple
+
+from requests import Session
+from requests.adapters import HTTPAdapter
+
+from odoo.tools import config
+
+from .aeat_envelope import build_envelope, process_envelope_reply, write_envelope
+from .aeat_metrics import (
+    capture_calls,
+    record_call_error,
+    record_request_body,
+    record_response_body,
+)
+from .aeat_signature import clear_signing_keys
+
+_logger = logging.getLogger(__name__)
+
+try:
+    from cryptography.hazmat.primitives.serialization import (
+        BestAvailableEncryption,
+        Encoding,
+        PrivateFormat,
+        pkcs12,
+    )
+except (ImportError, IOError) as err:
+    _logger.debug(err)
+
+try:
+    from zeep.cache import SqliteCache
+    from zeep.transports import Transport
+    from zeep.wsdl.utils import etree_to_string
+except (ImportError, IOError) as err:
+    Transport = object
+    _logger.debug(err)
+
+try:
+    import httpx
+    from zeep import AsyncClient
+    from zeep.proxy import AsyncServiceProxy
+    from zeep.transports import AsyncTransport
+except (ImportError, IOError) as err:
+    httpx = None
+    AsyncTransport = object
+    _logger.debug(err)
+
+CLIENT_CACHE_TTL = 3600
+# Seconds to establish the connection and to wait for the AEAT answer, which
+# may take well over a minute for a full batch of records.
+AEAT_CONNECT_TIMEOUT = 10
+AEAT_READ_TIMEOUT = 120
+# Hosts kept per certificate (WSDL/XSD host plus production and test
+# endpoints) and kept-alive connections per host.
+AEAT_POOL_HOSTS = 4
+AEAT_POOL_SIZE = 10
+# Calls kept in flight at once by run_async_calls
+AEAT_ASYNC_CONCURRENCY = 5
+# WSDL and XSD published by the AEAT change very rarely
+AEAT_SCHEMA_CACHE_TIMEOUT = 30 * 24 * 3600
+
+_client_cache = {}
+_client_cache_lock = threading.Lock()
+_session_pool = {}
+_session_pool_lock = threading.Lock()
+_ssl_contexts = {}
+_ssl_contexts_lock = threading.Lock()
+_schema_cache = None
+
+
+class AeatCredentials(
+    namedtuple("AeatCredentials", ["public_crt", "private_key", "pkcs12", "password"])
+):
+    """Client certificate of the AEAT calls: either the paths of the PEM
+    files of legacy certificates, or a PKCS#12 bundle and its password.
+    """
+
+    __slots__ = ()
+
+    @property
+    def fingerprint(self):
+        if self.pkcs12:
+            return hashlib.sha256(self.pkcs12).hexdigest()
+        return certificate_fingerprint(self.public_crt, self.private_key)
+
+
+def certificate_fingerprint(public_crt, private_key):
+    """Short digest identifying the certificate a client is authenticated with."""
+    return hashlib.sha256(f"{public_crt}|{private_key}".encode()).hexdigest()
+
+
+def _load_pkcs12_chain(context, data, password):
+    """Load a PKCS#12 bundle into ``context``.
+
+    ``SSLContext.load_cert_chain`` only reads files, so the key is handed over
+    re-encrypted with a one time password through an anonymous in-memory file
+    where available, or a temporary file that is removed right away.
+    """
+    key, certificate, chain = pkcs12.load_key_and_certificates(data, password)
+    one_time_password = secrets.token_urlsafe(32).encode()
+    pem = key.private_bytes(
+        Encoding.PEM, PrivateFormat.PKCS8, BestAvailableEncryption(one_time_password)
+    ) + b"".join(cert.public_bytes(Encoding.PEM) for cert in [certificate, *chain])
+    if hasattr(os, "memfd_create"):
+        fd = os.memfd_create("aeat_certificate")
+        try:
+            os.write(fd, pem)
+            context.load_cert_chain(f"/proc/self/fd/{fd}", password=one_time_password)
+        finally:
+            os.close(fd)
+        return
+    with tempfile.NamedTemporaryFile(suffix=".pem") as pem_file:
+        pem_file.write(pem)
+        pem_file.flush()
+        context.load_cert_chain(pem_file.name, password=one_time_password)
+
+
+def get_ssl_context(credentials):
+    """TLS context authenticated with ``credentials``, built once per process."""
+    key = credentials.fingerprint
+    with _ssl_contexts_lock:
+        context = _ssl_contexts.get(key)
+        if context is None:
+            context = ssl.create_default_context()
+            if credentials.pkcs12:
+                _load_pkcs12_chain(context, credentials.pkcs12, credentials.password)
+            else:
+                context.load_cert_chain(credentials.public_crt, credentials.private_key)
+            _ssl_contexts[key] = context
+    return context
+
+
+class SSLContextAdapter(HTTPAdapter):
+    """HTTP adapter whose connections use the given ``ssl.SSLContext``."""
+
+    def __init__(self, ssl_context, **kwargs):
+        self.ssl_context = ssl_context
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["ssl_context"] = self.ssl_context
+        return super().init_poolmanager(*args, **kwargs)
+
+    def proxy_manager_for(self, *args, **kwargs):
+        kwargs["ssl_context"] = self.ssl_context
+        return super().proxy_manager_for(*args, **kwargs)
+
+
+def get_cached_client(key, factory):
+    """Return the cached value for ``key``, building it with ``factory`` when
+    it is missing or expired.
+
+    The factory is called outside the lock, so a slow WSDL download does not
+    block other keys; if two threads race for the same key both build it and
+    the last one wins, which is harmless.
+    """
+    now = time.monotonic()
+    with _client_cache_lock:
+        entry = _client_cache.get(key)
+        if entry and entry[0] > now:
+            return entry[1]
+    value = factory()
+    ttl = int(config.get("aeat_client_cache_ttl", CLIENT_CACHE_TTL))
+    with _client_cache_lock:
+        _client_cache[key] = (now + ttl, value)
+    return value
+
+
+def _get_session(credentials):
+    """Return the pooled keep-alive session for a certificate.
+
+    Its adapter keeps one connection pool per host (up to ``aeat_pool_hosts``)
+    with ``aeat_pool_size`` connections each, so concurrent senders in the
+    same process share already authenticated connections.
+    """
+    key = credentials.fingerprint
+    with _session_pool_lock:
+        session = _session_pool.get(key)
+        if session is None:
+            session = Session()
+            adapter = SSLContextAdapter(
+                get_ssl_context(credentials),
+                pool_connections=int(config.get("aeat_pool_hosts", AEAT_POOL_HOSTS)),
+                pool_maxsize=int(config.get("aeat_pool_size", AEAT_POOL_SIZE)),
+            )
+            session.mount("https://", adapter)
+            _session_pool[key] = session
+    return session
+
+
+def _get_schema_cache():
+    """Persistent zeep cache for downloaded WSDL/XSD documents."""
+    global _schema_cache
+    if _schema_cache is None:
+        directory = os.path.join(config["data_dir"], "aeat")
+        os.makedirs(directory, exist_ok=True)
+        _schema_cache = SqliteCache(
+            path=os.path.join(directory, "zeep_cache.db"),
+            timeout=AEAT_SCHEMA_CACHE_TIMEOUT,
+        )
+    return _schema_cache
+
+
+def _get_timeout():
+    return (
+        int(config.get("aeat_connect_timeout", AEAT_CONNECT_TIMEOUT)),
+        int(config.get("aeat_read_timeout", AEAT_READ_TIMEOUT)),
+    )
+
+
+class AeatTransport(Transport):
+    """zeep transport measuring each call from the bodies it exchanges."""
+
+    def post_xml(self, address, envelope, headers):
+        message = etree_to_string(envelope)
+        record_request_body(message)
+        return self.post(address, message, headers)
+
+    def post(self, address, message, headers):
+        try:
+            response = super().post(address, message, headers)
+        except Exception as error:
+            record_call_error(error)
+            raise
+        record_response_body(response.content, response.status_code)
+        return response
+
+
+class AeatAsyncTransport(AsyncTransport):
+    """Asyncio counterpart of ``AeatTransport``."""
+
+    async def post_xml(self, address, envelope, headers):
+        message = etree_to_string(envelope)
+        record_request_body(message)
+        response = await self.post(address, message, headers)
+        return self.new_response(response)
+
+    async def post(self, address, message, headers):
+        try:
+            response = await super().post(address, message, headers)
+        except Exception as error:
+            record_call_error(error)
+            raise
+        record_response_body(response.content, response.status_code)
+        return response
+
+
+def get_transport(credentials):
+    """zeep transport over the pooled session of the certificate."""
+    timeout = _get_timeout()
+    return AeatTransport(
+        cache=_get_schema_cache(),
+        session=_get_session(credentials),
+        timeout=timeout,
+        operation_timeout=timeout,
+    )
+
+
+def clear_client_cache():
+    """Drop every cached client, TLS context, pooled session and signing
+    key, e.g. after a certificate or agency change.
+    """
+    with _client_cache_lock:
+        _client_cache.clear()
+    with _ssl_contexts_lock:
+        _ssl_contexts.clear()
+    with _session_pool_lock:
+        sessions = list(_session_pool.values())
+        _session_pool.clear()
+    for session in sessions:
+        session.close()
+    clear_signing_keys()
+
+
+def run_async_calls(
+    calls,
+    max_concurrency=AEAT_ASYNC_CONCURRENCY,
+    template=False,
+    store_envelopes=False,
+    captures=None,
+    stream=False,
+):
+    """Run several AEAT SOAP calls concurrently, at most ``max_concurrency``
+    in flight at once.
+
+    :param calls: list of ``(service, credentials, operation, kwargs)``
+      tuples, where ``service`` is a bound service as returned by
+      ``aeat.mixin._connect_aeat``. Its parsed WSDL, binding and address are
+      reused, only the transport changes.
+    :param template: build the envelopes with the compiled templates of
+      ``aeat_envelope`` instead of zeep's serializer.
+    :param store_envelopes: keep the compressed envelopes of each call.
+    :param captures: optional list, filled with the ``AeatCall`` list of
+      each call (see ``aeat_metrics.capture_calls``), in the same order. The
+      caller must close them once stored.
+    :param stream: stream the envelopes to spooled files with the compiled
+      templates and post them from there, for requests with thousands of
+      records. Repeated elements of ``kwargs`` may then be generators.
+    :return: list with the response of each call, in the same order, or the
+      exception the call raised.
+    """
+    if httpx is None:
+        raise RuntimeError("The httpx library is required for async AEAT calls")
+    return asyncio.run(
+        _run_async_calls(
+            calls, max_concurrency, template, store_envelopes, captures, stream
+        )
+    )
+
+
+async def _run_async_calls(
+    calls, max_concurrency, template, store_envelopes, captures, stream
+):
+    connect_timeout, read_timeout = _get_timeout()
+    semaphore = asyncio.Semaphore(max_concurrency)
+    transports = {}
+
+    def get_async_service(service, certificate):
+        # httpx clients are bound to the running event loop, so they are
+        # only shared among the calls of this run. The TLS context is not.
+        if certificate not in transports:
+            transports[certificate] = AeatAsyncTransport(
+                client=httpx.AsyncClient(
+                    verify=get_ssl_context(certificate),
+                    timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+                    limits=httpx.Limits(max_connections=max_concurrency),
+                )
+            )
+        client = AsyncClient(
+            wsdl=service._client.wsdl,
+            transport=transports[certificate],
+            plugins=service._client.plugins,
+        )
+        return AsyncServiceProxy(client, service._binding, **service._binding_options)
+
+    async def run(index, service, certificate, operation, kwargs):
+        async with semaphore:
+            async_service = get_async_service(service, certificate)
+            # Each call runs in its own task, so its capture only sees it
+            with capture_calls(store_envelopes) as capture:
+                try:
+                    address = service._binding_options["address"]
+                    transport = transports[certificate]
+                    if stream:
+                        body, http_headers = write_envelope(
+                            async_service, operation, kwargs
+                        )
+                        with body:
+                            response = await transport.post(
+                                address, body.aiter_chunks(), http_headers
+                            )
+                        return process_envelope_reply(
+                            async_service, operation, transport.new_response(response)
+                        )
+                    if not template:
+                        return await async_service[operation](**kwargs)
+                    envelope, http_headers = build_envelope(
+                        async_service, operation, kwargs
+                    )
+                    response = await transport.post_xml(
+                        address, envelope, http_headers
+                    )
+                    return process_envelope_reply(async_service, operation, response)
+                finally:
+                    if captures is not None:
+                        captures[index] = list(capture.calls)
+                        # Handed over to the caller, which closes them
+                        capture.calls.clear()
+
+    if captures is not None:
+        captures[:] = [[] for _call in calls]
+    try:
+        return await asyncio.gather(
+            *(run(index, *call) for index, call in enumerate(calls)),
+            return_exceptions=True,
+        )
+    finally:
+        for transport in transports.values():
+            await transport.aclose()
+            transport.wsdl_client.close()
@@ -0,0 +1,295 @@
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+"""Template based SOAP envelope builder for the AEAT web services.
+
+zeep serializes a request by converting every nested dict into its
+dynamic types, validating it and walking the schema again for each record,
+which dominates the CPU time of batches with hundreds of records. Here the
+schema of an operation is compiled once into a plain template (tag, cardinality
+and child template or value converter of each element) and the envelope is
+filled walking that template with lxml only.
+
+zeep is still the source of the contract (the template is compiled from its
+parsed WSDL) and it is used to parse the responses, so both serializers can be
+swapped freely. Elements the template does not cover (attributes or
+``xsd:any`` content) are delegated to zeep.
+
+For very large batches ``write_envelope`` streams the envelope with
+``lxml.etree.xmlfile`` into a spooled temporary file instead of building the
+tree: repeated elements may then be generators, consumed one record at a time.
+
+Requests can be checked locally with ``validate_request`` against the XSD of
+the service, compiled once per process by ``get_xml_schema``, so malformed
+records are found before the network round trip.
+"""
+import logging
+import re
+import tempfile
+import threading
+from collections.abc import Iterable
+from functools import lru_cache
+
+from lxml import etree
+
+from .aeat_metrics import AEAT_ENVELOPE_SPOOL_SIZE, start_call
+
+_logger = logging.getLogger(__name__)
+
+try:
+    from zeep.plugins import apply_egress
+    from zeep.xsd import ComplexType
+    from zeep.xsd.elements import Element
+except (ImportError, IOError) as err:
+    _logger.debug(err)
+
+SOAP_ENV_NS = "http://schemas.xmlsoap.org/soap/envelope/"
+# The error log of a compiled schema is shared by its validations
+_schema_lock = threading.Lock()
+
+
+class EnvelopeTemplate:
+    """Compiled template of the input message of a SOAP operation."""
+
+    def __init__(self, operation):
+        self.operation = operation
+        self.body = operation.input.body
+        self.headers = {
+            "SOAPAction": '"%s"' % (operation.soapaction or ""),
+            "Content-Type": "text/xml; charset=utf-8",
+        }
+        self._templates = {}
+        self._namespaces = {SOAP_ENV_NS}
+        self._template = self._compile_element(self.body)
+        self.nsmap = {"soapenv": SOAP_ENV_NS}
+        for index, namespace in enumerate(
+            sorted(self._namespaces - {SOAP_ENV_NS}), start=1
+        ):
+            self.nsmap["ns%d" % index] = namespace
+
+    def _compile_element(self, element):
+        """Return the ``(name, tag, many, child, element)`` entry of an
+        element, where ``child`` is the template of a complex type, the value
+        converter of a simple one or None when zeep has to render it.
+        """
+        self._namespaces.add(element.qname.namespace)
+        xsd_type = element.type
+        if not isinstance(xsd_type, ComplexType):
+            child = xsd_type.xmlvalue
+        elif xsd_type.attributes or not all(
+            isinstance(sub_element, Element) for _name, sub_element in xsd_type.elements
+        ):
+            child = None
+        else:
+            child = self._compile_type(xsd_type)
+        many = element.max_occurs == "unbounded" or element.max_occurs > 1
+        return (element.name, element.qname.text, many, child, element)
+
+    def _compile_type(self, xsd_type):
+        template = self._templates.get(xsd_type)
+        if template is None:
+            # Registered before compiling the children so recursive types
+            # end up pointing to the same (then filled) list.
+            template = self._templates[xsd_type] = []
+            template.extend(
+                self._compile_element(sub_element)
+                for _name, sub_element in xsd_type.elements
+            )
+        return template
+
+    def _fill(self, parent, template, values):
+        for name, tag, many, child, element in template:
+            value = values.get(name)
+            if value is None:
+                continue
+            if child is None:
+                if isinstance(value, dict):
+                    value = element.type(**value)
+                element.render(parent, value)
+                continue
+            if not many or not isinstance(value, (list, tuple)):
+                value = (value,)
+            for item in value:
+                node = etree.SubElement(parent, tag)
+                if isinstance(child, list):
+                    self._fill(node, child, item)
+                else:
+                    node.text = child(item)
+
+    def build(self, values):
+        """Return the ``soapenv:Envelope`` lxml element for the request
+        ``values``, the same dict that would be passed to the zeep operation.
+        """
+        envelope = etree.Element("{%s}Envelope" % SOAP_ENV_NS, nsmap=self.nsmap)
+        body = etree.SubElement(envelope, "{%s}Body" % SOAP_ENV_NS)
+        self._fill(body, [self._template], {self.body.name: values})
+        return envelope
+
+    def _write(self, xml_file, template, values):
+        for name, tag, many, child, element in template:
+            value = values.get(name)
+            if value is None:
+                continue
+            if child is None:
+                if isinstance(value, dict):
+                    value = element.type(**value)
+                parent = etree.Element("parent", nsmap=self.nsmap)
+                element.render(parent, value)
+                for node in parent:
+                    xml_file.write(node)
+                continue
+            if (
+                not many
+                or not isinstance(value, Iterable)
+                or isinstance(value, (str, dict))
+            ):
+                value = (value,)
+            for item in value:
+                with xml_file.element(tag):
+                    if isinstance(child, list):
+                        self._write(xml_file, child, item)
+                    else:
+                        xml_file.write(child(item))
+
+    def write(self, fileobj, values):
+        """Stream to ``fileobj`` the same envelope ``build`` returns, encoded
+        as zeep posts it. Repeated elements may be any iterable and only the
+        item being written is expanded.
+        """
+        with etree.xmlfile(fileobj, encoding="utf-8") as xml_file:
+            xml_file.write_declaration()
+            with xml_file.element("{%s}Envelope" % SOAP_ENV_NS, nsmap=self.nsmap):
+                with xml_file.element("{%s}Body" % SOAP_ENV_NS):
+                    self._write(xml_file, [self._template], {self.body.name: values})
+
+
+class EnvelopeStream:
+    """Sized reader of a written envelope, that requests posts without
+    loading it in memory. httpx async clients take ``aiter_chunks()``.
+    """
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        fileobj.seek(0, 2)
+        self.size = fileobj.tell()
+        fileobj.seek(0)
+
+    def __len__(self):
+        return self.size
+
+    def read(self, size=-1):
+        return self.fileobj.read(size)
+
+    def __iter__(self):
+        self.fileobj.seek(0)
+        return iter(lambda: self.fileobj.read(self.chunk_size), b"")
+
+    async def aiter_chunks(self):
+        for chunk in self:
+            yield chunk
+
+    def close(self):
+        self.fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+@lru_cache(maxsize=32)
+def _get_template(binding, operation_name):
+    return EnvelopeTemplate(binding.get(operation_name))
+
+
+def get_envelope_template(service, operation_name):
+    """Compiled template for an operation of a bound zeep service, shared by
+    every service built from the same parsed WSDL.
+    """
+    return _get_template(service._binding, operation_name)
+
+
+@lru_cache(maxsize=16)
+def get_xml_schema(path):
+    """``XMLSchema`` compiled from the XSD file at ``path``, once per process."""
+    return etree.XMLSchema(etree.parse(path))
+
+
+def validate_request(schema, template, values):
+    """Validate the body of the request ``values`` against ``schema``.
+
+    :return: list of the error messages, without namespaces, empty when the
+      request is valid.
+    """
+    request = template.build(values)[0][0]
+    with _schema_lock:
+        if schema.validate(request):
+            return []
+        return [
+            re.sub(r"\{[^}]*\}", "", error.message) for error in schema.error_log
+        ]
+
+
+def build_envelope(service, operation_name, values):
+    """Envelope and HTTP headers of a call, after the egress plugins of the
+    service client, as zeep would post them.
+    """
+    template = get_envelope_template(service, operation_name)
+    return apply_egress(
+        service._client,
+        template.build(values),
+        dict(template.headers),
+        template.operation,
+        service._binding_options,
+    )
+
+
+def write_envelope(service, operation_name, values):
+    """Stream the envelope of a call into a spooled temporary file.
+
+    The egress plugins need the whole tree, so instead of them the call is
+    registered in the metrics with ``start_call``.
+
+    :return: ``EnvelopeStream`` to post, that the caller must close, and the
+      HTTP headers.
+    """
+    template = get_envelope_template(service, operation_name)
+    spool = tempfile.SpooledTemporaryFile(max_size=AEAT_ENVELOPE_SPOOL_SIZE)
+    template.write(spool, values)
+    stream = EnvelopeStream(spool)
+    start_call(template.operation.name, spool)
+    http_headers = dict(template.headers)
+    http_headers["Content-Length"] = str(len(stream))
+    return stream, http_headers
+
+
+def process_envelope_reply(service, operation_name, response):
+    """Parse the HTTP response to a template built envelope with zeep."""
+    binding = service._binding
+    return binding.process_reply(
+        service._client, binding.get(operation_name), response
+    )
+
+
+def send_envelope(service, operation_name, values):
+    """Synchronous equivalent of ``service[operation_name](**values)`` that
+    builds the envelope from the compiled template.
+    """
+    envelope, http_headers = build_envelope(service, operation_name, values)
+    response = service._client.transport.post_xml(
+        service._binding_options["address"], envelope, http_headers
+    )
+    return process_envelope_reply(service, operation_name, response)
+
+
+def send_envelope_stream(service, operation_name, values):
+    """Same as ``send_envelope`` but streaming the envelope, for requests
+    with thousands of records.
+    """
+    stream, http_headers = write_envelope(service, operation_name, values)
+    with stream:
+        response = service._client.transport.post(
+            service._binding_options["address"], stream, http_headers
+        )
+    return process_envelope_reply(service, operation_name, response)
@@ -0,0 +1,311 @@
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+"""Bounded instrumentation of the AEAT SOAP calls.
+
+``AeatMetricsPlugin`` replaces zeep's ``HistoryPlugin`` in the cached clients.
+It does not keep any envelope: the timing and sizes of each call are added to
+per operation counters of the process (see ``get_call_metrics``), and only the
+call in progress is tracked, in a context variable so it is private to the
+thread or asyncio task that makes it.
+
+Sizes are taken from the bodies the transport actually posts and receives
+(see ``aeat_client.AeatTransport``), so measuring a call never serializes
+its envelope again. Calls that fail (connection errors, timeouts, HTTP
+errors and SOAP faults) are counted apart from the successful ones, with
+their last error. A summary of the counters is logged every
+``AEAT_METRICS_LOG_INTERVAL`` seconds.
+
+The raw envelopes are only kept when the caller asks for them with
+``capture_calls(store_envelopes=True)``. They are then gzip compressed into
+spooled temporary files, ready to be stored as attachments with
+``AeatCall.attachment_vals``.
+"""
+import contextlib
+import contextvars
+import gzip
+import logging
+import shutil
+import tempfile
+import threading
+import time
+
+_logger = logging.getLogger(__name__)
+
+try:
+    from zeep import Plugin
+except (ImportError, IOError) as err:
+    Plugin = object
+    _logger.debug(err)
+
+# Compressed envelopes bigger than this go to disk instead of memory
+AEAT_ENVELOPE_SPOOL_SIZE = 1024 * 1024
+# Seconds between two summaries of the counters in the log
+AEAT_METRICS_LOG_INTERVAL = 300
+
+_metrics = {}
+_metrics_lock = threading.Lock()
+_metrics_logged = time.monotonic()
+_current_call = contextvars.ContextVar("aeat_current_call", default=None)
+_capture = contextvars.ContextVar("aeat_capture", default=None)
+
+
+def _compress(data):
+    """Spooled file with ``data`` gzip compressed."""
+    spool = tempfile.SpooledTemporaryFile(max_size=AEAT_ENVELOPE_SPOOL_SIZE)
+    with gzip.GzipFile(fileobj=spool, mode="wb") as gzip_file:
+        gzip_file.write(data)
+    spool.seek(0)
+    return spool
+
+
+class AeatCall:
+    """Timing, sizes and optionally compressed envelopes of one call."""
+
+    __slots__ = (
+        "operation",
+        "started",
+        "duration",
+        "request_size",
+        "response_size",
+        "status_code",
+        "request",
+        "response",
+    )
+
+    def __init__(self, operation, request_size=0, request=None):
+        self.operation = operation
+        self.started = time.monotonic()
+        self.duration = None
+        self.request_size = request_size
+        self.response_size = None
+        self.status_code = None
+        self.request = request
+        self.response = None
+
+    def attachment_vals(self, res_model, res_ids):
+        """Values to create the ir.attachment of the captured envelopes on
+        each of the ``res_ids`` records.
+        """
+        vals = []
+        for kind, spool in (("request", self.request), ("response", self.response)):
+            if spool is None:
+                continue
+            spool.seek(0)
+            raw = spool.read()
+            vals.extend(
+                {
+                    "name": f"{self.operation}_{kind}.xml.gz",
+                    "raw": raw,
+                    "mimetype": "application/gzip",
+                    "res_model": res_model,
+                    "res_id": res_id,
+                }
+                for res_id in res_ids
+            )
+        return vals
+
+    def close(self):
+        for spool in (self.request, self.response):
+            if spool is not None:
+                spool.close()
+        self.request = self.response = None
+
+
+class AeatCallCapture:
+    """Calls completed while a ``capture_calls`` block is active."""
+
+    def __init__(self, store_envelopes=False):
+        self.store_envelopes = store_envelopes
+        self.calls = []
+
+    def close(self):
+        for call in self.calls:
+            call.close()
+
+
+@contextlib.contextmanager
+def capture_calls(store_envelopes=False):
+    """Collect the ``AeatCall`` of the calls made inside the block in the
+    yielded ``AeatCallCapture``. Spooled envelopes are released on exit.
+    """
+    capture = AeatCallCapture(store_envelopes)
+    token = _capture.set(capture)
+    try:
+        yield capture
+    finally:
+        _capture.reset(token)
+        capture.close()
+
+
+def _record_call(call, error=None):
+    """Add ``call`` to the counters of its operation, as failed with the
+    ``error`` message if given, and log the summary when it is due.
+    """
+    global _metrics_logged
+    with _metrics_lock:
+        stats = _metrics.setdefault(
+            call.operation,
+            {
+                "count": 0,
+                "total_time": 0.0,
+                "max_time": 0.0,
+                "bytes_sent": 0,
+                "bytes_received": 0,
+                "errors": 0,
+                "last_error": None,
+            },
+        )
+        if error is None:
+            stats["count"] += 1
+            stats["total_time"] += call.duration
+            stats["max_time"] = max(stats["max_time"], call.duration)
+            stats["bytes_sent"] += call.request_size
+            stats["bytes_received"] += call.response_size
+        else:
+            stats["errors"] += 1
+            stats["last_error"] = error
+        now = time.monotonic()
+        log_due = now - _metrics_logged >= AEAT_METRICS_LOG_INTERVAL
+        if log_due:
+            _metrics_logged = now
+    if log_due:
+        log_call_metrics()
+
+
+def get_call_metrics():
+    """Copy of the per operation counters of this process."""
+    with _metrics_lock:
+        return {operation: dict(stats) for operation, stats in _metrics.items()}
+
+
+def reset_call_metrics():
+    with _metrics_lock:
+        _metrics.clear()
+
+
+def log_call_metrics():
+    """Log the per operation counters of this process."""
+    for operation, stats in sorted(get_call_metrics().items()):
+        _logger.info(
+            "AEAT %s: %s calls, %.3fs average, %.3fs max, %s bytes sent, "
+            "%s bytes received, %s failed%s",
+            operation,
+            stats["count"],
+            stats["total_time"] / stats["count"] if stats["count"] else 0.0,
+            stats["max_time"],
+            stats["bytes_sent"],
+            stats["bytes_received"],
+            stats["errors"],
+            f" (last: {stats['last_error']})" if stats["last_error"] else "",
+        )
+
+
+def _is_storing():
+    capture = _capture.get()
+    return bool(capture and capture.store_envelopes)
+
+
+def start_call(operation_name, request_file):
+    """Track a call whose request was streamed to ``request_file`` (see
+    ``aeat_envelope.write_envelope``) instead of going through the egress
+    plugins. The response is measured by the plugin as usual.
+    """
+    request_file.seek(0, 2)
+    size = request_file.tell()
+    request_file.seek(0)
+    request = None
+    if _is_storing():
+        request = tempfile.SpooledTemporaryFile(max_size=AEAT_ENVELOPE_SPOOL_SIZE)
+        with gzip.GzipFile(fileobj=request, mode="wb") as gzip_file:
+            shutil.copyfileobj(request_file, gzip_file)
+        request_file.seek(0)
+        request.seek(0)
+    _finish_call("No answer processed")
+    _current_call.set(AeatCall(operation_name, size, request))
+
+
+def record_request_body(body):
+    """Measure, and keep compressed when captured, the request body the
+    transport posts for the call in progress.
+    """
+    call = _current_call.get()
+    if call is None:
+        return
+    call.request_size = len(body)
+    if _is_storing():
+        call.request = _compress(body)
+
+
+def record_response_body(body, status_code=200):
+    """Same as ``record_request_body`` for the body of the answer."""
+    call = _current_call.get()
+    if call is None:
+        return
+    call.response_size = len(body)
+    call.status_code = status_code
+    if _is_storing():
+        call.response = _compress(body)
+    if status_code >= 400 and not body:
+        # zeep raises without going through the ingress plugins
+        _finish_call(f"HTTP {status_code}")
+
+
+def record_call_error(error):
+    """Count the call in progress as failed with ``error``, an exception
+    raised by the transport.
+    """
+    _finish_call(f"{type(error).__name__}: {error}")
+
+
+def _finish_call(error=None):
+    """Count the call in progress, as failed with the ``error`` message if
+    given, and stop tracking it.
+    """
+    call = _current_call.get()
+    if call is None:
+        return
+    try:
+        call.duration = time.monotonic() - call.started
+        if call.response_size is None:
+            call.response_size = 0
+        _record_call(call, error)
+        _logger.debug(
+            "AEAT %s: %.3fs, %s bytes sent, %s bytes received%s",
+            call.operation,
+            call.duration,
+            call.request_size,
+            call.response_size,
+            f", failed: {error}" if error else "",
+        )
+        capture = _capture.get()
+        if capture is not None:
+            capture.calls.append(call)
+    finally:
+        _current_call.set(None)
+
+
+class AeatMetricsPlugin(Plugin):
+    """zeep plugin measuring each call without retaining its envelopes."""
+
+    def egress(self, envelope, http_headers, operation, binding_options):
+        # A previous call whose answer never reached the plugin failed
+        _finish_call("No answer processed")
+        _current_call.set(AeatCall(operation.name))
+        return envelope, http_headers
+
+    def ingress(self, envelope, http_headers, operation):
+        call = _current_call.get()
+        if call is None:
+            return envelope, http_headers
+        if call.response_size is None:
+            # Not received through an AeatTransport
+            call.response_size = int(http_headers.get("Content-Length") or 0)
+        error = None
+        fault = envelope.find("{*}Body/{*}Fault")
+        if fault is not None:
+            error = "Fault: %s" % (
+                fault.findtext("faultstring") or fault.findtext("{*}Reason/{*}Text")
+            )
+        elif call.status_code and call.status_code >= 400:
+            error = f"HTTP {call.status_code}"
+        _finish_call(error)
+        return envelope, http_headers
@@ -6,17 +6,16 @@
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 import logging
 
-from requests import Session
-
 from odoo import _, api, fields, models
 from odoo.exceptions import UserError
 
+from .aeat_client import get_cached_client, get_transport
+from .aeat_metrics import AeatMetricsPlugin
+
 _logger = logging.getLogger(__name__)
 
 try:
     from zeep import Client
-    from zeep.plugins import HistoryPlugin
-    from zeep.transports import Transport
 except (ImportError, IOError) as err:
     _logger.debug(err)
 
@@ -116,6 +115,19 @@ class AeatMixin(models.AbstractModel):
     def _get_aeat_invoice_dict(self):
         raise NotImplementedError()
 
+    def _get_aeat_invoice_dicts(self):
+        """Return a dict {record id: AEAT payload} for the whole recordset.
+
+        Modules building many payloads at once should override it to read the
+        data shared by the records only once.
+        """
+        self._prefetch_aeat_invoice_data()
+        return {record.id: record._get_aeat_invoice_dict() for record in self}
+
+    def _prefetch_aeat_invoice_data(self):
+        """Inheritable method to load in batch the related records read when
+        building the payloads of the recordset."""
+
     @api.model
     def _get_aeat_taxes_map(self, codes, date):
         raise NotImplementedError()
@@ -134,16 +146,26 @@ class AeatMixin(models.AbstractModel):
 
     def _connect_aeat(self, mapping_key):
         self.ensure_one()
-        public_crt, private_key = self.env["l10n.es.aeat.certificate"].get_certificates(
+        credentials = self.env["l10n.es.aeat.certificate"].get_credentials(
             company=self.company_id
         )
         params = self._connect_params_aeat(mapping_key)
-        session = Session()
-        session.cert = (public_crt, private_key)
-        transport = Transport(session=session)
-        history = HistoryPlugin()
-        client = Client(wsdl=params["wsdl"], transport=transport, plugins=[history])
-        return self._bind_service(client, params["port_name"], params["address"])
+
+        def bind_service():
+            transport = get_transport(credentials)
+            client = Client(
+                wsdl=params["wsdl"], transport=transport, plugins=[AeatMetricsPlugin()]
+            )
+            return self._bind_service(client, params["port_name"], params["address"])
+
+        key = (
+            self._name,
+            params["wsdl"],
+            params["port_name"],
+            params["address"],
+            credentials.fingerprint,
+        )
+        return get_cached_client(key, bind_service)
 
     def _get_aeat_country_code(self):
         self.ensure_one()
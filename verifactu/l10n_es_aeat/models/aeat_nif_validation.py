@@ -0,0 +1,294 @@
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+"""Local cache of the AEAT census check of NIF and name pairs.
+
+The AEAT rejects the records whose recipient is not identified in its census,
+which is only known after the whole submission round trip. The pairs used by
+the payload builders are kept here: unknown ones are queued as ``pending`` and
+validated in batches against the ``VNifV2`` service by a scheduled job, and
+each answer is reused until it expires.
+"""
+import logging
+from datetime import timedelta
+
+import psycopg2
+import requests
+from lxml import etree
+
+from odoo import _, api, fields, models
+
+from .aeat_client import _get_session, _get_timeout
+
+_logger = logging.getLogger(__name__)
+
+AEAT_NIF_VALIDATION_URL = (
+    "https://www1.agenciatributaria.gob.es/wlpl/BURT-JDIT/ws/VNifV2SOAP"
+)
+# Pairs per request accepted by the service
+AEAT_NIF_VALIDATION_BATCH = 10000
+# Days an answer of the census is trusted
+AEAT_NIF_VALIDATION_DAYS = 30
+SOAP_ENV_NS = "http://schemas.xmlsoap.org/soap/envelope/"
+VNIF_BASE_NS = (
+    "http://www2.agenciatributaria.gob.es/static_files/common/internet/dep/"
+    "aplicaciones/es/aeat/burt/jdit/ws/"
+)
+VNIF_REQUEST_NS = VNIF_BASE_NS + "VNifV2Ent.xsd"
+VNIF_RESPONSE_NS = VNIF_BASE_NS + "VNifV2Sal.xsd"
+VNIF_IDENTIFIED = "IDENTIFICADO"
+VNIF_NOT_IDENTIFIED = "NO IDENTIFICADO"
+
+
+def build_nif_validation_request(pairs):
+    """``VNifV2Ent`` envelope checking the ``(nif, name)`` pairs."""
+    envelope = etree.Element(
+        f"{{{SOAP_ENV_NS}}}Envelope",
+        nsmap={"soapenv": SOAP_ENV_NS, "vnif": VNIF_REQUEST_NS},
+    )
+    body = etree.SubElement(envelope, f"{{{SOAP_ENV_NS}}}Body")
+    request = etree.SubElement(body, f"{{{VNIF_REQUEST_NS}}}VNifV2Ent")
+    for nif, name in pairs:
+        taxpayer = etree.SubElement(request, f"{{{VNIF_REQUEST_NS}}}Contribuyente")
+        etree.SubElement(taxpayer, f"{{{VNIF_REQUEST_NS}}}Nif").text = nif
+        etree.SubElement(taxpayer, f"{{{VNIF_REQUEST_NS}}}Nombre").text = name
+    return etree.tostring(envelope, xml_declaration=True, encoding="UTF-8")
+
+
+def parse_nif_validation_response(content):
+    """Results of a ``VNifV2Sal`` answer.
+
+    :return: list of ``(nif, census name, result)``, in the order of the
+      request. Besides ``IDENTIFICADO`` and ``NO IDENTIFICADO``, the result may
+      flag a NIF as withdrawn or revoked (``IDENTIFICADO-BAJA``, ...) or as not
+      processed.
+    """
+    res = []
+    for taxpayer in etree.fromstring(content).iter(
+        f"{{{VNIF_RESPONSE_NS}}}Contribuyente"
+    ):
+        res.append(
+            (
+                taxpayer.findtext(f"{{{VNIF_RESPONSE_NS}}}Nif"),
+                taxpayer.findtext(f"{{{VNIF_RESPONSE_NS}}}Nombre"),
+                taxpayer.findtext(f"{{{VNIF_RESPONSE_NS}}}Resultado"),
+            )
+        )
+    return res
+
+
+class L10nEsAeatNifValidation(models.Model):
+    _name = "l10n.es.aeat.nif.validation"
+    _description = "AEAT census check of a NIF and name"
+    _order = "check_date desc, id desc"
+
+    nif = fields.Char(string="NIF", required=True, index=True)
+    name = fields.Char(required=True)
+    name_key = fields.Char(
+        required=True,
+        index=True,
+        help="Name normalized as it is compared with the cache.",
+    )
+    state = fields.Selection(
+        selection=[
+            ("pending", "Pending"),
+            ("valid", "Identified"),
+            ("invalid", "Not identified"),
+        ],
+        default="pending",
+        required=True,
+        index=True,
+    )
+    census_name = fields.Char(help="Name of the taxpayer in the AEAT census.")
+    check_date = fields.Datetime(readonly=True)
+    expiry_date = fields.Datetime(readonly=True, index=True)
+    error = fields.Char(readonly=True, help="Last error when calling the census.")
+
+    _sql_constraints = [
+        (
+            "nif_name_unique",
+            "unique(nif, name_key)",
+            "The NIF and name pair is already in the cache.",
+        )
+    ]
+
+    @api.model
+    def _normalize_name(self, name):
+        return " ".join((name or "").upper().split())
+
+    @api.model
+    def _get_entries(self, pairs):
+        """Cached checks of the ``(nif, name)`` pairs, queueing the unknown
+        ones for the next validation job.
+
+        :return: dict {(nif, name_key): entry}
+        """
+        keys = {}
+        for nif, name in pairs:
+            if nif and name:
+                keys.setdefault((nif, self._normalize_name(name)), name)
+        if not keys:
+            return {}
+        entries = self.sudo().search(
+            [
+                ("nif", "in", list({nif for nif, __ in keys})),
+                ("name_key", "in", list({name_key for __, name_key in keys})),
+            ]
+        )
+        res = {
+            (entry.nif, entry.name_key): entry
+            for entry in entries
+            if (entry.nif, entry.name_key) in keys
+        }
+        missing = [key for key in keys if key not in res]
+        if missing:
+            try:
+                with self.env.cr.savepoint():
+                    new_entries = self.sudo().create(
+                        [
+                            {
+                                "nif": nif,
+                                "name": keys[(nif, name_key)],
+                                "name_key": name_key,
+                            }
+                            for nif, name_key in missing
+                        ]
+                    )
+            except psycopg2.IntegrityError:
+                # Queued meanwhile by a concurrent transaction
+                new_entries = self.sudo().search(
+                    [
+                        ("nif", "in", [nif for nif, __ in missing]),
+                        ("name_key", "in", [name_key for __, name_key in missing]),
+                    ]
+                )
+            res.update({(entry.nif, entry.name_key): entry for entry in new_entries})
+        return res
+
+    @api.model
+    def _get_invalid_partners(self, partners):
+        """Partners with a Spanish NIF known not to be in the census with
+        their name. Those never checked are queued and not returned.
+        """
+        spanish = partners.filtered(
+            lambda partner: partner.aeat_country_code == "ES"
+            and not partner.aeat_id_type
+            and partner.aeat_id_number
+        )
+        entries = self._get_entries(
+            [(partner.aeat_id_number, partner.name) for partner in spanish]
+        )
+        now = fields.Datetime.now()
+        invalid = partners.browse()
+        for partner in spanish:
+            entry = entries.get(
+                (partner.aeat_id_number, self._normalize_name(partner.name))
+            )
+            if entry and entry.state == "invalid" and entry.expiry_date > now:
+                invalid |= partner
+        return invalid
+
+    @api.model
+    def _get_validation_url(self):
+        return (
+            self.env["ir.config_parameter"]
+            .sudo()
+            .get_param("l10n_es_aeat.nif_validation_url", AEAT_NIF_VALIDATION_URL)
+        )
+
+    @api.model
+    def _post_validation_request(self, content):
+        """Send a ``VNifV2Ent`` envelope and return the answer body. The
+        certificate of the current company authenticates the calls to the
+        AEAT; plain HTTP endpoints, as a local stand-in, are called without it.
+        """
+        url = self._get_validation_url()
+        if url.startswith("https://"):
+            credentials = self.env["l10n.es.aeat.certificate"].get_credentials(
+                self.env.company
+            )
+            post = _get_session(credentials).post
+        else:
+            post = requests.post
+        response = post(
+            url,
+            data=content,
+            headers={"Content-Type": "text/xml; charset=utf-8"},
+            timeout=_get_timeout(),
+        )
+        response.raise_for_status()
+        return response.content
+
+    def _validate(self):
+        """Check the entries of ``self`` against the census, one request per
+        batch of ``AEAT_NIF_VALIDATION_BATCH`` pairs, and write the states
+        with one statement per result.
+
+        Only an explicit ``NO IDENTIFICADO`` marks a pair as invalid. Any other
+        answer keeps it pending, with the result as error, to be checked again
+        by the next run.
+        """
+        params = self.env["ir.config_parameter"].sudo()
+        days = int(
+            params.get_param(
+                "l10n_es_aeat.nif_validation_days", AEAT_NIF_VALIDATION_DAYS
+            )
+        )
+        for start in range(0, len(self), AEAT_NIF_VALIDATION_BATCH):
+            batch = self[start : start + AEAT_NIF_VALIDATION_BATCH]
+            try:
+                answers = parse_nif_validation_response(
+                    self._post_validation_request(
+                        build_nif_validation_request(
+                            [(entry.nif, entry.name) for entry in batch]
+                        )
+                    )
+                )
+            except (requests.RequestException, etree.XMLSyntaxError) as error:
+                _logger.warning("AEAT census check failed: %s", error)
+                batch.write({"error": str(error)})
+                continue
+            if len(answers) != len(batch):
+                batch.write({"error": _("Unexpected answer of the census.")})
+                continue
+            now = fields.Datetime.now()
+            vals = {
+                "check_date": now,
+                "expiry_date": now + timedelta(days=days),
+                "error": False,
+            }
+            identified = not_identified = batch.browse()
+            unknown = {}
+            for entry, (__, census_name, result) in zip(batch, answers):
+                if result == VNIF_IDENTIFIED:
+                    identified |= entry
+                elif result == VNIF_NOT_IDENTIFIED:
+                    not_identified |= entry
+                else:
+                    unknown.setdefault(result, batch.browse())
+                    unknown[result] |= entry
+                if census_name and census_name != entry.census_name:
+                    entry.census_name = census_name
+            identified.write(dict(vals, state="valid"))
+            not_identified.write(dict(vals, state="invalid"))
+            for result, entries in unknown.items():
+                entries.write(
+                    {
+                        "state": "pending",
+                        "check_date": now,
+                        "error": _("Unexpected census result: %s", result),
+                    }
+                )
+
+    @api.model
+    def _cron_validate(self, limit=AEAT_NIF_VALIDATION_BATCH * 5):
+        """Validate the pending and expired pairs, oldest first."""
+        entries = self.search(
+            [
+                "|",
+                ("state", "=", "pending"),
+                ("expiry_date", "<", fields.Datetime.now()),
+            ],
+            order="id",
+            limit=limit,
+        )
+        entries._validate()
+        return len(entries)
@@ -0,0 +1,180 @@
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+"""Detached XAdES signatures made with the company certificate.
+
+The private key is decrypted from the PKCS#12 stored in the database (or read
+from the PEM files of legacy certificates) once per process and kept as a
+``cryptography`` key object, keyed by the certificate fingerprint like the TLS
+contexts of ``aeat_client``.
+
+``sign_detached`` signs a batch of documents in the calling process. With the
+key already loaded, thousands of records are signed per second, so no worker
+processes are forked from the server to spread the RSA operations.
+"""
+import base64
+import hashlib
+import logging
+import threading
+import uuid
+from datetime import datetime, timezone
+
+from lxml import etree
+
+_logger = logging.getLogger(__name__)
+
+try:
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import padding
+    from cryptography.hazmat.primitives.serialization import (
+        Encoding,
+        load_pem_private_key,
+        pkcs12,
+    )
+except (ImportError, IOError) as err:
+    _logger.debug(err)
+
+DS_NS = "http://www.w3.org/2000/09/xmldsig#"
+XADES_NS = "http://uri.etsi.org/01903/v1.3.2#"
+EXC_C14N = "http://www.w3.org/2001/10/xml-exc-c14n#"
+RSA_SHA256 = "http://www.w3.org/2001/04/xmldsig-more#rsa-sha256"
+SHA256 = "http://www.w3.org/2001/04/xmlenc#sha256"
+SIGNED_PROPERTIES_TYPE = "http://uri.etsi.org/01903#SignedProperties"
+
+_signing_keys = {}
+_signing_keys_lock = threading.Lock()
+
+
+def _load_signing_key(credentials):
+    if credentials.pkcs12:
+        key, certificate, __ = pkcs12.load_key_and_certificates(
+            credentials.pkcs12, credentials.password
+        )
+        return key, certificate
+    with open(credentials.private_key, "rb") as key_file:
+        key = load_pem_private_key(key_file.read(), None)
+    with open(credentials.public_crt, "rb") as certificate_file:
+        certificate = x509.load_pem_x509_certificate(certificate_file.read())
+    return key, certificate
+
+
+def get_signing_key(credentials):
+    """Private key and certificate of ``credentials``, loaded once per process."""
+    key = credentials.fingerprint
+    with _signing_keys_lock:
+        entry = _signing_keys.get(key)
+        if entry is None:
+            entry = _signing_keys[key] = _load_signing_key(credentials)
+    return entry
+
+
+def clear_signing_keys():
+    with _signing_keys_lock:
+        _signing_keys.clear()
+
+
+def _digest(content):
+    return base64.b64encode(hashlib.sha256(content).digest()).decode()
+
+
+def _c14n(element):
+    return etree.tostring(element, method="c14n", exclusive=True)
+
+
+def _rsa_sign(key, content):
+    return key.sign(content, padding.PKCS1v15(), hashes.SHA256())
+
+
+def _add_reference(signed_info, uri, digest, reference_type=None):
+    reference = etree.SubElement(signed_info, f"{{{DS_NS}}}Reference", URI=uri)
+    if reference_type:
+        reference.set("Type", reference_type)
+    transforms = etree.SubElement(reference, f"{{{DS_NS}}}Transforms")
+    etree.SubElement(transforms, f"{{{DS_NS}}}Transform", Algorithm=EXC_C14N)
+    etree.SubElement(reference, f"{{{DS_NS}}}DigestMethod", Algorithm=SHA256)
+    etree.SubElement(reference, f"{{{DS_NS}}}DigestValue").text = digest
+
+
+def _build_signature(certificate, uri, content, signing_time):
+    """``ds:Signature`` of ``content`` without its ``SignatureValue``.
+
+    :return: tuple (signature element, canonical ``SignedInfo`` to sign)
+    """
+    signature_id = f"Signature-{uuid.uuid4()}"
+    signature = etree.Element(
+        f"{{{DS_NS}}}Signature", nsmap={"ds": DS_NS}, Id=signature_id
+    )
+    signed_info = etree.SubElement(signature, f"{{{DS_NS}}}SignedInfo")
+    etree.SubElement(
+        signed_info, f"{{{DS_NS}}}CanonicalizationMethod", Algorithm=EXC_C14N
+    )
+    etree.SubElement(signed_info, f"{{{DS_NS}}}SignatureMethod", Algorithm=RSA_SHA256)
+    etree.SubElement(signature, f"{{{DS_NS}}}SignatureValue")
+    certificate_der = certificate.public_bytes(Encoding.DER)
+    key_info = etree.SubElement(signature, f"{{{DS_NS}}}KeyInfo")
+    x509_data = etree.SubElement(key_info, f"{{{DS_NS}}}X509Data")
+    etree.SubElement(x509_data, f"{{{DS_NS}}}X509Certificate").text = (
+        base64.b64encode(certificate_der).decode()
+    )
+    qualifying_properties = etree.SubElement(
+        etree.SubElement(signature, f"{{{DS_NS}}}Object"),
+        f"{{{XADES_NS}}}QualifyingProperties",
+        nsmap={"xades": XADES_NS},
+        Target=f"#{signature_id}",
+    )
+    signed_properties_id = f"SignedProperties-{signature_id}"
+    signed_properties = etree.SubElement(
+        qualifying_properties,
+        f"{{{XADES_NS}}}SignedProperties",
+        Id=signed_properties_id,
+    )
+    signature_properties = etree.SubElement(
+        signed_properties, f"{{{XADES_NS}}}SignedSignatureProperties"
+    )
+    etree.SubElement(signature_properties, f"{{{XADES_NS}}}SigningTime").text = (
+        signing_time
+    )
+    cert = etree.SubElement(
+        etree.SubElement(signature_properties, f"{{{XADES_NS}}}SigningCertificate"),
+        f"{{{XADES_NS}}}Cert",
+    )
+    cert_digest = etree.SubElement(cert, f"{{{XADES_NS}}}CertDigest")
+    etree.SubElement(cert_digest, f"{{{DS_NS}}}DigestMethod", Algorithm=SHA256)
+    etree.SubElement(cert_digest, f"{{{DS_NS}}}DigestValue").text = _digest(
+        certificate_der
+    )
+    issuer_serial = etree.SubElement(cert, f"{{{XADES_NS}}}IssuerSerial")
+    etree.SubElement(issuer_serial, f"{{{DS_NS}}}X509IssuerName").text = (
+        certificate.issuer.rfc4514_string()
+    )
+    etree.SubElement(issuer_serial, f"{{{DS_NS}}}X509SerialNumber").text = str(
+        certificate.serial_number
+    )
+    _add_reference(signed_info, uri, _digest(content))
+    _add_reference(
+        signed_info,
+        f"#{signed_properties_id}",
+        _digest(_c14n(signed_properties)),
+        SIGNED_PROPERTIES_TYPE,
+    )
+    return signature, _c14n(signed_info)
+
+
+def sign_detached(credentials, documents):
+    """Detached XAdES signatures of ``documents``.
+
+    :param documents: list of ``(uri, content)``, where ``content`` is the
+      canonical bytes of the document referenced by ``uri``.
+    :return: list of the ``ds:Signature`` documents, in the same order.
+    """
+    key, certificate = get_signing_key(credentials)
+    signing_time = datetime.now(timezone.utc).isoformat(timespec="seconds")
+    res = []
+    for uri, content in documents:
+        signature, signed_info = _build_signature(
+            certificate, uri, content, signing_time
+        )
+        signature.find(f"{{{DS_NS}}}SignatureValue").text = base64.b64encode(
+            _rsa_sign(key, signed_info)
+        ).decode()
+        res.append(etree.tostring(signature, encoding="UTF-8"))
+    return res
@@ -2,16 +2,15 @@
 # License AGPL-3 - See http://www.gnu.org/licenses/agpl-3.0.html
 import logging
 
-from requests import Session
-
 from odoo import models
 
+from .aeat_client import get_cached_client, get_transport
+from .aeat_metrics import AeatMetricsPlugin
+
 _logger = logging.getLogger(__name__)
 
 try:
     from zeep import Client
-    from zeep.plugins import HistoryPlugin
-    from zeep.transports import Transport
 except (ImportError, IOError) as err:
     _logger.debug(err)
 
@@ -22,21 +21,18 @@ class L10nEsAeatSoap(models.TransientModel):
 
     def connect_soap(self, wsdl, model):
         if "company_id" in model._fields:
-            public_crt, private_key = self.env[
-                "l10n.es.aeat.certificate"
-            ].get_certificates(model.company_id)
+            credentials = self.env["l10n.es.aeat.certificate"].get_credentials(
+                model.company_id
+            )
         else:
-            public_crt, private_key = self.env[
-                "l10n.es.aeat.certificate"
-            ].get_certificates()
+            credentials = self.env["l10n.es.aeat.certificate"].get_credentials()
 
-        session = Session()
-        session.cert = (public_crt, private_key)
-        transport = Transport(session=session)
+        def build_client():
+            transport = get_transport(credentials)
+            return Client(wsdl=wsdl, transport=transport, plugins=[AeatMetricsPlugin()])
 
-        history = HistoryPlugin()
-        client = Client(wsdl=wsdl, transport=transport, plugins=[history])
-        return client
+        key = (wsdl, credentials.fingerprint)
+        return get_cached_client(key, build_client)
 
     def get_test_mode(self, port_name, model):
         port_name = model.get_test_mode(port_name)
@@ -3,9 +3,17 @@
 
 from odoo import fields, models
 
+from .aeat_client import clear_client_cache
+
 
 class AeatTaxAgency(models.Model):
     _name = "aeat.tax.agency"
     _description = "Aeat Tax Agency"
 
     name = fields.Char(required=True)
+
+    def write(self, vals):
+        """Cached SOAP clients may point to the old WSDL or addresses."""
+        res = super().write(vals)
+        clear_client_cache()
+        return res
@@ -2,7 +2,7 @@
 # Copyright 2017 Tecnativa - Pedro M. Baeza
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
 
-from odoo import fields, models
+from odoo import api, fields, models
 from odoo.tools import ormcache
 
 
@@ -44,6 +44,27 @@ class ResPartner(models.Model):
     aeat_sending_enabled = fields.Boolean(
         compute="_compute_aeat_sending_enabled",
     )
+    # AEAT identity split from the VAT, stored so that the payload builders
+    # read plain columns and reports can filter or group on them
+    aeat_country_code = fields.Char(
+        string="AEAT country code",
+        compute="_compute_aeat_identity",
+        store=True,
+        index=True,
+    )
+    aeat_id_type = fields.Char(
+        string="AEAT identifier type",
+        compute="_compute_aeat_identity",
+        store=True,
+        help="Empty for Spanish NIFs, 02 for intra-community VAT numbers and "
+        "04 or the AEAT identification type for the rest.",
+    )
+    aeat_id_number = fields.Char(
+        string="AEAT identifier",
+        compute="_compute_aeat_identity",
+        store=True,
+        index=True,
+    )
 
     def _compute_aeat_sending_enabled(self):
         self.aeat_sending_enabled = False
@@ -89,37 +110,65 @@ class ResPartner(models.Model):
             )
         return europe.country_ids.mapped("code")
 
-    @ormcache("self.vat, self.country_id")
+    @api.depends(
+        "vat", "country_id.code", "aeat_identification_type", "aeat_identification"
+    )
+    def _compute_aeat_identity(self):
+        """Split the VAT of the partners into the AEAT country code,
+        identifier type and identifier. The Europe codes and the countries of
+        the VAT prefixes are read once for the whole recordset.
+        """
+        europe_codes = set(self._get_aeat_europe_codes())
+        prefixes = {
+            (partner.vat or "")[:2].upper()
+            for partner in self
+            if not partner.country_id.code
+        }
+        prefix_countries = set()
+        if prefixes:
+            prefix_countries = set(
+                self.env["res.country"]
+                .search([("code", "in", list(prefixes))])
+                .mapped("code")
+            )
+        for partner in self:
+            vat_number = partner.vat or ""
+            prefix = vat_number[:2].upper()
+            if partner._map_aeat_country_code(prefix) in europe_codes:
+                country_code = prefix
+                vat_number = vat_number[2:]
+                identifier_type = "02"
+            else:
+                if partner.country_id.code:
+                    country_code = partner.country_id.code
+                elif prefix in prefix_countries:
+                    country_code = prefix
+                else:
+                    country_code = ""
+                if partner._map_aeat_country_code(country_code) in europe_codes:
+                    identifier_type = "02"
+                else:
+                    country_code = partner._map_aeat_country_code(
+                        country_code, extended=True
+                    )
+                    identifier_type = "04"
+            if country_code == "ES":
+                identifier_type = ""
+            partner.aeat_country_code = country_code
+            partner.aeat_id_type = partner.aeat_identification_type or identifier_type
+            partner.aeat_id_number = (
+                partner.aeat_identification
+                if partner.aeat_identification_type
+                else vat_number
+            )
+
     def _parse_aeat_vat_info(self):
         """Return tuple with split info (country_code, identifier_type and
         vat_number) from vat and country partner
         """
         self.ensure_one()
-        vat_number = self.vat or ""
-        prefix = vat_number[:2].upper()
-        if self._map_aeat_country_code(prefix) in self._get_aeat_europe_codes():
-            country_code = prefix
-            vat_number = vat_number[2:]
-            identifier_type = "02"
-        else:
-            if self.country_id.code:
-                country_code = self.country_id.code
-            elif self.env["res.country"].search([("code", "=", prefix)]):
-                country_code = prefix
-            else:
-                country_code = ""
-            if (
-                self._map_aeat_country_code(country_code)
-                in self._get_aeat_europe_codes()
-            ):
-                identifier_type = "02"
-            else:
-                country_code = self._map_aeat_country_code(country_code, extended=True)
-                identifier_type = "04"
-        if country_code == "ES":
-            identifier_type = ""
         return (
-            country_code,
-            self.aeat_identification_type or identifier_type,
-            self.aeat_identification if self.aeat_identification_type else vat_number,
+            self.aeat_country_code or "",
+            self.aeat_id_type or "",
+            self.aeat_id_number or "",
         )
@@ -101,6 +101,26 @@ class TestL10nEsAeat(TransactionCase):
         self.assertEqual(identifier_type, "04")
         self.assertEqual(vat_number, "CU12345678Z")
 
+    def test_aeat_identity_stored(self):
+        partners = self.env["res.partner"].create(
+            [
+                {"name": "FR partner", "vat": "FR61954506077"},
+                {"name": "ES partner", "vat": "ES12345678Z"},
+            ]
+        )
+        self.assertEqual(partners.mapped("aeat_country_code"), ["FR", "ES"])
+        self.assertEqual(partners.mapped("aeat_id_type"), ["02", False])
+        self.assertEqual(
+            self.env["res.partner"].search(
+                [("id", "in", partners.ids), ("aeat_id_number", "=", "61954506077")]
+            ),
+            partners[0],
+        )
+        partners[1].write(
+            {"aeat_identification_type": "03", "aeat_identification": "X123"}
+        )
+        self.assertEqual(partners[1]._parse_aeat_vat_info(), ("ES", "03", "X123"))
+
     def test_unique_date_range(self):
         self.env["l10n.es.aeat.map.tax"].create(
             {"date_from": "2020-01-01", "model": 303}
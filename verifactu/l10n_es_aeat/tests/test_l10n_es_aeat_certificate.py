@@ -15,7 +15,7 @@ from cryptography.hazmat.primitives.serialization import (
 )
 from cryptography.x509 import oid
 
-from odoo import exceptions
+from odoo import exceptions, fields
 from odoo.tests import Form, common
 
 CRYPTOGRAPHY_VERSION_3 = tuple(map(int, cryptography.__version__.split("."))) >= (3, 0)
@@ -147,3 +147,30 @@ class TestL10nEsAeatCertificate(TestL10nEsAeatCertificateBase):
             self.assertEqual(f.public_key_data, self.public_key)
             f.show_public_key = False
             self.assertFalse(f.public_key_data)
+
+    def test_certificate_kept_in_database(self):
+        self._activate_certificate(self.certificate_password)
+        self.assertFalse(self.sii_cert.public_key)
+        self.assertFalse(self.sii_cert.private_key)
+        credentials = self.env["l10n.es.aeat.certificate"].get_credentials(
+            self.sii_cert.company_id
+        )
+        _key, certificate, _chain = pkcs12.load_key_and_certificates(
+            credentials.pkcs12, credentials.password
+        )
+        self.assertEqual(certificate.public_bytes(Encoding.PEM), self.public_key.encode())
+        with self.assertRaises(exceptions.UserError):
+            self.env["l10n.es.aeat.certificate"].get_certificates(
+                self.sii_cert.company_id
+            )
+
+    def test_get_credentials_cached(self):
+        self._activate_certificate(self.certificate_password)
+        certificate_obj = self.env["l10n.es.aeat.certificate"]
+        company = self.sii_cert.company_id
+        credentials = certificate_obj.get_credentials(company)
+        with self.assertQueryCount(0):
+            self.assertEqual(certificate_obj.get_credentials(company), credentials)
+        self.sii_cert.date_end = fields.Date.subtract(fields.Date.today(), days=1)
+        with self.assertRaises(exceptions.UserError):
+            certificate_obj.get_credentials(company)
@@ -0,0 +1,113 @@
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+import gzip
+from types import SimpleNamespace
+from unittest.mock import MagicMock, Mock, patch
+
+from lxml import etree
+
+from odoo.addons.l10n_es_aeat.models import aeat_client, aeat_metrics
+
+from .test_l10n_es_aeat_certificate import TestL10nEsAeatCertificateBase
+
+
+class TestL10nEsAeatClient(TestL10nEsAeatCertificateBase):
+    def setUp(self):
+        super().setUp()
+        aeat_client.clear_client_cache()
+
+    def test_client_cached_per_key(self):
+        factory = Mock(side_effect=lambda: object())
+        client = aeat_client.get_cached_client(("wsdl", "fp"), factory)
+        self.assertIs(aeat_client.get_cached_client(("wsdl", "fp"), factory), client)
+        self.assertIsNot(
+            aeat_client.get_cached_client(("wsdl", "other"), factory), client
+        )
+        self.assertEqual(factory.call_count, 2)
+
+    def test_client_cache_invalidated_on_certificate_change(self):
+        factory = Mock(side_effect=lambda: object())
+        client = aeat_client.get_cached_client(("wsdl", "fp"), factory)
+        self._activate_certificate()
+        self.assertIsNot(aeat_client.get_cached_client(("wsdl", "fp"), factory), client)
+
+    def test_session_pooled_per_certificate(self):
+        self._activate_certificate()
+        credentials = self.env["l10n.es.aeat.certificate"].get_credentials(
+            self.sii_cert.company_id
+        )
+        transport = aeat_client.get_transport(credentials)
+        self.assertIs(aeat_client.get_transport(credentials).session, transport.session)
+        adapter = transport.session.get_adapter("https://www1.agenciatributaria.gob.es")
+        self.assertIs(adapter.ssl_context, aeat_client.get_ssl_context(credentials))
+        self.assertIsNone(transport.session.cert)
+        self.assertEqual(
+            transport.operation_timeout,
+            (aeat_client.AEAT_CONNECT_TIMEOUT, aeat_client.AEAT_READ_TIMEOUT),
+        )
+
+    def test_metrics_plugin_keeps_no_envelopes(self):
+        aeat_metrics.reset_call_metrics()
+        plugin = aeat_metrics.AeatMetricsPlugin()
+        envelope = etree.fromstring(b"<Envelope><Body>test</Body></Envelope>")
+        operation = SimpleNamespace(name="TestOperation")
+        plugin.egress(envelope, {}, operation, {})
+        plugin.ingress(envelope, {"Content-Length": "42"}, operation)
+        stats = aeat_metrics.get_call_metrics()["TestOperation"]
+        self.assertEqual(stats["count"], 1)
+        self.assertEqual(stats["bytes_received"], 42)
+        # Sizes and stored envelopes come from the bodies the transport
+        # exchanges, the envelope is not serialized again
+        answer = b"<Envelope><Body>answer</Body></Envelope>"
+        session = MagicMock()
+        session.post.return_value = SimpleNamespace(
+            content=answer, status_code=200, headers={}
+        )
+        transport = aeat_client.AeatTransport(session=session)
+        with aeat_metrics.capture_calls(store_envelopes=True) as capture, patch.object(
+            etree, "tostring", wraps=etree.tostring
+        ) as tostring:
+            plugin.egress(envelope, {}, operation, {})
+            transport.post_xml("https://aeat", envelope, {})
+            plugin.ingress(envelope, {}, operation)
+            vals = capture.calls[0].attachment_vals("res.partner", [1])
+        self.assertEqual(tostring.call_count, 1)
+        self.assertEqual(len(vals), 2)
+        self.assertIn(b"<Body>test</Body>", gzip.decompress(vals[0]["raw"]))
+        self.assertEqual(gzip.decompress(vals[1]["raw"]), answer)
+        self.assertIsNone(capture.calls[0].request)
+        stats = aeat_metrics.get_call_metrics()["TestOperation"]
+        self.assertEqual(stats["count"], 2)
+        self.assertEqual(stats["bytes_received"], 42 + len(answer))
+        self.assertEqual(
+            stats["bytes_sent"], len(session.post.call_args[1]["data"])
+        )
+
+    def test_metrics_failed_calls(self):
+        aeat_metrics.reset_call_metrics()
+        plugin = aeat_metrics.AeatMetricsPlugin()
+        envelope = etree.fromstring(b"<Envelope><Body>test</Body></Envelope>")
+        operation = SimpleNamespace(name="TestOperation")
+        session = MagicMock()
+        session.post.side_effect = ConnectionError("refused")
+        transport = aeat_client.AeatTransport(session=session)
+        plugin.egress(envelope, {}, operation, {})
+        with self.assertRaises(ConnectionError):
+            transport.post_xml("https://aeat", envelope, {})
+        self.assertIsNone(aeat_metrics._current_call.get())
+        # zeep raises on an empty HTTP error without calling the plugins
+        session.post.side_effect = None
+        session.post.return_value = SimpleNamespace(
+            content=b"", status_code=503, headers={}
+        )
+        plugin.egress(envelope, {}, operation, {})
+        transport.post_xml("https://aeat", envelope, {})
+        self.assertIsNone(aeat_metrics._current_call.get())
+        stats = aeat_metrics.get_call_metrics()["TestOperation"]
+        self.assertEqual(stats["count"], 0)
+        self.assertEqual(stats["bytes_sent"], 0)
+        self.assertEqual(stats["errors"], 2)
+        self.assertEqual(stats["last_error"], "HTTP 503")
+        with self.assertLogs(aeat_metrics._logger.name, "INFO") as logs:
+            aeat_metrics.log_call_metrics()
+        self.assertIn("2 failed (last: HTTP 503)", logs.output[0])
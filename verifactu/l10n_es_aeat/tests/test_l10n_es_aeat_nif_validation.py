@@ -0,0 +1,119 @@
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+from datetime import timedelta
+from unittest.mock import patch
+
+from lxml import etree
+
+from odoo import fields
+from odoo.tests.common import TransactionCase
+
+from odoo.addons.l10n_es_aeat.models.aeat_nif_validation import (
+    SOAP_ENV_NS,
+    VNIF_REQUEST_NS,
+    VNIF_RESPONSE_NS,
+    L10nEsAeatNifValidation,
+)
+
+
+def _census_response(content, unidentified=(), results=None):
+    """``VNifV2Sal`` answer identifying every pair but ``unidentified``, or
+    with the result given in ``results`` by NIF
+    """
+    envelope = etree.Element(f"{{{SOAP_ENV_NS}}}Envelope")
+    body = etree.SubElement(envelope, f"{{{SOAP_ENV_NS}}}Body")
+    response = etree.SubElement(body, f"{{{VNIF_RESPONSE_NS}}}VNifV2Sal")
+    for taxpayer in etree.fromstring(content).iter(
+        f"{{{VNIF_REQUEST_NS}}}Contribuyente"
+    ):
+        nif = taxpayer.findtext(f"{{{VNIF_REQUEST_NS}}}Nif")
+        result = etree.SubElement(response, f"{{{VNIF_RESPONSE_NS}}}Contribuyente")
+        etree.SubElement(result, f"{{{VNIF_RESPONSE_NS}}}Nif").text = nif
+        etree.SubElement(result, f"{{{VNIF_RESPONSE_NS}}}Resultado").text = (
+            (results or {}).get(nif)
+            or ("NO IDENTIFICADO" if nif in unidentified else "IDENTIFICADO")
+        )
+    return etree.tostring(envelope)
+
+
+class TestL10nEsAeatNifValidation(TransactionCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.validation_model = cls.env["l10n.es.aeat.nif.validation"]
+        spain = cls.env.ref("base.es")
+        cls.partners = cls.env["res.partner"].create(
+            [
+                {"name": "Good  customer", "vat": "12345678Z", "country_id": spain.id},
+                {"name": "Bad customer", "vat": "00000000T", "country_id": spain.id},
+                {"name": "Foreign customer", "vat": "FR61954506077"},
+            ]
+        )
+
+    def _validate(self, unidentified=(), results=None):
+        with patch.object(
+            L10nEsAeatNifValidation,
+            "_post_validation_request",
+            autospec=True,
+            side_effect=lambda model, content: _census_response(
+                content, unidentified, results
+            ),
+        ) as post:
+            self.validation_model._cron_validate()
+        return post
+
+    def test_unknown_pairs_queued(self):
+        self.assertFalse(self.validation_model._get_invalid_partners(self.partners))
+        entries = self.validation_model.search(
+            [("nif", "in", ["12345678Z", "00000000T"])]
+        )
+        self.assertEqual(len(entries), 2)
+        self.assertEqual(set(entries.mapped("state")), {"pending"})
+        self.assertEqual(
+            entries.filtered(lambda e: e.nif == "12345678Z").name_key, "GOOD CUSTOMER"
+        )
+        # Spanish NIFs only: the census does not hold foreign VAT numbers
+        self.assertFalse(self.validation_model.search([("nif", "=", "61954506077")]))
+        self.validation_model._get_invalid_partners(self.partners)
+        self.assertEqual(
+            self.validation_model.search_count(
+                [("nif", "in", ["12345678Z", "00000000T"])]
+            ),
+            2,
+        )
+
+    def test_batch_validation(self):
+        self.validation_model._get_invalid_partners(self.partners)
+        post = self._validate(unidentified={"00000000T"})
+        self.assertEqual(post.call_count, 1)
+        self.assertEqual(
+            self.validation_model._get_invalid_partners(self.partners),
+            self.partners[1],
+        )
+        # Renaming the partner makes a new pair to check
+        self.partners[1].name = "Bad customer S.L."
+        self.assertFalse(self.validation_model._get_invalid_partners(self.partners))
+        # Nothing left to check until the answers expire
+        self.assertEqual(self._validate().call_count, 1)
+        self.assertEqual(self._validate().call_count, 0)
+
+    def test_expired_answers_checked_again(self):
+        self.validation_model._get_invalid_partners(self.partners)
+        self._validate(unidentified={"00000000T"})
+        entry = self.validation_model.search([("nif", "=", "00000000T")])
+        entry.expiry_date = fields.Datetime.now() - timedelta(days=1)
+        self.assertFalse(self.validation_model._get_invalid_partners(self.partners))
+        self._validate()
+        self.assertEqual(entry.state, "valid")
+
+    def test_other_results_kept_pending(self):
+        self.validation_model._get_invalid_partners(self.partners)
+        self._validate(results={"00000000T": "IDENTIFICADO-BAJA"})
+        entry = self.validation_model.search([("nif", "=", "00000000T")])
+        self.assertEqual(entry.state, "pending")
+        self.assertIn("IDENTIFICADO-BAJA", entry.error)
+        self.assertFalse(self.validation_model._get_invalid_partners(self.partners))
+        # Checked again by the next run
+        self._validate(unidentified={"00000000T"})
+        self.assertEqual(entry.state, "invalid")
+        self.assertFalse(entry.error)
@@ -0,0 +1,71 @@
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+import base64
+import hashlib
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding
+from lxml import etree
+
+from odoo.addons.l10n_es_aeat.models import aeat_client, aeat_signature
+
+from .test_l10n_es_aeat_certificate import TestL10nEsAeatCertificateBase
+
+DS = "{%s}" % aeat_signature.DS_NS
+
+
+class TestL10nEsAeatSignature(TestL10nEsAeatCertificateBase):
+    def setUp(self):
+        super().setUp()
+        aeat_client.clear_client_cache()
+        self._activate_certificate()
+        self.credentials = self.env["l10n.es.aeat.certificate"].get_credentials(
+            self.sii_cert.company_id
+        )
+
+    def _assert_valid(self, signature, content):
+        root = etree.fromstring(signature)
+        certificate = x509.load_der_x509_certificate(
+            base64.b64decode(root.findtext(f".//{DS}X509Certificate"))
+        )
+        signed_info = root.find(f"{DS}SignedInfo")
+        certificate.public_key().verify(
+            base64.b64decode(root.findtext(f"{DS}SignatureValue")),
+            etree.tostring(signed_info, method="c14n", exclusive=True),
+            padding.PKCS1v15(),
+            hashes.SHA256(),
+        )
+        document, properties = signed_info.findall(f"{DS}Reference")
+        self.assertEqual(
+            document.findtext(f"{DS}DigestValue"),
+            base64.b64encode(hashlib.sha256(content).digest()).decode(),
+        )
+        signed_properties = root.find(
+            ".//{%s}SignedProperties" % aeat_signature.XADES_NS
+        )
+        self.assertEqual(properties.get("URI"), "#" + signed_properties.get("Id"))
+        self.assertEqual(
+            properties.findtext(f"{DS}DigestValue"),
+            base64.b64encode(
+                hashlib.sha256(
+                    etree.tostring(signed_properties, method="c14n", exclusive=True)
+                ).digest()
+            ).decode(),
+        )
+
+    def test_key_loaded_once(self):
+        key = aeat_signature.get_signing_key(self.credentials)
+        self.assertIs(aeat_signature.get_signing_key(self.credentials), key)
+        aeat_client.clear_client_cache()
+        self.assertIsNot(aeat_signature.get_signing_key(self.credentials), key)
+
+    def test_sign_detached(self):
+        documents = [
+            (f"urn:test:{number}", b"<Registro>%d</Registro>" % number)
+            for number in range(3)
+        ]
+        signatures = aeat_signature.sign_detached(self.credentials, documents)
+        self.assertEqual(len(signatures), 3)
+        for signature, (__, content) in zip(signatures, documents):
+            self._assert_valid(signature, content)
@@ -91,3 +91,12 @@ class TestL10nEsAeatTaxInfoGroup(TestL10nEsAeatModBase):
         self.assertEqual(tax_info[tax10]["amount"], -100)
         self.assertEqual(tax_info[tax21]["base"], -1000)
         self.assertEqual(tax_info[tax21]["amount"], -210)
+
+    def test_tax_infos_batch(self):
+        invoice = self._invoice_sale_create("2018-02-01", {})
+        refund = invoice._reverse_moves()
+        moves = invoice | refund
+        with self.assertQueryCount(10):
+            tax_infos = moves._get_aeat_tax_infos()
+        for move in moves:
+            self.assertEqual(tax_infos[move.id], move._get_aeat_tax_info())
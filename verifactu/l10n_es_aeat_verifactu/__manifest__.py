@@ -4,7 +4,7 @@
 
 {
     "name": "Comunicación Veri*FACTU",
-    "version": "18.0.1.0.0",
+    "version": "18.0.1.2.0",
     "category": "Accounting & Finance",
     "website": "https://github.com/sergiodeveloper5/verifactu",
     "author": "Aures Tic, ForgeFlow, Odoo Community Association (OCA)",
@@ -28,6 +28,9 @@
         "views/res_partner_view.xml",
         "views/account_journal_views.xml",
         "views/verifactu_queue_view.xml",
+        "views/verifactu_registry_view.xml",
+        "views/verifactu_event_view.xml",
+        "wizard/verifactu_registry_export_view.xml",
         "reports/verifactu_invoice_report.xml",
     ],
     "assets": {
@@ -0,0 +1,2 @@
+from . import backfill
+from . import export
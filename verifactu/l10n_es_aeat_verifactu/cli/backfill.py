@@ -0,0 +1,60 @@
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+"""Carga inicial en Veri*FACTU de las facturas ya publicadas.
+
+Uso::
+
+    odoo-bin verifactu_backfill -c odoo.conf -d base_de_datos [--company ID]
+
+Sin ``--company`` se tratan todas las compañías con Veri*FACTU habilitado.
+Cada bloque de facturas se confirma por separado, así que el comando puede
+interrumpirse y volver a lanzarse: continúa desde el último punto de control.
+"""
+import argparse
+import logging
+
+import odoo
+from odoo.cli import Command
+from odoo.tools import config
+
+from ..models.verifactu_queue import VERIFACTU_BACKFILL_CHUNK
+
+_logger = logging.getLogger(__name__)
+
+
+class VerifactuBackfill(Command):
+    """Registra en Veri*FACTU las facturas ya publicadas"""
+
+    name = "verifactu_backfill"
+
+    def run(self, cmdargs):
+        parser = argparse.ArgumentParser(
+            prog="odoo-bin verifactu_backfill",
+            description=__doc__.split("\n\n")[0],
+        )
+        parser.add_argument(
+            "--company",
+            type=int,
+            action="append",
+            dest="company_ids",
+            help="Compañía a registrar; se puede repetir",
+        )
+        parser.add_argument(
+            "--chunk-size", type=int, default=VERIFACTU_BACKFILL_CHUNK
+        )
+        args, odoo_args = parser.parse_known_args(cmdargs)
+        config.parse_config(odoo_args)
+        dbname = config["db_name"]
+        if not dbname:
+            parser.error("Se necesita la base de datos (-d)")
+        registry = odoo.registry(dbname)
+        with registry.cursor() as cr:
+            env = odoo.api.Environment(cr, odoo.SUPERUSER_ID, {})
+            companies = (
+                env["res.company"].browse(args.company_ids)
+                if args.company_ids
+                else env["res.company"].search([("verifactu_enabled", "=", True)])
+            )
+            total = env["verifactu.queue"].backfill_invoices(
+                companies, chunk_size=args.chunk_size, commit=True
+            )
+        _logger.info("Carga inicial Veri*FACTU: %s facturas encoladas", total)
@@ -0,0 +1,62 @@
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+"""Exportación del registro de facturación Veri*FACTU a un fichero.
+
+Uso::
+
+    odoo-bin verifactu_export -c odoo.conf -d base_de_datos --output fichero.xml.gz
+        [--company ID] [--date-from AAAA-MM-DD] [--date-to AAAA-MM-DD]
+        [--format xml|jsonl]
+
+Sin ``--company`` se exportan todas las compañías con Veri*FACTU habilitado.
+El fichero se escribe comprimido con gzip según se leen los registros.
+"""
+import argparse
+import logging
+
+import odoo
+from odoo.cli import Command
+from odoo.tools import config
+
+_logger = logging.getLogger(__name__)
+
+
+class VerifactuExport(Command):
+    """Exporta el registro de facturación Veri*FACTU"""
+
+    name = "verifactu_export"
+
+    def run(self, cmdargs):
+        parser = argparse.ArgumentParser(
+            prog="odoo-bin verifactu_export",
+            description=__doc__.split("\n\n")[0],
+        )
+        parser.add_argument("--output", required=True, help="Fichero de salida")
+        parser.add_argument(
+            "--company",
+            type=int,
+            action="append",
+            dest="company_ids",
+            help="Compañía a exportar; se puede repetir",
+        )
+        parser.add_argument("--date-from")
+        parser.add_argument("--date-to")
+        parser.add_argument("--format", choices=["xml", "jsonl"], default="xml")
+        args, odoo_args = parser.parse_known_args(cmdargs)
+        config.parse_config(odoo_args)
+        dbname = config["db_name"]
+        if not dbname:
+            parser.error("Se necesita la base de datos (-d)")
+        registry = odoo.registry(dbname)
+        with registry.cursor() as cr, open(args.output, "wb") as output:
+            env = odoo.api.Environment(cr, odoo.SUPERUSER_ID, {})
+            companies = (
+                env["res.company"].browse(args.company_ids)
+                if args.company_ids
+                else env["res.company"].search([("verifactu_enabled", "=", True)])
+            )
+            count = env["verifactu.registry"].export_records(
+                output, companies, args.date_from, args.date_to, args.format
+            )
+        _logger.info(
+            "Registro Veri*FACTU exportado: %s registros en %s", count, args.output
+        )
@@ -0,0 +1,33 @@
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
+
+from openupgradelib import openupgrade
+
+
+@openupgrade.migrate()
+def migrate(env, version):
+    """Fill the now stored ``verifactu_enabled`` of the moves with one
+    statement, instead of letting the ORM compute it move by move.
+    """
+    if openupgrade.column_exists(env.cr, "account_move", "verifactu_enabled"):
+        return
+    openupgrade.logged_query(
+        env.cr, "ALTER TABLE account_move ADD COLUMN verifactu_enabled boolean"
+    )
+    openupgrade.logged_query(
+        env.cr,
+        """
+        UPDATE account_move am
+        SET verifactu_enabled = TRUE
+        FROM res_company rc
+        WHERE rc.id = am.company_id
+            AND rc.verifactu_enabled
+            AND am.move_type IN ('out_invoice', 'out_refund', 'in_invoice', 'in_refund')
+            AND (
+                am.fiscal_position_id IS NULL
+                OR EXISTS (
+                    SELECT 1 FROM account_fiscal_position afp
+                    WHERE afp.id = am.fiscal_position_id AND afp.aeat_active
+                )
+            )
+        """,
+    )
@@ -0,0 +1,10 @@
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
+
+from openupgradelib import openupgrade
+
+
+@openupgrade.migrate()
+def migrate(env, version):
+    """Drop the pending invoices index that also covered vendor bills."""
+    # Recreated by account.move init() limited to customer invoices
+    env.cr.execute("DROP INDEX IF EXISTS account_move_verifactu_pending_index")
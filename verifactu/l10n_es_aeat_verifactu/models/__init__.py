@@ -6,3 +6,5 @@ from . import aeat_tax_agency
 from . import account_fiscal_position
 from . import res_partner
 from . import verifactu_queue
+from . import verifactu_registry
+from . import verifactu_event
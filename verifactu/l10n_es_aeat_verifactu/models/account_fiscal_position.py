@@ -3,6 +3,26 @@
 
 from odoo import fields, models
 
+VERIFACTU_REGIME_KEYS = [
+    ("01", "01 - Operación de régimen general"),
+    ("02", "02 - Exportación"),
+    ("03", "03 - Bienes usados, objetos de arte, antigüedades y colección"),
+    ("04", "04 - Oro de inversión"),
+    ("05", "05 - Agencias de viajes"),
+    ("06", "06 - Grupo de entidades en IVA (nivel avanzado)"),
+    ("07", "07 - Criterio de caja"),
+    ("08", "08 - Operaciones sujetas al IPSI / IGIC"),
+    ("09", "09 - Agencias de viajes que actúan como mediadoras"),
+    ("10", "10 - Cobros por cuenta de terceros"),
+    ("11", "11 - Arrendamiento de local de negocio"),
+    ("14", "14 - IVA pendiente en certificaciones de obra pública"),
+    ("15", "15 - IVA pendiente en operaciones de tracto sucesivo"),
+    ("17", "17 - Regímenes de ventanilla única (OSS / IOSS)"),
+    ("18", "18 - Recargo de equivalencia"),
+    ("19", "19 - Régimen especial de agricultura, ganadería y pesca"),
+    ("20", "20 - Régimen simplificado"),
+]
+
 
 class AccountFiscalPosition(models.Model):
     _inherit = "account.fiscal.position"
@@ -11,3 +31,10 @@ class AccountFiscalPosition(models.Model):
         related="company_id.verifactu_enabled",
         readonly=True,
     )
+    verifactu_regime_key = fields.Selection(
+        selection=VERIFACTU_REGIME_KEYS,
+        string="Clave de régimen Veri*FACTU",
+        help="ClaveRegimen declarada en el desglose de las facturas. Si se deja "
+        "vacía, se deduce de los impuestos: 02 en exportaciones, 18 con recargo "
+        "de equivalencia y 01 en el resto.",
+    )
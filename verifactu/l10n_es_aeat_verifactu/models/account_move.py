@@ -13,14 +13,39 @@ from odoo import _, api, fields, models
 from odoo.exceptions import UserError
 
 from .verifactu_mixin import VerifactuMixin
+from .verifactu_records import InvoiceId, Party, TaxDetail, to_amount
 
 VERIFACTU_VALID_INVOICE_STATES = ["posted"]
+# Partial index over the invoices still to be registered, so that looking
+# them up reads only the index and not the whole account_move table
+VERIFACTU_PENDING_INDEX = "account_move_verifactu_pending_index"
+VERIFACTU_PENDING_AEAT_STATES = ("not_sent",)
+# Only customer invoices are registered: vendor bills stay "not_sent"
+VERIFACTU_MOVE_TYPES = ("out_invoice", "out_refund")
+# Sales tax templates of l10n_es by the code they are declared with in the
+# breakdown: operation type (S2, N1, N2), exemption cause (E*) or equivalence
+# surcharge (RE). The taxes not listed are subject and not exempt (S1).
+VERIFACTU_TAX_CODES = {
+    "S2": ["s_iva0_isp"],
+    "N1": ["s_iva_ns"],
+    "N2": ["s_iva0_sp_i"],
+    "E1": ["s_iva_e"],
+    "E2": ["s_iva0_e"],
+    "E5": ["s_iva0_ic"],
+    "RE": ["s_req05", "s_req014", "s_req52", "s_req0175", "s_req026", "s_req062"],
+}
+VERIFACTU_NOT_SUBJECT_CODES = ("N1", "N2")
 
 
 class AccountMove(models.Model):
     _name = "account.move"
     _inherit = ["account.move", "verifactu.mixin"]
 
+    aeat_state = fields.Selection(
+        selection_add=[("error", "Error"), ("cancelled", "Cancelled")],
+        ondelete={"error": "set default", "cancelled": "set default"},
+    )
+    verifactu_enabled = fields.Boolean(store=True, readonly=True)
     verifactu_document_type = fields.Selection(
         selection=lambda self: self._get_verifactu_docuyment_types(),
         default="F1",
@@ -45,6 +70,12 @@ class AccountMove(models.Model):
         copy=False,
         help="Referencia única de Veri*FACTU para esta factura",
     )
+    verifactu_registry_ids = fields.One2many(
+        comodel_name="verifactu.registry",
+        inverse_name="invoice_id",
+        string="Registros Veri*FACTU",
+        readonly=True,
+    )
 
     def _get_verifactu_docuyment_types(self):
         return [
@@ -91,6 +122,52 @@ class AccountMove(models.Model):
             else:
                 invoice.verifactu_enabled = False
 
+    def init(self):
+        res = super().init()
+        self.env.cr.execute(
+            "SELECT indexname FROM pg_indexes WHERE indexname = %s",
+            [VERIFACTU_PENDING_INDEX],
+        )
+        if not self.env.cr.fetchone():
+            self.env.cr.execute(
+                f"""
+                CREATE INDEX {VERIFACTU_PENDING_INDEX}
+                ON account_move (company_id, id)
+                WHERE verifactu_enabled
+                AND move_type IN %s
+                AND state IN %s
+                AND aeat_state IN %s
+            """,
+                [
+                    VERIFACTU_MOVE_TYPES,
+                    tuple(VERIFACTU_VALID_INVOICE_STATES),
+                    VERIFACTU_PENDING_AEAT_STATES,
+                ],
+            )
+        return res
+
+    @api.model
+    def _get_verifactu_unregistered_domain(self):
+        """Invoices to be registered in veri*FACTU, matching the predicate of
+        the partial index ``VERIFACTU_PENDING_INDEX``.
+        """
+        return [
+            ("verifactu_enabled", "=", True),
+            ("move_type", "in", VERIFACTU_MOVE_TYPES),
+            ("state", "in", VERIFACTU_VALID_INVOICE_STATES),
+            ("aeat_state", "in", VERIFACTU_PENDING_AEAT_STATES),
+        ]
+
+    @api.model
+    def _get_verifactu_unregistered(self, companies=None, limit=None):
+        """Invoices still to be registered, ordered by id so that the lookup
+        is an index only scan of ``VERIFACTU_PENDING_INDEX``.
+        """
+        domain = self._get_verifactu_unregistered_domain()
+        if companies is not None:
+            domain += [("company_id", "in", companies.ids)]
+        return self.search(domain, order="id", limit=limit)
+
     def _get_document_date(self):
         """
         TODO: this method is the same in l10n_es_aeat_sii_oca, so I think that
@@ -119,6 +196,20 @@ class AccountMove(models.Model):
         """
         return self.move_type
 
+    def _prefetch_aeat_invoice_data(self):
+        """Load in a few queries what the payload builder reads per invoice:
+        company and customer with their countries, and the journal of the
+        third-party flag.
+        """
+        res = super()._prefetch_aeat_invoice_data()
+        self.mapped("company_id.partner_id.country_id")
+        self.mapped("commercial_partner_id.country_id")
+        self.mapped("fiscal_position_id")
+        self.mapped("journal_id")
+        self.mapped("reversed_entry_id")
+        self.mapped("invoice_line_ids.name")
+        return res
+
     def _get_valid_document_states(self):
         return VERIFACTU_VALID_INVOICE_STATES
 
@@ -139,10 +230,154 @@ class AccountMove(models.Model):
         return self.verifactu_document_type or "F1"
 
     def _get_verifactu_amount_tax(self):
-        return self.amount_tax
+        return self.amount_tax_signed
 
     def _get_verifactu_amount_total(self):
-        return self.amount_total
+        return self.amount_total_signed
+
+    @api.model
+    def _get_aeat_taxes_map(self, codes, date):
+        """Taxes of the company of ``self`` declared with any of ``codes`` of
+        ``VERIFACTU_TAX_CODES``.
+        """
+        templates = self.env["account.tax.template"]
+        for code in codes:
+            for name in VERIFACTU_TAX_CODES.get(code, []):
+                template = self.env.ref(
+                    f"l10n_es.account_tax_template_{name}", raise_if_not_found=False
+                )
+                if template:
+                    templates |= template
+        company = self.company_id or self.env.company
+        return company.get_taxes_from_templates(templates)
+
+    def _get_verifactu_tax_codes(self):
+        """{tax id: code} of the taxes of the company of ``self`` not
+        declared as S1.
+        """
+        date = self._get_document_fiscal_date()
+        return {
+            tax.id: code
+            for code in VERIFACTU_TAX_CODES
+            for tax in self._get_aeat_taxes_map([code], date)
+        }
+
+    def _get_verifactu_tax_details(self):
+        tax_infos = self._get_aeat_tax_infos()
+        tax_codes = {}
+        res = {}
+        for invoice in self:
+            company = invoice.company_id
+            if company not in tax_codes:
+                tax_codes[company] = invoice._get_verifactu_tax_codes()
+            res[invoice.id] = invoice._get_verifactu_invoice_tax_details(
+                tax_infos[invoice.id], tax_codes[company]
+            )
+        return res
+
+    def _get_verifactu_invoice_tax_details(self, tax_info, tax_codes):
+        """Breakdown of the invoice for its ``_get_aeat_tax_info`` entries.
+        Each equivalence surcharge is declared in the line of the subject
+        tax with its same base.
+        """
+        taxes = []
+        surcharges = []
+        for info in tax_info.values():
+            code = tax_codes.get(info["tax"].id, "S1")
+            if code == "RE":
+                surcharges.append(info)
+            else:
+                taxes.append([info, code, None])
+        for surcharge in surcharges:
+            subject = [item for item in taxes if item[1] == "S1" and not item[2]]
+            match = next(
+                (
+                    item
+                    for item in subject
+                    if to_amount(item[0]["base"]) == to_amount(surcharge["base"])
+                ),
+                subject and subject[0],
+            )
+            if match:
+                match[2] = surcharge
+        return [
+            self._get_verifactu_tax_detail(info, code, surcharge)
+            for info, code, surcharge in taxes
+        ]
+
+    def _get_verifactu_regime_key(self, code, surcharge=None):
+        """``ClaveRegimen`` of a line of the breakdown: the one of the fiscal
+        position, or else derived from the tax.
+        """
+        if self.fiscal_position_id.verifactu_regime_key:
+            return self.fiscal_position_id.verifactu_regime_key
+        if code == "E2":
+            return "02"
+        if surcharge:
+            return "18"
+        return "01"
+
+    def _get_verifactu_tax_detail(self, tax_info, code="S1", surcharge=None):
+        """Line of the breakdown for one entry of ``_get_aeat_tax_info``
+        declared with ``code``, and its equivalence ``surcharge`` entry.
+        """
+        regime_key = self._get_verifactu_regime_key(code, surcharge)
+        if code in VERIFACTU_NOT_SUBJECT_CODES:
+            return TaxDetail(
+                regime_key=regime_key, operation_type=code, base=tax_info["base"]
+            )
+        if code[:1] == "E":
+            return TaxDetail(
+                regime_key=regime_key, exemption=code, base=tax_info["base"]
+            )
+        return TaxDetail(
+            regime_key=regime_key,
+            operation_type=code,
+            tax_rate=tax_info["tax"].amount,
+            base=tax_info["base"],
+            fee=tax_info["amount"],
+            surcharge_rate=surcharge and surcharge["tax"].amount,
+            surcharge_fee=surcharge and surcharge["amount"],
+        )
+
+    def _get_verifactu_rectification_type(self):
+        # Refunds are sent by differences, with negative amounts
+        if self._get_verifactu_document_type()[:1] == "R":
+            return "I"
+        return False
+
+    def _get_verifactu_rectified_ids(self):
+        origin = self.reversed_entry_id
+        if not origin:
+            return []
+        return [
+            InvoiceId(
+                issuer_nif=self._get_verifactu_issuer(),
+                serial_number=origin._get_document_serial_number(),
+                date=origin._get_document_date(),
+            )
+        ]
+
+    def _get_verifactu_description(self):
+        return ", ".join(filter(None, self.invoice_line_ids.mapped("name"))) or "/"
+
+    def _get_verifactu_recipients(self):
+        if self._get_verifactu_document_type() in ("F2", "R5"):
+            return []
+        partner = self._aeat_get_partner()
+        country_code, identifier_type, identifier = partner._parse_aeat_vat_info()
+        if not identifier_type:
+            return [Party(name=partner.name, nif=identifier)]
+        if identifier_type == "02":
+            identifier = country_code + identifier
+        return [
+            Party(
+                name=partner.name,
+                country_code=country_code,
+                id_type=identifier_type,
+                identifier=identifier,
+            )
+        ]
 
     def _get_verifactu_previous_hash(self):
         # TODO store it? search it by some kind of sequence?
@@ -290,6 +525,21 @@ class AccountMove(models.Model):
             }
         }
     
+    def action_cancel_verifactu(self):
+        """Encola la anulación en Veri*FACTU de todas las facturas de ``self``"""
+        if not all(self.mapped("verifactu_enabled")):
+            raise UserError(_("Solo se pueden anular facturas con Veri*FACTU habilitado."))
+        items = self.env["verifactu.queue"].create_cancellation_items(self)
+        return {
+            "type": "ir.actions.client",
+            "tag": "display_notification",
+            "params": {
+                "title": _("Veri*FACTU"),
+                "message": _("%s anulaciones añadidas a la cola de envío.") % len(items),
+                "type": "success",
+            },
+        }
+
     def action_post(self):
         """Override para envío automático a Veri*FACTU"""
         result = super().action_post()
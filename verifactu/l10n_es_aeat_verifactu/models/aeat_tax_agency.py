@@ -1,6 +1,8 @@
 # Copyright 2024 Aures Tic - Jose Zambudio <jose@aurestic.es>
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
+import os
+
 from odoo import fields, models
 
 VERIFACTU_WDSL_MAPPING = {
@@ -8,9 +10,15 @@ VERIFACTU_WDSL_MAPPING = {
     "out_refund": "verifactu_wsdl_out",
 }
 VERIFACTU_PORT_NAME_MAPPING = {
-    "out_invoice": "SuministroInformacion",
-    "out_refund": "SuministroInformacion",
+    "out_invoice": "SistemaVerifactu",
+    "out_refund": "SistemaVerifactu",
 }
+VERIFACTU_SERVICE_NAME = "sfVerifactu"
+# WSDL and XSD published by the AEAT, bundled to avoid downloading and
+# parsing them from the network at runtime
+VERIFACTU_WSDL_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "wsdl"
+)
 
 
 class AeatTaxAgency(models.Model):
@@ -31,7 +39,18 @@ class AeatTaxAgency(models.Model):
             # If not test address is provides we try to get it using the port name.
             port_name += "Pruebas"
         return {
-            "wsdl": getattr(self, wsdl_field),
+            "wsdl": self._get_verifactu_local_wsdl(getattr(self, wsdl_field)),
             "address": address,
             "port_name": port_name,
         }
+
+    def _get_verifactu_local_wsdl(self, wsdl):
+        """Return the bundled copy of the given WSDL URL when there is one.
+
+        The XSD files it imports are resolved relative to it, so the whole
+        contract is loaded from disk without any network access.
+        """
+        if not wsdl:
+            return wsdl
+        local_wsdl = os.path.join(VERIFACTU_WSDL_PATH, wsdl.rsplit("/", 1)[-1])
+        return local_wsdl if os.path.isfile(local_wsdl) else wsdl
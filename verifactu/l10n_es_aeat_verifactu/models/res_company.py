@@ -9,3 +9,34 @@ class ResCompany(models.Model):
 
     verifactu_enabled = fields.Boolean(string="Enable veri*FACTU")
     verifactu_test = fields.Boolean(string="Is it the veri*FACTU test environment?")
+    verifactu_mode = fields.Selection(
+        selection=[
+            ("verifactu", "veri*FACTU"),
+            ("offline", "Non veri*FACTU"),
+        ],
+        string="veri*FACTU mode",
+        default="verifactu",
+        required=True,
+        help="In non veri*FACTU mode the records are not sent to the AEAT: "
+        "they are signed with the company certificate and kept in the registry.",
+    )
+    # Punto de control de la carga inicial de facturas ya publicadas
+    verifactu_backfill_move_id = fields.Many2one(
+        "account.move",
+        string="Última factura registrada en la carga inicial",
+        readonly=True,
+        copy=False,
+    )
+
+    def write(self, vals):
+        if "verifactu_mode" not in vals:
+            return super().write(vals)
+        changed = self.filtered(
+            lambda company: company.verifactu_mode != vals["verifactu_mode"]
+        )
+        res = super().write(vals)
+        # Inicio o fin del funcionamiento como sistema NO VERI*FACTU
+        event_type = "01" if vals["verifactu_mode"] == "offline" else "02"
+        for company in changed:
+            self.env["verifactu.event"].log_event(event_type, company=company)
+        return res
@@ -0,0 +1,264 @@
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+import logging
+from datetime import date
+from hashlib import sha256
+
+from dateutil.relativedelta import relativedelta
+
+from odoo import _, api, fields, models
+from odoo.exceptions import UserError
+
+_logger = logging.getLogger(__name__)
+
+# Clave de los eventos pendientes en ``cr.precommit.data``
+VERIFACTU_EVENT_BUFFER = 'verifactu.event.buffer'
+# Filas por sentencia INSERT al volcar los eventos
+VERIFACTU_EVENT_INSERT_BATCH = 1000
+# Meses por delante para los que se crean particiones
+VERIFACTU_EVENT_PARTITION_MONTHS = 2
+# Columnas escritas al volcar los eventos, en ese orden
+VERIFACTU_EVENT_COLUMNS = (
+    'company_id',
+    'sequence',
+    'event_type',
+    'event_date',
+    'user_id',
+    'issuer_nif',
+    'description',
+    'previous_hash',
+    'event_hash',
+)
+
+
+class VerifactuEvent(models.Model):
+    """Registro de eventos del sistema informático de facturación.
+
+    Cada evento se encadena con el anterior de su compañía mediante su
+    huella. Los eventos se acumulan en la transacción que los genera y se
+    vuelcan al confirmarla con un único INSERT de varias filas, así que
+    registrar un evento no cuesta ninguna consulta en el momento. La tabla
+    está particionada por mes de ``event_date``.
+    """
+
+    _name = "verifactu.event"
+    _description = "Evento del sistema Veri*FACTU"
+    _order = "event_date desc, id desc"
+    _rec_name = "event_type"
+    # Tabla particionada, creada en init()
+    _auto = False
+
+    company_id = fields.Many2one(
+        "res.company", string="Compañía", required=True, readonly=True
+    )
+    sequence = fields.Integer(
+        string="Posición en la cadena", required=True, readonly=True
+    )
+    event_type = fields.Selection([
+        ('01', 'Inicio del funcionamiento'),
+        ('02', 'Fin del funcionamiento'),
+        ('03', 'Detección de anomalías en registros de facturación'),
+        ('04', 'Anomalía en registros de facturación'),
+        ('05', 'Detección de anomalías en registros de evento'),
+        ('06', 'Anomalía en registros de evento'),
+        ('07', 'Restauración de copia de seguridad'),
+        ('08', 'Exportación de registros de facturación'),
+        ('09', 'Exportación de registros de evento'),
+        ('10', 'Resumen de eventos'),
+        ('90', 'Otros'),
+    ], string="Tipo de evento", required=True, readonly=True)
+    event_date = fields.Datetime(string="Fecha", required=True, readonly=True)
+    user_id = fields.Many2one("res.users", string="Usuario", readonly=True)
+    issuer_nif = fields.Char(string="NIF emisor", readonly=True)
+    description = fields.Char(string="Descripción", readonly=True)
+    previous_hash = fields.Char(string="Huella anterior", readonly=True)
+    event_hash = fields.Char(string="Huella", required=True, readonly=True)
+
+    def init(self):
+        cr = self.env.cr
+        cr.execute("""
+            CREATE TABLE IF NOT EXISTS verifactu_event (
+                id SERIAL,
+                company_id INTEGER NOT NULL REFERENCES res_company(id),
+                sequence INTEGER NOT NULL,
+                event_type VARCHAR NOT NULL,
+                event_date TIMESTAMP NOT NULL,
+                user_id INTEGER,
+                issuer_nif VARCHAR,
+                description VARCHAR,
+                previous_hash VARCHAR,
+                event_hash VARCHAR NOT NULL,
+                PRIMARY KEY (id, event_date)
+            ) PARTITION BY RANGE (event_date)
+        """)
+        cr.execute("""
+            CREATE INDEX IF NOT EXISTS verifactu_event_company_sequence_index
+            ON verifactu_event (company_id, sequence)
+        """)
+        # Red de seguridad para fechas sin partición propia
+        cr.execute("""
+            CREATE TABLE IF NOT EXISTS verifactu_event_default
+            PARTITION OF verifactu_event DEFAULT
+        """)
+        self._create_partitions()
+
+    @api.model
+    def _create_partitions(self, months=VERIFACTU_EVENT_PARTITION_MONTHS):
+        """Crea las particiones del mes en curso y de los ``months``
+        siguientes que aún no existen.
+        """
+        start = date.today().replace(day=1)
+        for __ in range(months + 1):
+            end = start + relativedelta(months=1)
+            name = f"verifactu_event_{start:%Y_%m}"
+            try:
+                with self.env.cr.savepoint():
+                    self.env.cr.execute(
+                        f"""
+                        CREATE TABLE IF NOT EXISTS {name}
+                        PARTITION OF verifactu_event
+                        FOR VALUES FROM (%s) TO (%s)
+                        """,
+                        [start, end],
+                    )
+            except Exception as e:
+                # La partición por defecto ya tiene eventos de ese mes
+                _logger.warning(
+                    f"No se ha podido crear la partición {name}: {str(e)}"
+                )
+            start = end
+
+    @api.model
+    def _cron_create_partitions(self):
+        self._create_partitions()
+
+    def write(self, vals):
+        raise UserError(_("Los eventos Veri*FACTU no se pueden modificar."))
+
+    def unlink(self):
+        raise UserError(_("Los eventos Veri*FACTU no se pueden eliminar."))
+
+    @api.model
+    def log_event(self, event_type, description=None, company=None):
+        """Añade un evento a los pendientes de la transacción en curso.
+
+        No hace ninguna consulta: los eventos se encadenan y se insertan al
+        confirmar la transacción, y se descartan si se deshace.
+        """
+        company = company or self.env.company
+        data = self.env.cr.precommit.data
+        buffer = data.get(VERIFACTU_EVENT_BUFFER)
+        if buffer is None:
+            buffer = data[VERIFACTU_EVENT_BUFFER] = []
+            self.env.cr.precommit.add(self._flush_events)
+        buffer.append({
+            'company_id': company.id,
+            'event_type': event_type,
+            'event_date': fields.Datetime.now(),
+            'user_id': self.env.uid,
+            'issuer_nif': company.vat,
+            'description': description and description[:255],
+        })
+
+    @api.model
+    def _flush_events(self):
+        """Encadena e inserta los eventos pendientes de la transacción.
+
+        La cadena de cada compañía se bloquea con un bloqueo consultivo hasta
+        el final de la transacción, que ya está terminando, y no con el de
+        su fila, para no competir con el encadenamiento de las facturas.
+        """
+        buffer = self.env.cr.precommit.data.pop(VERIFACTU_EVENT_BUFFER, None)
+        if not buffer:
+            return
+        cr = self.env.cr
+        company_ids = sorted({event['company_id'] for event in buffer})
+        for company_id in company_ids:
+            cr.execute(
+                "SELECT pg_advisory_xact_lock(hashtext(%s), %s)",
+                [self._name, company_id],
+            )
+        cr.execute(
+            """
+            SELECT DISTINCT ON (company_id) company_id, sequence, event_hash
+            FROM verifactu_event
+            WHERE company_id IN %s
+            ORDER BY company_id, sequence DESC
+            """,
+            [tuple(company_ids)],
+        )
+        heads = {company_id: (sequence, event_hash)
+                 for company_id, sequence, event_hash in cr.fetchall()}
+        rows = []
+        for event in buffer:
+            sequence, previous_hash = heads.get(event['company_id'], (0, None))
+            event = dict(
+                event, sequence=sequence + 1, previous_hash=previous_hash
+            )
+            event['event_hash'] = self._compute_event_hash(event)
+            heads[event['company_id']] = (event['sequence'], event['event_hash'])
+            rows.append(tuple(event[column] for column in VERIFACTU_EVENT_COLUMNS))
+        query = "INSERT INTO verifactu_event (%s) VALUES " % ", ".join(
+            VERIFACTU_EVENT_COLUMNS
+        )
+        for start in range(0, len(rows), VERIFACTU_EVENT_INSERT_BATCH):
+            batch = rows[start:start + VERIFACTU_EVENT_INSERT_BATCH]
+            cr.execute(query + ", ".join(["%s"] * len(batch)), batch)
+
+    @api.model
+    def _compute_event_hash(self, event):
+        """Huella de ``event``, dict con los valores de sus columnas"""
+        hash_string = "&".join(f"{name}={value or ''}" for name, value in (
+            ('IDEmisor', event['issuer_nif']),
+            ('Secuencia', event['sequence']),
+            ('TipoEvento', event['event_type']),
+            ('Descripcion', event['description']),
+            ('HuellaEventoAnterior', event['previous_hash']),
+            ('FechaHoraGenEvento', fields.Datetime.to_string(event['event_date'])),
+        ))
+        return sha256(hash_string.encode('utf-8')).hexdigest().upper()
+
+    @api.model
+    def check_integrity(self, company):
+        """Recalcula la cadena de eventos de ``company`` y registra la
+        comprobación y, si la hay, la primera anomalía encontrada.
+
+        :return: primer evento cuya huella o enlace no coincide, o vacío
+        """
+        self.log_event('05', company=company)
+        cursor = self.env.cr._cnx.cursor('verifactu_event_integrity')
+        cursor.itersize = VERIFACTU_EVENT_INSERT_BATCH
+        broken = self.browse()
+        previous_hash = None
+        try:
+            cursor.execute(
+                """
+                SELECT id, issuer_nif, sequence, event_type, description,
+                    previous_hash, event_date, event_hash
+                FROM verifactu_event
+                WHERE company_id = %s
+                ORDER BY sequence
+                """,
+                [company.id],
+            )
+            for row in cursor:
+                event = dict(zip((
+                    'id', 'issuer_nif', 'sequence', 'event_type', 'description',
+                    'previous_hash', 'event_date', 'event_hash',
+                ), row))
+                if (
+                    event['previous_hash'] != previous_hash
+                    or event['event_hash'] != self._compute_event_hash(event)
+                ):
+                    broken = self.browse(event['id'])
+                    break
+                previous_hash = event['event_hash']
+        finally:
+            cursor.close()
+        if broken:
+            self.log_event(
+                '06',
+                _("Cadena de eventos rota en la posición %s") % broken.sequence,
+                company=company,
+            )
+        return broken
@@ -4,13 +4,25 @@
 
 from hashlib import sha256
 
-from odoo import _, api, fields, models
+import pytz
+
+from odoo import _, api, fields, models, release
 from odoo.exceptions import UserError
 
-from odoo.addons.l10n_es_aeat.models.aeat_mixin import round_by_keys
+from .aeat_tax_agency import VERIFACTU_SERVICE_NAME
+from .verifactu_records import (
+    VERIFACTU_VERSION,
+    CancellationRecord,
+    Chaining,
+    ComputerSystem,
+    InvoiceId,
+    RegistrationRecord,
+)
 
-VERIFACTU_VERSION = "0.12.2"
 VERIFACTU_DATE_FORMAT = "%d-%m-%Y"
+VERIFACTU_MAPPING_KEYS_OUT = ("out_invoice", "out_refund")
+VERIFACTU_SYSTEM_NAME = "Odoo"
+VERIFACTU_SYSTEM_ID = "OD"
 
 
 class VerifactuMixin(models.AbstractModel):
@@ -39,6 +51,13 @@ class VerifactuMixin(models.AbstractModel):
             agency = self.env.ref("l10n_es_aeat.aeat_tax_agency_spain")
         return agency._connect_params_verifactu(mapping_key, self.company_id)
 
+    def _bind_service(self, client, port_name, address=None):
+        self.ensure_one()
+        service = client._get_service(VERIFACTU_SERVICE_NAME)
+        port = client._get_port(service, port_name)
+        address = address or port.binding_options["address"]
+        return client.create_service(port.binding.name, address)
+
     def _get_aeat_header(self, tipo_comunicacion=False, cancellation=False):
         """Builds VERIFACTU send header
 
@@ -53,7 +72,6 @@ class VerifactuMixin(models.AbstractModel):
                 _("No VAT configured for the company '{}'").format(self.company_id.name)
             )
         header = {
-            "IDVersion": VERIFACTU_VERSION,
             "ObligadoEmision": {
                 "NombreRazon": self.company_id.name[0:120],
                 "NIF": self.company_id.partner_id._parse_aeat_vat_info()[2],
@@ -65,32 +83,149 @@ class VerifactuMixin(models.AbstractModel):
         #     header.update({"TipoComunicacion": tipo_comunicacion})
         return header
 
+    def _get_aeat_query_header(self):
+        """Builds the header of ConsultaFactuSistemaFacturacion, which unlike
+        the registration one carries the version.
+        """
+        return dict(self._get_aeat_header(), IDVersion=VERIFACTU_VERSION)
+
     def _get_aeat_invoice_dict(self):
         self.ensure_one()
-        inv_dict = {}
-        mapping_key = self._get_mapping_key()
-        if mapping_key in ["out_invoice", "out_refund"]:
-            inv_dict = self._get_aeat_invoice_dict_out()
-        else:
+        return self._get_aeat_invoice_dicts()[self.id]
+
+    def _get_aeat_invoice_dicts(self):
+        """SOAP structure of the registration records of the recordset"""
+        return {
+            record_id: record.to_soap()
+            for record_id, record in self._get_verifactu_records().items()
+        }
+
+    def _get_verifactu_records(self, cancel=False):
+        """Build the typed records of the whole recordset in one call.
+
+        Related records are loaded in batch first, and the issuer NIF and the
+        computer system, which are the same for all the documents of a
+        company, are computed once per company instead of once per document.
+
+        :param cancel: build ``CancellationRecord`` instead of
+          ``RegistrationRecord``.
+        :return: dict {record id: record}
+        """
+        if any(
+            record._get_mapping_key() not in VERIFACTU_MAPPING_KEYS_OUT
+            for record in self
+        ):
             raise NotImplementedError
-        round_by_keys(
-            inv_dict,
-            [
-                "BaseImponible",
-                "CuotaRepercutida",
-                "CuotaSoportada",
-                "TipoRecargoEquivalencia",
-                "CuotaRecargoEquivalencia",
-                "ImportePorArticulos7_14_Otros",
-                "ImporteTAIReglasLocalizacion",
-                "ImporteTotal",
-                "BaseRectificada",
-                "CuotaRectificada",
-                "CuotaDeducible",
-                "ImporteCompensacionREAGYP",
-            ],
+        self._prefetch_aeat_invoice_data()
+        companies = self.mapped("company_id")
+        issuer_nifs = {
+            company: company.partner_id._parse_aeat_vat_info()[2]
+            for company in companies
+        }
+        systems = {
+            company: self._get_verifactu_computer_system(company)
+            for company in companies
+        }
+        tax_details = {} if cancel else self._get_verifactu_tax_details()
+        res = {}
+        for record in self:
+            company = record.company_id
+            invoice_id = InvoiceId(
+                issuer_nif=issuer_nifs[company],
+                serial_number=record._get_document_serial_number(),
+                date=record._get_document_date(),
+            )
+            if cancel:
+                res[record.id] = record._get_verifactu_cancellation_record(
+                    invoice_id, systems[company]
+                )
+            else:
+                res[record.id] = record._get_verifactu_registration_record(
+                    invoice_id, systems[company], tax_details[record.id]
+                )
+        return res
+
+    def _get_verifactu_registration_record(self, invoice_id, system, details):
+        self.ensure_one()
+        return RegistrationRecord(
+            invoice_id=invoice_id,
+            issuer_name=self.company_id.name,
+            invoice_type=self._get_verifactu_document_type(),
+            rectification_type=self._get_verifactu_rectification_type(),
+            rectified_ids=self._get_verifactu_rectified_ids(),
+            description=self._get_verifactu_description(),
+            recipients=self._get_verifactu_recipients(),
+            details=details,
+            total_fee=self._get_verifactu_amount_tax(),
+            total_amount=self._get_verifactu_amount_total(),
+            chaining=self._get_verifactu_chaining(),
+            system=system,
+            generated_at=self._get_verifactu_registration_date(),
+            hash=self.verifactu_hash,
+        )
+
+    def _get_verifactu_cancellation_record(self, invoice_id, system):
+        self.ensure_one()
+        record = CancellationRecord(
+            invoice_id=invoice_id,
+            chaining=self._get_verifactu_chaining(),
+            system=system,
+            generated_at=pytz.utc.localize(fields.Datetime.now()).isoformat(),
+        )
+        record.hash = record.compute_hash()
+        return record
+
+    def _get_verifactu_tax_details(self):
+        """``TaxDetail`` lists of the recordset, keyed by record id"""
+        raise NotImplementedError
+
+    @api.model
+    def _get_verifactu_computer_system(self, company):
+        """``SistemaInformatico`` of the records of ``company``"""
+        return ComputerSystem(
+            name=company.name,
+            nif=company.partner_id._parse_aeat_vat_info()[2],
+            system_name=VERIFACTU_SYSTEM_NAME,
+            system_id=VERIFACTU_SYSTEM_ID,
+            version=release.version,
+            installation_number=self.env["ir.config_parameter"]
+            .sudo()
+            .get_param("database.uuid"),
+        )
+
+    def _get_verifactu_chaining(self):
+        """Previous record of the chain. The queue links the records it
+        creates (see ``verifactu.queue._create_chained_items``), so the
+        records built outside of it are sent as the first one.
+        """
+        return Chaining()
+
+    def _get_verifactu_rectification_type(self):
+        return False
+
+    def _get_verifactu_rectified_ids(self):
+        return []
+
+    def _get_verifactu_description(self):
+        return "/"
+
+    def _get_verifactu_recipients(self):
+        return []
+
+    def _get_verifactu_census_rejected(self):
+        """Documents of ``self`` whose recipient NIF and name are known not
+        to be identified in the AEAT census, so their records would be
+        rejected. Recipients never checked are queued for the census job.
+        """
+        with_recipients = self.filtered(
+            lambda document: document._get_verifactu_recipients()
+        )
+        invalid = self.env["l10n.es.aeat.nif.validation"]._get_invalid_partners(
+            with_recipients.mapped(lambda document: document._aeat_get_partner())
+        )
+        return with_recipients.filtered(
+            lambda document: document._aeat_get_partner() in invalid
         )
-        return inv_dict
 
     def _get_aeat_invoice_dict_out(self, cancel=False):
         """Build dict with data to send to AEAT WS for document types:
@@ -101,25 +236,7 @@ class VerifactuMixin(models.AbstractModel):
         :return: documents (dict) : Dict XML with data for this document.
         """
         self.ensure_one()
-        document_date = self._change_date_format(self._get_document_date())
-        company = self.company_id
-        fiscal_year = self._get_document_fiscal_year()
-        period = self._get_document_period()
-        serial_number = self._get_document_serial_number()
-        inv_dict = {
-            "IDFactura": {
-                "IDEmisorFactura": {
-                    "NIF": company.partner_id._parse_aeat_vat_info()[2]
-                },
-                "NumSerieFactura": serial_number,
-                "FechaExpedicionFactura": document_date,
-            },
-            "PeriodoLiquidacion": {
-                "Ejercicio": fiscal_year,
-                "Periodo": period,
-            },
-        }
-        return inv_dict
+        return self._get_verifactu_records(cancel=cancel)[self.id].to_soap()
 
     def _aeat_check_exceptions(self):
         """Inheritable method for exceptions control when sending veri*FACTU invoices."""
@@ -2,13 +2,65 @@
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
 import logging
+import os
+from collections import defaultdict
 from datetime import datetime, timedelta
 
+import pytz
+from requests.exceptions import ChunkedEncodingError, ReadTimeout
+
 from odoo import _, api, fields, models
 from odoo.exceptions import UserError
+from odoo.tools import split_every
+
+from odoo.addons.l10n_es_aeat.models.aeat_client import (
+    AEAT_ASYNC_CONCURRENCY,
+    run_async_calls,
+)
+from odoo.addons.l10n_es_aeat.models.aeat_envelope import (
+    get_envelope_template,
+    get_xml_schema,
+    send_envelope,
+    send_envelope_stream,
+    validate_request,
+)
+from odoo.addons.l10n_es_aeat.models.aeat_metrics import capture_calls
+
+from .aeat_tax_agency import VERIFACTU_WSDL_PATH
+
+from .verifactu_records import Chaining
 
 _logger = logging.getLogger(__name__)
 
+# Errores producidos cuando la petición ya ha salido hacia AEAT: el envío puede
+# haberse registrado, así que no se reintenta sino que se concilia consultando.
+VERIFACTU_UNKNOWN_OUTCOME_ERRORS = (ReadTimeout, ChunkedEncodingError)
+
+try:
+    import httpx
+
+    VERIFACTU_UNKNOWN_OUTCOME_ERRORS += (httpx.ReadTimeout, httpx.RemoteProtocolError)
+except (ImportError, IOError) as err:
+    _logger.debug(err)
+
+# Esquema de la petición RegFactuSistemaFacturacion
+VERIFACTU_REQUEST_XSD = os.path.join(VERIFACTU_WSDL_PATH, 'SuministroLR.xsd')
+
+# Facturas por bloque de la carga inicial
+VERIFACTU_BACKFILL_CHUNK = 500
+
+# Registros que se construyen a la vez en el envío en streaming
+VERIFACTU_STREAM_CHUNK = 500
+
+# Registros admitidos por AEAT en un envío RegFactuSistemaFacturacion
+VERIFACTU_MAX_BATCH_SIZE = 1000
+
+# Valor de Operacion.TipoOperacion en las respuestas de AEAT
+VERIFACTU_OPERATIONS = {
+    'alta': 'Alta',
+    'anulacion': 'Anulacion',
+}
+
 
 class VerifactuQueue(models.Model):
     """Cola de envío para Veri*FACTU"""
@@ -28,9 +80,35 @@ class VerifactuQueue(models.Model):
         ('pending', 'Pendiente'),
         ('processing', 'Procesando'),
         ('sent', 'Enviado'),
+        ('unknown', 'Sin confirmar'),
         ('error', 'Error'),
         ('cancelled', 'Cancelado'),
+        ('local', 'Conservado localmente'),
     ], string="Estado", default='pending', required=True)
+    operation = fields.Selection([
+        ('alta', 'Alta'),
+        ('anulacion', 'Anulación'),
+    ], string="Operación", default='alta', required=True)
+
+    # Encadenamiento: cada registro generado enlaza con el anterior del emisor
+    registry_id = fields.Many2one(
+        "verifactu.registry",
+        string="Registro de facturación",
+        readonly=True,
+        copy=False,
+        index=True,
+        ondelete="restrict",
+    )
+    record_sequence = fields.Integer(
+        related="registry_id.sequence", store=True, string="Posición en la cadena"
+    )
+    record_date = fields.Char(
+        related="registry_id.record_date",
+        string="Fecha de generación del registro",
+    )
+    record_hash = fields.Char(
+        related="registry_id.record_hash", store=True, string="Huella"
+    )
     
     priority = fields.Integer(string="Prioridad", default=10)
     retry_count = fields.Integer(string="Intentos", default=0)
@@ -62,18 +140,195 @@ class VerifactuQueue(models.Model):
         # Verificar si ya existe en cola
         existing = self.search([
             ('invoice_id', '=', invoice_id),
-            ('state', 'in', ['pending', 'processing'])
+            ('operation', '=', 'alta'),
+            ('state', 'in', ['pending', 'processing', 'unknown', 'local'])
         ])
         if existing:
             return existing[0]
-        
-        return self.create({
-            'name': f"Envío Veri*FACTU - {invoice.name}",
-            'invoice_id': invoice_id,
-            'priority': priority,
-            'company_id': invoice.company_id.id,
-        })
-    
+
+        return self._create_chained_items(invoice, 'alta', priority)
+
+    @api.model
+    def create_cancellation_items(self, invoices, priority=10):
+        """Encola la anulación de ``invoices`` en una sola operación.
+
+        Los registros de anulación se encadenan a continuación del último
+        registro de cada emisor y se envían en los mismos lotes que las
+        altas. Se omiten las facturas cuya anulación ya está en cola o
+        enviada.
+
+        :return: elementos de la cola creados
+        """
+        registered = self.env['verifactu.registry'].search([
+            ('invoice_id', 'in', invoices.ids),
+            ('operation', '=', 'alta'),
+        ]).mapped('invoice_id')
+        not_registered = invoices - registered
+        if not_registered:
+            raise UserError(
+                _("Las siguientes facturas no tienen registro Veri*FACTU: %s")
+                % ", ".join(not_registered.mapped('name'))
+            )
+        cancelled = self.search([
+            ('invoice_id', 'in', invoices.ids),
+            ('operation', '=', 'anulacion'),
+            ('state', 'in', ['pending', 'processing', 'unknown', 'sent', 'local']),
+        ]).mapped('invoice_id')
+        return self._create_chained_items(invoices - cancelled, 'anulacion', priority)
+
+    @api.model
+    def _create_chained_items(self, invoices, operation, priority=10):
+        """Genera los registros de ``invoices`` y los añade a la cadena de su
+        emisor, creando una fila del registro de facturación y un elemento de
+        cola por factura.
+
+        La huella de cada registro incluye la del anterior, así que la cadena
+        de cada compañía se bloquea hasta el final de la transacción para que
+        dos procesos no enlacen registros con el mismo predecesor. El bloqueo
+        es consultivo y no el de la fila de la compañía, que haría esperar a
+        toda escritura que la referencie (apuntes, empresas, adjuntos...).
+
+        En el modo NO VERI*FACTU los registros se firman en bloque y los
+        elementos de cola quedan conservados localmente, sin enviarse.
+        """
+        items = self.browse()
+        if not invoices:
+            return items
+        companies = invoices.mapped('company_id')
+        # En orden de id, como verifactu.event, para no bloquearse entre sí
+        for company_id in sorted(companies.ids):
+            self.env.cr.execute(
+                "SELECT pg_advisory_xact_lock(hashtext(%s), %s)",
+                ['verifactu.registry', company_id],
+            )
+        registry_obj = self.env['verifactu.registry']
+        records = invoices._get_verifactu_records(cancel=operation == 'anulacion')
+        generated_at = pytz.utc.localize(fields.Datetime.now()).isoformat()
+        registry_vals_list = []
+        vals_list = []
+        for company in companies:
+            head = registry_obj._get_chain_head(company)
+            chaining = head._get_next_chaining()
+            sequence = head.sequence
+            company_invoices = invoices.filtered(lambda inv: inv.company_id == company)
+            offline = company.verifactu_mode == 'offline'
+            for invoice in company_invoices:
+                record = records[invoice.id]
+                record.chaining = chaining
+                record.generated_at = generated_at
+                record.hash = record.compute_hash()
+                sequence += 1
+                registry_vals_list.append(
+                    registry_obj._prepare_vals(invoice, operation, sequence, record)
+                )
+                vals_list.append({
+                    'name': (
+                        f"Anulación Veri*FACTU - {invoice.name}"
+                        if operation == 'anulacion'
+                        else f"Envío Veri*FACTU - {invoice.name}"
+                    ),
+                    'invoice_id': invoice.id,
+                    'operation': operation,
+                    'priority': priority,
+                    'company_id': company.id,
+                    'state': 'local' if offline else 'pending',
+                })
+                chaining = Chaining(
+                    previous_id=record.invoice_id, previous_hash=record.hash
+                )
+            if offline:
+                signatures = registry_obj._sign_records(
+                    company_invoices,
+                    [records[invoice.id] for invoice in company_invoices],
+                )
+                for vals, signature in zip(
+                    registry_vals_list[-len(company_invoices):], signatures
+                ):
+                    vals['signature'] = signature
+        for vals, registry in zip(vals_list, registry_obj.create(registry_vals_list)):
+            vals['registry_id'] = registry.id
+        return self.create(vals_list)
+
+    @api.model
+    def backfill_invoices(self, companies, chunk_size=VERIFACTU_BACKFILL_CHUNK,
+                          commit=False):
+        """Registra en bloque las facturas ya publicadas de ``companies`` que
+        aún no tienen registro Veri*FACTU, p. ej. al activarlo a mitad de año.
+
+        Las facturas de cada emisor se recorren por fecha y número en bloques
+        de ``chunk_size``. Cada bloque se encadena, congela sus huellas y crea
+        sus elementos de cola de una vez, y guarda en la compañía su última
+        factura como punto de control. Con ``commit`` cada bloque se confirma
+        por separado, así que un proceso interrumpido sigue desde el último
+        punto de control sin repetir ni saltar facturas.
+
+        :return: número de facturas encoladas
+        """
+        total = 0
+        for company in companies:
+            while True:
+                invoices = self._get_backfill_chunk(company, chunk_size)
+                if not invoices:
+                    break
+                registered = self.env['verifactu.registry'].search([
+                    ('invoice_id', 'in', invoices.ids),
+                    ('operation', '=', 'alta'),
+                ]).mapped('invoice_id')
+                pending = invoices - registered
+                items = self._create_chained_items(pending, 'alta')
+                self._write_invoice_hashes(items)
+                company.verifactu_backfill_move_id = invoices[-1]
+                total += len(pending)
+                if commit:
+                    self.env.cr.commit()
+                _logger.info(
+                    "Carga inicial Veri*FACTU de %s: %s facturas encoladas hasta %s",
+                    company.name, total, invoices[-1].name,
+                )
+                self.env.invalidate_all()
+        return total
+
+    @api.model
+    def _write_invoice_hashes(self, items):
+        """Copia en las facturas sin huella la de su registro encadenado, en
+        una sola sentencia en lugar de calcularla y generar su QR una a una.
+        """
+        if not items:
+            return
+        move_obj = self.env['account.move']
+        move_obj.flush_model(['verifactu_hash'])
+        self.env.cr.execute(
+            """
+            UPDATE account_move AS move
+               SET verifactu_hash = registry.record_hash
+              FROM verifactu_registry AS registry
+             WHERE registry.invoice_id = move.id
+               AND registry.id IN %s
+               AND move.verifactu_hash IS NULL
+            """,
+            [tuple(items.mapped('registry_id').ids)],
+        )
+        items.mapped('invoice_id').invalidate_recordset(['verifactu_hash'])
+
+    @api.model
+    def _get_backfill_chunk(self, company, chunk_size):
+        """Siguientes facturas de ``company`` por registrar tras su punto de
+        control, en orden de fecha y número.
+        """
+        move_obj = self.env['account.move']
+        domain = move_obj._get_verifactu_unregistered_domain() + [
+            ('company_id', '=', company.id),
+        ]
+        last = company.verifactu_backfill_move_id
+        if last:
+            domain += [
+                '|', ('invoice_date', '>', last.invoice_date),
+                '&', ('invoice_date', '=', last.invoice_date),
+                '|', ('name', '>', last.name),
+                '&', ('name', '=', last.name), ('id', '>', last.id),
+            ]
+        return move_obj.search(domain, order='invoice_date, name, id', limit=chunk_size)
+
     def process_queue_item(self):
         """Procesa un elemento de la cola"""
         self.ensure_one()
@@ -82,91 +337,777 @@ class VerifactuQueue(models.Model):
             return False
         
         self.state = 'processing'
-        
-        try:
-            # Procesar envío
-            result = self._send_to_verifactu()
-            
-            if result.get('success'):
-                self.write({
-                    'state': 'sent',
-                    'processed_date': fields.Datetime.now(),
-                    'response_data': result.get('response', ''),
-                })
-                
-                # Actualizar factura
-                self.invoice_id.write({
-                    'aeat_state': 'sent',
-                    'aeat_send_failed': False,
-                    'aeat_send_error': False,
-                })
-                
-            else:
-                self._handle_error(result.get('error', 'Error desconocido'))
-                
-        except Exception as e:
-            _logger.error(f"Error procesando cola Veri*FACTU {self.id}: {str(e)}")
-            self._handle_error(str(e))
-        
+        self._send_batches()
         return True
-    
-    def _send_to_verifactu(self):
-        """Envía la factura a Veri*FACTU"""
-        # Aquí se implementaría la conexión real con AEAT
-        # Por ahora simulamos el envío
-        
-        invoice = self.invoice_id
-        
-        # Verificar que la factura tenga todos los datos necesarios
-        if not invoice.verifactu_hash:
-            invoice._compute_verifactu_hash()
-        
-        # Simular envío exitoso
-        return {
-            'success': True,
-            'response': f"Factura {invoice.name} enviada correctamente",
-            'reference': invoice.verifactu_reference,
-        }
-    
-    def _handle_error(self, error_message):
-        """Maneja errores en el procesamiento"""
-        self.retry_count += 1
-        
-        if self.retry_count >= self.max_retries:
-            self.write({
+
+    def _get_exception_result(self, error):
+        """Resultado de envío correspondiente a una excepción"""
+        if isinstance(error, VERIFACTU_UNKNOWN_OUTCOME_ERRORS):
+            _logger.warning(
+                f"Resultado desconocido en cola Veri*FACTU {self.ids}: {str(error)}"
+            )
+            return {'success': False, 'unknown': True, 'error': str(error)}
+        _logger.error(f"Error procesando cola Veri*FACTU {self.ids}: {str(error)}")
+        return {'success': False, 'error': str(error)}
+
+    def _get_send_result_vals(self, result, now):
+        """Valores a escribir en la cola y en la factura según el resultado.
+
+        :param result: dict devuelto por _parse_verifactu_response. Además de
+            ``success``, ``response`` y ``error`` admite ``aeat_state``
+            ('sent' o 'sent_w_errors'), ``unknown`` para envíos sin confirmar,
+            ``held`` y ``delay`` para registros retenidos detrás de otro no
+            válido y ``estado``, ``code`` y ``csv`` de la respuesta de AEAT.
+        :return: tupla (valores de la cola, valores de la factura o None)
+        """
+        self.ensure_one()
+        if result.get('unknown'):
+            return {'state': 'unknown', 'error_message': result.get('error')}, None
+
+        if result.get('success'):
+            error = result.get('error') or False
+            # Una anulación aceptada nunca deja la factura como enviada
+            default_state = 'cancelled' if self.operation == 'anulacion' else 'sent'
+            return {
+                'state': 'sent',
+                'processed_date': now,
+                'response_data': result.get('response', ''),
+            }, {
+                'aeat_state': result.get('aeat_state') or default_state,
+                'aeat_send_failed': False,
+                'aeat_send_error': error,
+            }
+
+        error_message = result.get('error', 'Error desconocido')
+        if result.get('held'):
+            # Sin envío no cuenta como intento
+            return {
+                'state': 'pending',
+                'scheduled_date': now + result['delay'],
+                'error_message': error_message,
+            }, None
+
+        retry_count = self.retry_count + 1
+        if retry_count >= self.max_retries:
+            return {
                 'state': 'error',
+                'retry_count': retry_count,
                 'error_message': error_message,
-                'processed_date': fields.Datetime.now(),
-            })
-            
-            # Actualizar factura
-            self.invoice_id.write({
+                'processed_date': now,
+            }, {
                 'aeat_state': 'error',
                 'aeat_send_failed': True,
                 'aeat_send_error': error_message,
-            })
-        else:
-            # Reprogramar para reintento
-            retry_delay = timedelta(minutes=5 * self.retry_count)
-            self.write({
-                'state': 'pending',
-                'scheduled_date': fields.Datetime.now() + retry_delay,
-                'error_message': error_message,
-            })
+            }
+
+        # Reprogramar para reintento
+        return {
+            'state': 'pending',
+            'retry_count': retry_count,
+            'scheduled_date': now + self._get_retry_delay(retry_count),
+            'error_message': error_message,
+        }, None
+
+    @api.model
+    def _get_retry_delay(self, retry_count):
+        """Espera antes del reintento número ``retry_count``"""
+        return timedelta(minutes=5 * retry_count)
+
+    @api.model
+    def _get_registry_result_vals(self, result, now):
+        """Respuesta de AEAT a guardar en el registro de facturación, o None
+        si el resultado no viene de AEAT.
+        """
+        if not result.get('estado'):
+            return None
+        return {
+            'aeat_state': result['estado'],
+            'aeat_code': result.get('code') and str(result['code']),
+            'aeat_csv': result.get('csv') or False,
+            'response_date': now,
+        }
+
+    def _apply_send_results(self, results):
+        """Aplica en bloque los resultados de un envío agrupados por desenlace.
+
+        Los elementos con el mismo desenlace (aceptados, aceptados con errores,
+        rechazos con el mismo error, reintentos con el mismo retraso...) se
+        escriben con una sola escritura por modelo, de modo que la respuesta
+        de un lote grande cuesta unas pocas sentencias y no una por factura.
+
+        :param results: dict {id del elemento: resultado de _get_send_result_vals}
+        """
+        now = fields.Datetime.now()
+        groups = defaultdict(lambda: self.browse())
+        for item in self:
+            result = results[item.id]
+            queue_vals, invoice_vals = item._get_send_result_vals(result, now)
+            registry_vals = self._get_registry_result_vals(result, now)
+            key = (
+                tuple(sorted(queue_vals.items())),
+                invoice_vals and tuple(sorted(invoice_vals.items())),
+                registry_vals and tuple(sorted(registry_vals.items())),
+            )
+            groups[key] |= item
+
+        for (queue_vals, invoice_vals, registry_vals), items in groups.items():
+            items.write(dict(queue_vals))
+            if invoice_vals:
+                items.mapped('invoice_id').write(dict(invoice_vals))
+            if registry_vals:
+                items.mapped('registry_id').write(dict(registry_vals))
+    
+    def _handle_error(self, error_message):
+        """Maneja errores en el procesamiento"""
+        self._apply_send_results(
+            {item.id: {'success': False, 'error': error_message} for item in self}
+        )
     
     @api.model
-    def process_pending_queue(self):
-        """Procesa elementos pendientes en la cola"""
-        pending_items = self.search([
-            ('state', '=', 'pending'),
-            ('scheduled_date', '<=', fields.Datetime.now()),
-        ], order='priority desc, scheduled_date asc', limit=10)
-        
-        for item in pending_items:
-            item.process_queue_item()
-        
-        return len(pending_items)
+    def process_pending_queue(self, commit=False):
+        """Vacía la cola de elementos pendientes.
+
+        En cada vuelta se toman de cada compañía hasta
+        ``l10n_es_aeat_verifactu.batch_size`` elementos en el orden de la
+        cadena (ver ``_get_pending_batch_items``) y se envían en un lote por
+        compañía. Las vueltas se repiten mientras quede algo por enviar. Con
+        ``commit`` cada vuelta se confirma por separado, así que lo ya
+        aceptado por AEAT no se pierde si falla una vuelta posterior.
+
+        :return: número de elementos procesados
+        """
+        batch_size = self._get_batch_size()
+        processed = self.browse()
+        while True:
+            pending_items = self._get_pending_batch_items(batch_size) - processed
+            if not pending_items:
+                break
+            processed |= pending_items
+            pending_items._process_pending_batch()
+            if commit:
+                self.env.cr.commit()
+        return len(processed)
+
+    @api.model
+    def _get_batch_size(self):
+        """Elementos por lote y compañía, sin pasar del límite de AEAT"""
+        batch_size = int(
+            self.env['ir.config_parameter'].sudo().get_param(
+                'l10n_es_aeat_verifactu.batch_size', VERIFACTU_MAX_BATCH_SIZE
+            )
+        )
+        return max(1, min(batch_size, VERIFACTU_MAX_BATCH_SIZE))
+
+    @api.model
+    def _get_pending_batch_items(self, batch_size):
+        """Siguientes elementos a enviar de cada compañía con algo pendiente.
+
+        Se leen los pendientes de cada cadena en su orden, hasta
+        ``batch_size`` o hasta el primero que aún no toca enviar: ningún
+        registro sale antes que el anterior de su cadena.
+        """
+        now = fields.Datetime.now()
+        self.flush_model(['state', 'scheduled_date', 'company_id'])
+        self.env.cr.execute(
+            """
+            SELECT DISTINCT company_id FROM verifactu_queue
+            WHERE state = 'pending' AND scheduled_date <= %s
+            ORDER BY company_id
+            """,
+            [now],
+        )
+        item_ids = []
+        for (company_id,) in self.env.cr.fetchall():
+            chain = self.search([
+                ('state', '=', 'pending'),
+                ('company_id', '=', company_id),
+            ], order='record_sequence asc, id asc', limit=batch_size)
+            for item in chain:
+                if item.scheduled_date and item.scheduled_date > now:
+                    break
+                item_ids.append(item.id)
+        return self.browse(item_ids)
+
+    def _process_pending_batch(self):
+        """Envía los elementos de ``self``, un lote por compañía"""
+        pending_items = self
+        pending_items.write({'state': 'processing'})
+        census_results = pending_items._get_census_rejected_results()
+        if census_results:
+            rejected = self.browse(list(census_results))
+            rejected._apply_send_results(census_results)
+            pending_items -= rejected
+        if self._is_async_send_enabled():
+            pending_items._send_batches_async()
+        else:
+            pending_items._send_batches()
+        for company in pending_items.mapped('company_id'):
+            self.env['verifactu.event'].log_event(
+                '90',
+                _("Cola procesada: %s envíos") % len(
+                    pending_items.filtered(lambda item: item.company_id == company)
+                ),
+                company=company,
+            )
+
+    def _get_census_rejected_results(self):
+        """Resultados de las altas cuyo destinatario no está identificado en
+        el censo de AEAT según la caché local: se dan por fallidas sin
+        enviarlas, y los registros que les siguen en la cadena se retienen
+        (ver ``_get_chain_break_results``). Siguen reintentándose, así que se
+        envían en cuanto se corrige el contacto; la huella no incluye al
+        destinatario, por lo que la cadena no cambia.
+
+        :return: dict {id del elemento: resultado}
+        """
+        altas = self.filtered(lambda item: item.operation == 'alta')
+        rejected = altas.mapped('invoice_id')._get_verifactu_census_rejected()
+        errors = {}
+        for item in altas.filtered(lambda item: item.invoice_id in rejected):
+            partner = item.invoice_id._aeat_get_partner()
+            errors[item.id] = _(
+                "El NIF %(nif)s y el nombre %(name)s del destinatario no "
+                "están identificados en el censo de AEAT"
+            ) % {'nif': partner.aeat_id_number, 'name': partner.name}
+        return self._get_chain_break_results(
+            errors,
+            _(
+                "Retenido hasta el envío del registro anterior de la cadena, "
+                "cuyo destinatario no está identificado en el censo de AEAT"
+            ),
+        )
+
+    @api.model
+    def _is_async_send_enabled(self):
+        """Modo de envío asíncrono: un lote por emisor, todos a la vez"""
+        return (
+            self.env['ir.config_parameter'].sudo().get_param(
+                'l10n_es_aeat_verifactu.async_send'
+            ) == 'True'
+        )
+
+    def _get_send_options(self):
+        """Opciones de envío de los lotes, de ``ir.config_parameter``"""
+        params = self.env['ir.config_parameter'].sudo()
+        return {
+            # Los sobres se escriben registro a registro en un fichero
+            # temporal, sin tener el lote completo en memoria
+            'stream': (
+                params.get_param('l10n_es_aeat_verifactu.stream_envelope') == 'True'
+            ),
+            # Los registros que no cumplen el XSD se retiran del lote antes
+            # del envío, con el error local, y el resto sale en el primer intento
+            'validate': (
+                params.get_param('l10n_es_aeat_verifactu.validate_schema', 'True')
+                == 'True'
+            ),
+            # Las plantillas precompiladas generan el mismo XML que zeep en una
+            # fracción del tiempo para lotes grandes
+            'template': (
+                params.get_param('l10n_es_aeat_verifactu.template_envelope') == 'True'
+            ),
+            'store_envelopes': (
+                params.get_param('l10n_es_aeat_verifactu.store_envelopes') == 'True'
+            ),
+        }
+
+    def _prepare_batches(self, stream=False, validate=True):
+        """Prepara un lote RegFactuSistemaFacturacion por compañía.
+
+        Los elementos cuyo lote no se puede preparar, o con registros que no
+        cumplen el XSD en una petición completa, se dan ya por fallidos.
+
+        :return: lista de tuplas (elementos, llamada, errores de esquema que
+            se completan durante el envío en streaming o None)
+        """
+        batches = []
+        for company in self.mapped('company_id'):
+            items = self.filtered(lambda item: item.company_id == company)
+            try:
+                schema_errors = {} if validate else None
+                call = items._get_verifactu_batch_call(
+                    lazy=stream, schema_errors=schema_errors
+                )
+                if not stream and schema_errors:
+                    invalid = items.browse(list(schema_errors))
+                    invalid._apply_send_results(
+                        invalid._get_schema_error_results(schema_errors)
+                    )
+                    items -= invalid
+                    if not items:
+                        continue
+                batches.append((items, call, schema_errors if stream else None))
+            except Exception as e:
+                result = items._get_exception_result(e)
+                items._apply_send_results({item.id: result for item in items})
+        return batches
+
+    def _apply_batch_response(self, response, schema_errors=None):
+        """Escribe el resultado de enviar el lote de ``self``: la respuesta
+        de AEAT o la excepción producida.
+        """
+        if isinstance(response, Exception):
+            result = self._get_exception_result(response)
+            results = {item.id: result for item in self}
+        else:
+            results = self._parse_verifactu_response(response)
+        if schema_errors:
+            # Registros retirados del sobre según se escribía
+            results.update(self._get_schema_error_results(schema_errors))
+        self._apply_send_results(results)
+
+    @api.model
+    def _send_verifactu_call(self, call, template=False, stream=False):
+        """Ejecuta de forma síncrona una llamada de ``_get_verifactu_batch_call``"""
+        serv, __, operation, request = call
+        if stream:
+            return send_envelope_stream(serv, operation, request)
+        if template:
+            return send_envelope(serv, operation, request)
+        return serv[operation](**request)
+
+    def _send_batches(self):
+        """Envía a AEAT un lote por compañía, uno detrás de otro"""
+        options = self._get_send_options()
+        for items, call, schema_errors in self._prepare_batches(
+            stream=options['stream'], validate=options['validate']
+        ):
+            with capture_calls(options['store_envelopes']) as capture:
+                try:
+                    response = items._send_verifactu_call(
+                        call, template=options['template'], stream=options['stream']
+                    )
+                except Exception as e:
+                    response = e
+                items._apply_batch_response(response, schema_errors)
+                if options['store_envelopes']:
+                    items._attach_envelopes(capture.calls)
+
+    def _send_batches_async(self):
+        """Envía a AEAT un lote por compañía, manteniendo todos en vuelo a la vez.
+
+        La preparación de los lotes y la escritura de los resultados se hacen
+        con el ORM antes y después; solo las llamadas SOAP se ejecutan de forma
+        concurrente, hasta ``l10n_es_aeat_verifactu.async_max_concurrency``. El
+        tiempo total tiende al de la petición más lenta y no a la suma de todas.
+        """
+        options = self._get_send_options()
+        batches = self._prepare_batches(
+            stream=options['stream'], validate=options['validate']
+        )
+        max_concurrency = int(
+            self.env['ir.config_parameter'].sudo().get_param(
+                'l10n_es_aeat_verifactu.async_max_concurrency',
+                AEAT_ASYNC_CONCURRENCY,
+            )
+        )
+        captures = []
+        responses = (
+            run_async_calls(
+                [call for __, call, __ in batches],
+                max_concurrency,
+                template=options['template'],
+                store_envelopes=options['store_envelopes'],
+                captures=captures,
+                stream=options['stream'],
+            )
+            if batches
+            else []
+        )
+        for (items, __, schema_errors), response, captured_calls in zip(
+            batches, responses, captures
+        ):
+            items._apply_batch_response(response, schema_errors)
+            if options['store_envelopes']:
+                items._attach_envelopes(captured_calls)
+            for call in captured_calls:
+                call.close()
+
+    def _attach_envelopes(self, calls):
+        """Guarda comprimidos los sobres SOAP de ``calls`` en los elementos.
+
+        El filestore deduplica por contenido, así que el mismo lote adjunto a
+        todos sus elementos solo se almacena una vez.
+        """
+        vals_list = [
+            vals for call in calls for vals in call.attachment_vals(self._name, self.ids)
+        ]
+        if vals_list:
+            self.env['ir.attachment'].sudo().create(vals_list)
+
+    def _get_verifactu_batch_call(self, lazy=False, schema_errors=None):
+        """Llamada RegFactuSistemaFacturacion con las facturas de ``self``.
+
+        Todos los elementos deben pertenecer a la misma compañía.
+
+        :param lazy: ver ``_get_verifactu_batch_request``.
+        :param schema_errors: dict en el que guardar los errores de los
+            registros que no cumplen el XSD, que se retiran de la petición
+            (ver ``_validate_verifactu_batch_request``). Sin él no se valida.
+
+        :return: tupla (servicio, certificado, operación, argumentos) tal y
+            como la espera ``run_async_calls``.
+        """
+        invoice = self[0].invoice_id
+        serv = invoice._connect_aeat(invoice._get_mapping_key())
+        certificate = self.env['l10n.es.aeat.certificate'].get_credentials(
+            invoice.company_id
+        )
+        request = self._get_verifactu_batch_request(lazy=lazy)
+        if schema_errors is not None:
+            request = self._validate_verifactu_batch_request(
+                serv, request, schema_errors
+            )
+        return (serv, certificate, 'RegFactuSistemaFacturacion', request)
+
+    def _validate_verifactu_batch_request(self, service, request, errors):
+        """Valida localmente los registros de ``request`` contra el XSD de AEAT.
+
+        Cada registro enlaza con la huella del anterior, así que el primer
+        registro no válido se retira de la petición junto con todos los que
+        lo siguen en la cadena, que salen después de él en un envío
+        posterior. Su error se guarda en ``errors`` {id del elemento:
+        mensajes}, con None para los retenidos detrás de él. Una petición
+        completa se valida de una vez y solo si falla se valida registro a
+        registro; una perezosa se valida registro a registro según se
+        escribe, así que ``errors`` se completa durante el envío.
+        """
+        template = get_envelope_template(service, 'RegFactuSistemaFacturacion')
+        schema = get_xml_schema(VERIFACTU_REQUEST_XSD)
+        items = self._sorted_by_chain()
+        header = request['Cabecera']
+
+        def valid_registros(registros):
+            for index, (item, registro) in enumerate(zip(items, registros)):
+                messages = validate_request(
+                    schema,
+                    template,
+                    {'Cabecera': header, 'RegistroFactura': [registro]},
+                )
+                if messages:
+                    errors[item.id] = "; ".join(messages)
+                    errors.update(dict.fromkeys(items[index + 1:].ids))
+                    return
+                yield registro
+
+        registros = request['RegistroFactura']
+        if isinstance(registros, list):
+            if not validate_request(schema, template, request):
+                return request
+            registros = list(valid_registros(registros))
+        else:
+            registros = valid_registros(registros)
+        return dict(request, RegistroFactura=registros)
+
+    def _get_schema_error_results(self, schema_errors):
+        """Resultados de los elementos de ``self`` retirados de la petición:
+        los que no cumplen el esquema fallan, y los que les siguen en la
+        cadena vuelven a la cola para enviarse detrás de ellos.
+        """
+        return self._get_chain_break_results(
+            {
+                item_id: _("El registro no cumple el esquema de AEAT: %s") % error
+                for item_id, error in schema_errors.items()
+                if error
+            },
+            _(
+                "Retenido hasta el envío del registro anterior de la cadena, "
+                "que no cumple el esquema de AEAT"
+            ),
+        )
+
+    def _get_chain_break_results(self, errors, held_error):
+        """Resultados de los elementos de ``self`` que no se envían.
+
+        Los de ``errors`` {id del elemento: mensaje} fallan. Los que les
+        siguen en la cadena de su compañía enlazan con la huella de un
+        registro que AEAT no ha recibido, así que se retienen con
+        ``held_error`` y se reprograman con el primer reintento de los
+        fallidos, para salir detrás de ellos.
+
+        :return: dict {id del elemento: resultado}
+        """
+        failed = self.browse(list(errors))
+        delay = min(
+            (self._get_retry_delay(item.retry_count + 1) for item in failed),
+            default=timedelta(),
+        )
+        results = {}
+        for company in failed.mapped('company_id'):
+            chain = self.filtered(
+                lambda item: item.company_id == company
+            )._sorted_by_chain()
+            first = next(
+                index for index, item in enumerate(chain) if item.id in errors
+            )
+            for item in chain[first:]:
+                if item.id in errors:
+                    results[item.id] = {'success': False, 'error': errors[item.id]}
+                else:
+                    results[item.id] = {
+                        'success': False,
+                        'held': True,
+                        'delay': delay,
+                        'error': held_error,
+                    }
+        return results
+
+    def _sorted_by_chain(self):
+        """Elementos de ``self`` en el orden en que se encadenaron"""
+        return self.sorted(lambda item: (item.record_sequence, item.id))
+
+    def _get_verifactu_batch_request(self, lazy=False):
+        """Cabecera y registros de alta y anulación de las facturas de
+        ``self``, en el orden de la cadena.
+
+        :param lazy: devolver los registros como un generador que construye
+            los registros tipados, y lee las filas anteriores del registro,
+            por bloques de ``VERIFACTU_STREAM_CHUNK`` elementos según se
+            escriben, para el envío en streaming. La caché del ORM se vacía
+            tras cada bloque, así que la memoria no crece con el lote.
+        """
+        items = self._sorted_by_chain()
+
+        def lazy_registros():
+            for chunk in split_every(
+                VERIFACTU_STREAM_CHUNK, items.ids, items.browse
+            ):
+                yield from chunk._get_verifactu_registros()
+                self.env.invalidate_all()
+
+        return {
+            'Cabecera': items[0].invoice_id._get_aeat_header(),
+            'RegistroFactura': (
+                lazy_registros() if lazy else items._get_verifactu_registros()
+            ),
+        }
+
+    def _get_verifactu_registros(self):
+        """Estructuras SOAP de los registros de ``self``, en su orden, con el
+        encadenamiento, la fecha y la huella congelados en el registro.
+        """
+        altas = self.filtered(lambda item: item.operation == 'alta')
+        records = altas.mapped('invoice_id')._get_verifactu_records()
+        cancellations = (self - altas).mapped('invoice_id')._get_verifactu_records(
+            cancel=True
+        )
+        previous = self.mapped('registry_id')._get_previous_records()
+        registros = []
+        for item in self:
+            if item.operation == 'anulacion':
+                record = cancellations[item.invoice_id.id]
+                key = 'RegistroAnulacion'
+            else:
+                record = records[item.invoice_id.id]
+                key = 'RegistroAlta'
+            registry = item.registry_id
+            if registry:
+                previous_record = previous.get(
+                    (registry.company_id.id, registry.sequence - 1)
+                )
+                record.chaining = (
+                    previous_record._get_next_chaining()
+                    if previous_record
+                    else Chaining()
+                )
+                record.generated_at = registry.record_date
+                record.hash = registry.record_hash
+            registros.append({key: record.to_soap()})
+        return registros
+
+    def _parse_verifactu_response(self, response):
+        """Convierte la respuesta de RegFactuSistemaFacturacion en resultados.
+
+        :return: dict {id del elemento: resultado} para _apply_send_results
+        """
+        lines = {
+            (
+                line.IDFactura.NumSerieFactura,
+                line.IDFactura.FechaExpedicionFactura,
+                line.Operacion.TipoOperacion,
+            ): line
+            for line in response.RespuestaLinea or []
+        }
+        results = {}
+        for item in self:
+            line = lines.get(
+                item._get_verifactu_invoice_key()
+                + (VERIFACTU_OPERATIONS[item.operation],)
+            )
+            if line is None:
+                results[item.id] = {
+                    'success': False,
+                    'error': _("AEAT no ha devuelto respuesta para la factura"),
+                }
+                continue
+            error = line.CodigoErrorRegistro and (
+                f"[{line.CodigoErrorRegistro}] {line.DescripcionErrorRegistro}"
+            )
+            response_vals = {
+                'estado': line.EstadoRegistro,
+                'code': line.CodigoErrorRegistro,
+                'csv': response.CSV,
+            }
+            if line.EstadoRegistro == 'Incorrecto' and not line.RegistroDuplicado:
+                results[item.id] = dict(response_vals, success=False, error=error)
+            else:
+                # Un registro duplicado ya estaba en AEAT: no hay nada que reenviar
+                if item.operation == 'anulacion':
+                    aeat_state = 'cancelled'
+                elif line.EstadoRegistro == 'AceptadoConErrores':
+                    aeat_state = 'sent_w_errors'
+                else:
+                    aeat_state = 'sent'
+                results[item.id] = dict(
+                    response_vals,
+                    success=True,
+                    response=response.CSV or '',
+                    aeat_state=aeat_state,
+                    error=error if not line.RegistroDuplicado else False,
+                )
+        return results
     
+    @api.model
+    def reconcile_unknown_queue(self):
+        """Concilia con AEAT los envíos cuyo resultado se desconoce.
+
+        Los elementos se agrupan por emisor y periodo de liquidación, y cada
+        grupo se resuelve con una consulta paginada a
+        ConsultaFactuSistemaFacturacion en lugar de reenviar factura a factura.
+        """
+        unknown_items = self.search([('state', '=', 'unknown')])
+        groups = defaultdict(lambda: self.browse())
+        for item in unknown_items:
+            invoice = item.invoice_id
+            key = (
+                item.company_id,
+                invoice._get_document_fiscal_year(),
+                invoice._get_document_period(),
+            )
+            groups[key] |= item
+
+        for (company, fiscal_year, period), items in groups.items():
+            try:
+                registered = items._query_verifactu_period(fiscal_year, period)
+            except Exception as e:
+                _logger.warning(
+                    f"Error conciliando Veri*FACTU de {company.name} "
+                    f"({fiscal_year}/{period}): {str(e)}"
+                )
+                continue
+            items._resolve_unknown_items(registered)
+
+        return len(unknown_items)
+
+    def _get_verifactu_invoice_key(self):
+        """Clave (NumSerieFactura, FechaExpedicionFactura) de la factura"""
+        self.ensure_one()
+        invoice = self.invoice_id
+        return (
+            invoice._get_document_serial_number(),
+            invoice._get_document_date(),
+        )
+
+    def _query_verifactu_period(self, fiscal_year, period):
+        """Consulta en AEAT los registros del emisor de un periodo.
+
+        Recorre las páginas de la consulta usando ClavePaginacion y se detiene
+        en cuanto se han localizado todas las facturas de ``self``.
+
+        :return: dict {(NumSerieFactura, FechaExpedicionFactura): EstadoRegistro}
+            solo con las facturas de ``self`` que AEAT tiene registradas.
+        """
+        pending = {item._get_verifactu_invoice_key() for item in self}
+        invoice = self[0].invoice_id
+        serv = invoice._connect_aeat(invoice._get_mapping_key())
+        query = {
+            "Cabecera": invoice._get_aeat_query_header(),
+            "FiltroConsulta": {
+                "PeriodoImputacion": {"Ejercicio": fiscal_year, "Periodo": period},
+            },
+        }
+        registered = {}
+        while pending:
+            res = serv.ConsultaFactuSistemaFacturacion(**query)
+            for record in res.RegistroRespuestaConsultaFactuSistemaFacturacion or []:
+                key = (
+                    record.IDFactura.NumSerieFactura,
+                    record.IDFactura.FechaExpedicionFactura,
+                )
+                if key in pending:
+                    pending.discard(key)
+                    registered[key] = record.EstadoRegistro
+            if res.IndicadorPaginacion != "S" or not res.ClavePaginacion:
+                break
+            query["FiltroConsulta"]["ClavePaginacion"] = res.ClavePaginacion
+        return registered
+
+    def _resolve_unknown_items(self, registered):
+        """Resuelve en bloque los elementos en duda con lo registrado en AEAT.
+
+        Las facturas que AEAT no tiene vuelven a la cola: reenviarlas no puede
+        generar duplicados.
+        """
+        now = fields.Datetime.now()
+        groups = defaultdict(lambda: self.browse())
+        for item in self:
+            state = registered.get(item._get_verifactu_invoice_key())
+            if state is None:
+                groups[(None, False)] |= item
+            elif item.operation == 'anulacion':
+                # Solo un registro anulado confirma la anulación
+                if state.EstadoRegistro == 'Anulado':
+                    groups[('Anulacion', False)] |= item
+                else:
+                    groups[(None, False)] |= item
+            else:
+                groups[
+                    (state.EstadoRegistro, state.DescripcionErrorRegistro or False)
+                ] |= item
+
+        for (aeat_state, error), items in groups.items():
+            if aeat_state is None:
+                items.write({
+                    'state': 'pending',
+                    'scheduled_date': now,
+                })
+            elif aeat_state == 'Anulacion':
+                items.write({
+                    'state': 'sent',
+                    'processed_date': now,
+                })
+                items.mapped('registry_id').write({
+                    'aeat_state': 'Correcto',
+                    'response_date': now,
+                })
+                items.mapped('invoice_id').write({
+                    'aeat_state': 'cancelled',
+                    'aeat_send_failed': False,
+                    'aeat_send_error': False,
+                })
+            elif aeat_state == 'Anulado':
+                items.write({
+                    'state': 'cancelled',
+                    'processed_date': now,
+                })
+            else:
+                items.write({
+                    'state': 'sent',
+                    'processed_date': now,
+                    'error_message': error,
+                })
+                items.mapped('registry_id').write({
+                    'aeat_state': aeat_state,
+                    'response_date': now,
+                })
+                items.mapped('invoice_id').write({
+                    'aeat_state': (
+                        'sent' if aeat_state == 'Correcto' else 'sent_w_errors'
+                    ),
+                    'aeat_send_failed': False,
+                    'aeat_send_error': error,
+                })
+
     def action_retry(self):
         """Reintenta el envío"""
         self.ensure_one()
@@ -0,0 +1,311 @@
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+"""Typed Veri*FACTU registration and cancellation records.
+
+Each record keeps only the attributes declared in its ``__slots__`` and the
+field rules live in the class: amounts are quantized with ``Decimal`` once,
+when the record is created, and texts are cut to the length allowed by the
+AEAT schema. ``to_soap`` returns the structure zeep and the envelope
+templates expect, so no second pass over the payload is needed.
+"""
+import json
+from decimal import ROUND_HALF_UP, Decimal
+from hashlib import sha256
+
+VERIFACTU_VERSION = "1.0"
+AMOUNT_PRECISION = Decimal("0.01")
+
+
+def to_amount(value):
+    """Quantize ``value`` to the 2 decimals of the AEAT amounts.
+
+    Floats go through their shortest ``repr`` so 3 x 3,77 € at 10% is
+    rounded as written and not as its binary approximation.
+    """
+    if not isinstance(value, Decimal):
+        value = Decimal(repr(value) if isinstance(value, float) else value)
+    return value.quantize(AMOUNT_PRECISION, rounding=ROUND_HALF_UP)
+
+
+class VerifactuRecord:
+    """Base of the records: keyword construction with the field rules."""
+
+    __slots__ = ()
+    # Fields quantized with ``to_amount``
+    _amounts = ()
+    # Maximum length of the text fields
+    _max_lengths = {}
+
+    def __init__(self, **values):
+        for name in self.__slots__:
+            value = values.pop(name, None)
+            if value is not None:
+                if name in self._amounts:
+                    value = to_amount(value)
+                elif name in self._max_lengths:
+                    value = value[: self._max_lengths[name]]
+            setattr(self, name, value)
+        if values:
+            raise TypeError(
+                "Unknown fields for %s: %s" % (type(self).__name__, ", ".join(values))
+            )
+
+    def __eq__(self, other):
+        return type(self) is type(other) and all(
+            getattr(self, name) == getattr(other, name) for name in self.__slots__
+        )
+
+    def __repr__(self):
+        return "%s(%s)" % (
+            type(self).__name__,
+            ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__),
+        )
+
+    def to_soap(self):
+        raise NotImplementedError
+
+
+class ChainedRecord(VerifactuRecord):
+    """Record of the issuer's hash chain, whose ``hash`` covers some of its
+    fields and the hash of the previous record.
+    """
+
+    __slots__ = ()
+
+    def hash_fields(self):
+        """(name, value) pairs of the hash string, in the specified order"""
+        raise NotImplementedError
+
+    def compute_hash(self):
+        hash_string = "&".join(f"{name}={value}" for name, value in self.hash_fields())
+        return sha256(hash_string.encode("utf-8")).hexdigest().upper()
+
+    def digest(self):
+        """SHA-256 of the whole SOAP structure, unlike ``hash`` which only
+        covers the fields of the specification.
+        """
+        content = json.dumps(
+            self.to_soap(), sort_keys=True, default=str, separators=(",", ":")
+        )
+        return sha256(content.encode("utf-8")).hexdigest()
+
+
+class InvoiceId(VerifactuRecord):
+    """Issuer, number and date identifying an invoice"""
+
+    __slots__ = ("issuer_nif", "serial_number", "date")
+    _max_lengths = {"serial_number": 60}
+
+    def to_soap(self):
+        return {
+            "IDEmisorFactura": self.issuer_nif,
+            "NumSerieFactura": self.serial_number,
+            "FechaExpedicionFactura": self.date,
+        }
+
+    def to_soap_cancellation(self):
+        return {
+            "IDEmisorFacturaAnulada": self.issuer_nif,
+            "NumSerieFacturaAnulada": self.serial_number,
+            "FechaExpedicionFacturaAnulada": self.date,
+        }
+
+
+class Party(VerifactuRecord):
+    """Recipient of an invoice, identified by NIF or by ``IDOtro``"""
+
+    __slots__ = ("name", "nif", "country_code", "id_type", "identifier")
+    _max_lengths = {"name": 120, "identifier": 20}
+
+    def to_soap(self):
+        res = {"NombreRazon": self.name}
+        if self.nif:
+            res["NIF"] = self.nif
+        else:
+            res["IDOtro"] = {
+                "CodigoPais": self.country_code,
+                "IDType": self.id_type,
+                "ID": self.identifier,
+            }
+        return res
+
+
+class TaxDetail(VerifactuRecord):
+    """One line of ``Desglose``. ``exemption`` replaces ``operation_type``
+    for exempt operations.
+    """
+
+    __slots__ = (
+        "regime_key",
+        "operation_type",
+        "exemption",
+        "tax_rate",
+        "base",
+        "fee",
+        "surcharge_rate",
+        "surcharge_fee",
+    )
+    _amounts = ("tax_rate", "base", "fee", "surcharge_rate", "surcharge_fee")
+
+    def to_soap(self):
+        res = {"ClaveRegimen": self.regime_key}
+        if self.exemption:
+            res["OperacionExenta"] = self.exemption
+        else:
+            res["CalificacionOperacion"] = self.operation_type
+        if self.tax_rate is not None and not self.exemption:
+            res["TipoImpositivo"] = self.tax_rate
+        res["BaseImponibleOimporteNoSujeto"] = self.base
+        if self.fee is not None and not self.exemption:
+            res["CuotaRepercutida"] = self.fee
+        if self.surcharge_fee:
+            res["TipoRecargoEquivalencia"] = self.surcharge_rate
+            res["CuotaRecargoEquivalencia"] = self.surcharge_fee
+        return res
+
+
+class ComputerSystem(VerifactuRecord):
+    """``SistemaInformatico`` block, shared by the records of a company"""
+
+    __slots__ = (
+        "name",
+        "nif",
+        "system_name",
+        "system_id",
+        "version",
+        "installation_number",
+        "only_verifactu",
+        "multi_ot",
+        "multiple_ot",
+    )
+    _max_lengths = {
+        "name": 120,
+        "system_name": 30,
+        "system_id": 2,
+        "version": 50,
+        "installation_number": 100,
+    }
+
+    def to_soap(self):
+        return {
+            "NombreRazon": self.name,
+            "NIF": self.nif,
+            "NombreSistemaInformatico": self.system_name,
+            "IdSistemaInformatico": self.system_id,
+            "Version": self.version,
+            "NumeroInstalacion": self.installation_number,
+            "TipoUsoPosibleSoloVerifactu": self.only_verifactu or "S",
+            "TipoUsoPosibleMultiOT": self.multi_ot or "N",
+            "IndicadorMultiplesOT": self.multiple_ot or "N",
+        }
+
+
+class Chaining(VerifactuRecord):
+    """Link to the previous record of the issuer, none for the first one"""
+
+    __slots__ = ("previous_id", "previous_hash")
+
+    def to_soap(self):
+        if self.previous_id is None:
+            return {"PrimerRegistro": "S"}
+        return {
+            "RegistroAnterior": dict(
+                self.previous_id.to_soap(), Huella=self.previous_hash
+            )
+        }
+
+
+class RegistrationRecord(ChainedRecord):
+    """``RegistroAlta`` of an invoice"""
+
+    __slots__ = (
+        "invoice_id",
+        "issuer_name",
+        "invoice_type",
+        "rectification_type",
+        "rectified_ids",
+        "description",
+        "recipients",
+        "details",
+        "total_fee",
+        "total_amount",
+        "chaining",
+        "system",
+        "generated_at",
+        "hash",
+    )
+    _amounts = ("total_fee", "total_amount")
+    _max_lengths = {"issuer_name": 120, "description": 500}
+
+    def hash_fields(self):
+        return (
+            ("IDEmisorFactura", self.invoice_id.issuer_nif),
+            ("NumSerieFactura", self.invoice_id.serial_number),
+            ("FechaExpedicionFactura", self.invoice_id.date),
+            ("TipoFactura", self.invoice_type),
+            ("CuotaTotal", self.total_fee),
+            ("ImporteTotal", self.total_amount),
+            ("Huella", self.chaining.previous_hash or ""),
+            ("FechaHoraHusoGenRegistro", self.generated_at),
+        )
+
+    def to_soap(self):
+        res = {
+            "IDVersion": VERIFACTU_VERSION,
+            "IDFactura": self.invoice_id.to_soap(),
+            "NombreRazonEmisor": self.issuer_name,
+            "TipoFactura": self.invoice_type,
+        }
+        if self.rectification_type:
+            res["TipoRectificativa"] = self.rectification_type
+        if self.rectified_ids:
+            res["FacturasRectificadas"] = {
+                "IDFacturaRectificada": [
+                    invoice_id.to_soap() for invoice_id in self.rectified_ids
+                ]
+            }
+        res["DescripcionOperacion"] = self.description
+        if self.recipients:
+            res["Destinatarios"] = {
+                "IDDestinatario": [party.to_soap() for party in self.recipients]
+            }
+        res.update(
+            {
+                "Desglose": {
+                    "DetalleDesglose": [detail.to_soap() for detail in self.details]
+                },
+                "CuotaTotal": self.total_fee,
+                "ImporteTotal": self.total_amount,
+                "Encadenamiento": self.chaining.to_soap(),
+                "SistemaInformatico": self.system.to_soap(),
+                "FechaHoraHusoGenRegistro": self.generated_at,
+                "TipoHuella": "01",
+                "Huella": self.hash,
+            }
+        )
+        return res
+
+
+class CancellationRecord(ChainedRecord):
+    """``RegistroAnulacion`` of a previously registered invoice"""
+
+    __slots__ = ("invoice_id", "chaining", "system", "generated_at", "hash")
+
+    def hash_fields(self):
+        return (
+            ("IDEmisorFacturaAnulada", self.invoice_id.issuer_nif),
+            ("NumSerieFacturaAnulada", self.invoice_id.serial_number),
+            ("FechaExpedicionFacturaAnulada", self.invoice_id.date),
+            ("Huella", self.chaining.previous_hash or ""),
+            ("FechaHoraHusoGenRegistro", self.generated_at),
+        )
+
+    def to_soap(self):
+        return {
+            "IDVersion": VERIFACTU_VERSION,
+            "IDFactura": self.invoice_id.to_soap_cancellation(),
+            "Encadenamiento": self.chaining.to_soap(),
+            "SistemaInformatico": self.system.to_soap(),
+            "FechaHoraHusoGenRegistro": self.generated_at,
+            "TipoHuella": "01",
+            "Huella": self.hash,
+        }
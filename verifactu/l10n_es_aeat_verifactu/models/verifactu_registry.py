@@ -0,0 +1,387 @@
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+
+from lxml import etree
+
+from odoo import _, api, fields, models
+from odoo.exceptions import UserError
+
+from odoo.addons.l10n_es_aeat.models.aeat_envelope import get_envelope_template
+from odoo.addons.l10n_es_aeat.models.aeat_signature import sign_detached
+
+from .verifactu_records import CancellationRecord, Chaining, InvoiceId
+
+# Filas leídas de cada vez del cursor de la exportación
+VERIFACTU_EXPORT_ITERSIZE = 2000
+# Bytes leídos de cada vez al copiar la exportación al almacén de adjuntos
+VERIFACTU_EXPORT_BLOCK_SIZE = 1024 * 1024
+# Columnas exportadas y su nombre en el fichero, en ese orden
+VERIFACTU_EXPORT_COLUMNS = (
+    ('sequence', 'Secuencia'),
+    ('operation', 'Operacion'),
+    ('issuer_nif', 'IDEmisorFactura'),
+    ('serial_number', 'NumSerieFactura'),
+    ('expedition_date', 'FechaExpedicionFactura'),
+    ('document_type', 'TipoFactura'),
+    ('total_fee', 'CuotaTotal'),
+    ('total_amount', 'ImporteTotal'),
+    ('previous_hash', 'HuellaAnterior'),
+    ('record_date', 'FechaHoraHusoGenRegistro'),
+    ('record_hash', 'Huella'),
+    ('payload_digest', 'ResumenContenido'),
+    ('aeat_state', 'EstadoRegistro'),
+    ('aeat_code', 'CodigoErrorRegistro'),
+    ('aeat_csv', 'CSV'),
+    ('response_date', 'FechaRespuesta'),
+    ('signature', 'Firma'),
+)
+
+# Únicos campos que se completan después de crear el registro
+VERIFACTU_REGISTRY_RESPONSE_FIELDS = {
+    'aeat_state',
+    'aeat_code',
+    'aeat_csv',
+    'response_date',
+}
+
+
+class VerifactuRegistry(models.Model):
+    """Registro de facturación Veri*FACTU.
+
+    Una fila inmutable por cada registro de alta o anulación generado, con su
+    enlace en la cadena del emisor, la huella y el resumen del contenido
+    enviado. Solo se añaden filas: lo único que se escribe después es la
+    respuesta de AEAT. Las facturas no guardan nada de esto, así que las
+    consultas de auditoría no compiten con la contabilidad.
+    """
+
+    _name = "verifactu.registry"
+    _description = "Registro de facturación Veri*FACTU"
+    _order = "company_id, sequence desc"
+    _rec_name = "serial_number"
+
+    company_id = fields.Many2one(
+        "res.company",
+        string="Compañía",
+        required=True,
+        readonly=True,
+        ondelete="restrict",
+    )
+    sequence = fields.Integer(
+        string="Posición en la cadena", required=True, readonly=True
+    )
+    operation = fields.Selection([
+        ('alta', 'Alta'),
+        ('anulacion', 'Anulación'),
+    ], string="Operación", required=True, readonly=True)
+    invoice_id = fields.Many2one(
+        "account.move",
+        string="Factura",
+        required=True,
+        readonly=True,
+        index=True,
+        ondelete="restrict",
+    )
+    # Identificación de la factura tal y como se registró
+    issuer_nif = fields.Char(string="NIF emisor", required=True, readonly=True)
+    serial_number = fields.Char(string="Número", required=True, readonly=True)
+    expedition_date = fields.Char(
+        string="Fecha de expedición", required=True, readonly=True
+    )
+    document_type = fields.Char(string="Tipo de factura", readonly=True)
+    total_fee = fields.Char(string="Cuota total", readonly=True)
+    total_amount = fields.Char(string="Importe total", readonly=True)
+    # Encadenamiento
+    previous_hash = fields.Char(string="Huella anterior", readonly=True)
+    record_date = fields.Char(
+        string="Fecha de generación del registro",
+        required=True,
+        readonly=True,
+        index=True,
+    )
+    record_hash = fields.Char(string="Huella", required=True, readonly=True)
+    payload_digest = fields.Char(
+        string="Resumen del contenido",
+        readonly=True,
+        help="SHA-256 del registro enviado, para comprobar que no se ha alterado.",
+    )
+    signature = fields.Text(
+        string="Firma",
+        readonly=True,
+        help="Firma XAdES separada del registro, en el modo NO VERI*FACTU.",
+    )
+    # Respuesta de AEAT
+    aeat_state = fields.Selection([
+        ('Correcto', 'Correcto'),
+        ('AceptadoConErrores', 'Aceptado con errores'),
+        ('Incorrecto', 'Incorrecto'),
+    ], string="Estado en AEAT", readonly=True)
+    aeat_code = fields.Char(string="Código de error", readonly=True)
+    aeat_csv = fields.Char(string="CSV", readonly=True)
+    response_date = fields.Datetime(string="Fecha de respuesta", readonly=True)
+
+    _sql_constraints = [
+        (
+            'company_sequence_unique',
+            'unique(company_id, sequence)',
+            'La posición en la cadena de registros del emisor debe ser única.',
+        ),
+    ]
+
+    def write(self, vals):
+        if set(vals) - VERIFACTU_REGISTRY_RESPONSE_FIELDS:
+            raise UserError(
+                _("Los registros de facturación Veri*FACTU no se pueden modificar.")
+            )
+        return super().write(vals)
+
+    def unlink(self):
+        raise UserError(
+            _("Los registros de facturación Veri*FACTU no se pueden eliminar.")
+        )
+
+    @api.model
+    def _get_chain_head(self, company):
+        """Último registro de la cadena de ``company``"""
+        return self.search(
+            [('company_id', '=', company.id)], order='sequence desc', limit=1
+        )
+
+    def _get_invoice_id(self):
+        self.ensure_one()
+        return InvoiceId(
+            issuer_nif=self.issuer_nif,
+            serial_number=self.serial_number,
+            date=self.expedition_date,
+        )
+
+    def _get_next_chaining(self):
+        """Encadenamiento del registro que sigue a ``self``, o de un primer
+        registro si ``self`` está vacío.
+        """
+        if not self:
+            return Chaining()
+        self.ensure_one()
+        return Chaining(
+            previous_id=self._get_invoice_id(), previous_hash=self.record_hash
+        )
+
+    def _get_previous_records(self):
+        """Registros que preceden en la cadena a los de ``self``.
+
+        :return: dict {(compañía, posición): registro}
+        """
+        previous = self.search([
+            ('company_id', 'in', self.mapped('company_id').ids),
+            ('sequence', 'in', [record.sequence - 1 for record in self]),
+        ])
+        return {(record.company_id.id, record.sequence): record for record in previous}
+
+    @api.model
+    def _prepare_vals(self, invoice, operation, sequence, record):
+        """Valores de la fila de ``record``, registro tipado ya encadenado"""
+        vals = {
+            'company_id': invoice.company_id.id,
+            'sequence': sequence,
+            'operation': operation,
+            'invoice_id': invoice.id,
+            'issuer_nif': record.invoice_id.issuer_nif,
+            'serial_number': record.invoice_id.serial_number,
+            'expedition_date': record.invoice_id.date,
+            'previous_hash': record.chaining.previous_hash,
+            'record_date': record.generated_at,
+            'record_hash': record.hash,
+            'payload_digest': record.digest(),
+        }
+        if operation == 'alta':
+            vals.update({
+                'document_type': record.invoice_type,
+                'total_fee': str(record.total_fee),
+                'total_amount': str(record.total_amount),
+            })
+        return vals
+
+    @api.model
+    def _sign_records(self, invoices, records):
+        """Firmas XAdES separadas de ``records``, registros tipados ya
+        encadenados de ``invoices``, todas de la misma compañía.
+
+        Cada firma cubre el XML canónico del registro tal y como se enviaría
+        a AEAT y lo referencia por su huella. La clave del certificado se
+        carga una vez por proceso.
+
+        :return: lista de firmas en el orden de ``records``
+        """
+        invoice = invoices[0]
+        service = invoice._connect_aeat(invoice._get_mapping_key())
+        template = get_envelope_template(service, 'RegFactuSistemaFacturacion')
+        header = invoice._get_aeat_header()
+        documents = []
+        for record in records:
+            key = (
+                'RegistroAnulacion'
+                if isinstance(record, CancellationRecord)
+                else 'RegistroAlta'
+            )
+            request = template.build(
+                {'Cabecera': header, 'RegistroFactura': [{key: record.to_soap()}]}
+            )[0][0]
+            documents.append((
+                f"urn:verifactu:{record.invoice_id.issuer_nif}:{record.hash}",
+                etree.tostring(request[1][0], method='c14n', exclusive=True),
+            ))
+        credentials = self.env['l10n.es.aeat.certificate'].get_credentials(
+            invoice.company_id
+        )
+        return [
+            signature.decode() for signature in sign_detached(credentials, documents)
+        ]
+
+    @api.model
+    def export_records(self, fileobj, companies, date_from=None, date_to=None,
+                       export_format='xml'):
+        """Exporta comprimido con gzip en ``fileobj`` el registro de
+        facturación de ``companies`` generado entre ``date_from`` y
+        ``date_to``, ambas incluidas, en XML o JSON Lines (``'jsonl'``).
+
+        Las filas se leen con un cursor de servidor en bloques de
+        ``VERIFACTU_EXPORT_ITERSIZE`` y se escriben según llegan, en una sola
+        pasada, así que la memoria no depende del número de registros.
+
+        :return: número de registros exportados
+        """
+        self.flush_model()
+        query, params = self._get_export_query(companies, date_from, date_to)
+        cursor = self.env.cr._cnx.cursor('verifactu_registry_export')
+        cursor.itersize = VERIFACTU_EXPORT_ITERSIZE
+        try:
+            cursor.execute(query, params)
+            with gzip.GzipFile(fileobj=fileobj, mode='wb') as output:
+                if export_format == 'jsonl':
+                    count = self._write_export_jsonl(output, cursor)
+                else:
+                    count = self._write_export_xml(output, cursor)
+        finally:
+            cursor.close()
+        for company in companies:
+            self.env['verifactu.event'].log_event(
+                '08',
+                _("Exportación %(format)s del %(from)s al %(to)s") % {
+                    'format': export_format,
+                    'from': date_from or '-',
+                    'to': date_to or '-',
+                },
+                company=company,
+            )
+        return count
+
+    @api.model
+    def export_attachment(self, companies, date_from=None, date_to=None,
+                          export_format='xml'):
+        """Exportación de ``export_records`` guardada como adjunto.
+
+        El fichero comprimido se escribe en disco y se copia por bloques al
+        almacén de adjuntos (ver ``_store_export_file``), sin leerlo entero.
+        """
+        with tempfile.TemporaryFile() as fileobj:
+            count = self.export_records(
+                fileobj, companies, date_from, date_to, export_format
+            )
+            vals = self._store_export_file(fileobj)
+        name = "registro_verifactu_%s_%s.%s.gz" % (
+            date_from or '', date_to or '', export_format
+        )
+        vals.update({
+            'name': name,
+            'mimetype': 'application/gzip',
+            'res_model': 'res.company' if len(companies) == 1 else False,
+            'res_id': companies.id if len(companies) == 1 else False,
+            'description': _("%s registros de facturación Veri*FACTU") % count,
+        })
+        return self.env['ir.attachment'].create(vals)
+
+    @api.model
+    def _store_export_file(self, fileobj):
+        """Valores del adjunto con el contenido de ``fileobj``.
+
+        Con el almacén en ficheros, el contenido se resume y se copia al
+        almacén por bloques de ``VERIFACTU_EXPORT_BLOCK_SIZE``, con la misma
+        ruta y suma SHA-1 que ``ir.attachment`` le daría. Con los adjuntos en
+        la base de datos se lee entero.
+        """
+        attachment_obj = self.env['ir.attachment'].sudo()
+        fileobj.seek(0)
+        if attachment_obj._storage() != 'file':
+            return {'raw': fileobj.read()}
+        checksum = hashlib.sha1()
+        for block in iter(lambda: fileobj.read(VERIFACTU_EXPORT_BLOCK_SIZE), b''):
+            checksum.update(block)
+        checksum = checksum.hexdigest()
+        file_size = fileobj.tell()
+        fname = "%s/%s" % (checksum[:2], checksum)
+        full_path = attachment_obj._full_path(fname)
+        if not os.path.exists(full_path):
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            fileobj.seek(0)
+            with open(full_path, 'wb') as target:
+                shutil.copyfileobj(fileobj, target, VERIFACTU_EXPORT_BLOCK_SIZE)
+            # Se borra si la transacción no llega a confirmarse
+            attachment_obj._mark_for_gc(fname)
+        return {
+            'store_fname': fname,
+            'checksum': checksum,
+            'file_size': file_size,
+        }
+
+    @api.model
+    def _get_export_query(self, companies, date_from, date_to):
+        """Consulta de la exportación, en el orden de la cadena de cada emisor.
+
+        ``record_date`` se genera siempre en UTC con formato ISO, así que
+        admite comparaciones de texto con fechas ISO.
+        """
+        columns = ", ".join(column for column, __ in VERIFACTU_EXPORT_COLUMNS)
+        query = f"SELECT {columns} FROM verifactu_registry WHERE company_id IN %s"
+        params = [tuple(companies.ids) or (None,)]
+        if date_from:
+            query += " AND record_date >= %s"
+            params.append(fields.Date.to_date(date_from).isoformat())
+        if date_to:
+            query += " AND record_date < %s"
+            params.append(
+                (fields.Date.to_date(date_to) + timedelta(days=1)).isoformat()
+            )
+        query += " ORDER BY company_id, sequence"
+        return query, params
+
+    @api.model
+    def _write_export_jsonl(self, output, cursor):
+        count = 0
+        names = [name for __, name in VERIFACTU_EXPORT_COLUMNS]
+        for row in cursor:
+            line = json.dumps(dict(zip(names, row)), default=str, ensure_ascii=False)
+            output.write(line.encode('utf-8') + b'\n')
+            count += 1
+        return count
+
+    @api.model
+    def _write_export_xml(self, output, cursor):
+        count = 0
+        with etree.xmlfile(output, encoding='utf-8') as xml_file:
+            xml_file.write_declaration()
+            with xml_file.element('RegistroFacturacion'):
+                for row in cursor:
+                    registro = etree.Element('Registro')
+                    for (__, name), value in zip(VERIFACTU_EXPORT_COLUMNS, row):
+                        if value is not None and value is not False:
+                            etree.SubElement(registro, name).text = str(value)
+                    xml_file.write(registro)
+                    count += 1
+        return count
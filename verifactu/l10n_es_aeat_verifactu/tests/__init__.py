@@ -1 +1,6 @@
 from . import test_10n_es_aeat_verifactu
+from . import test_verifactu_envelope
+from . import test_verifactu_queue
+from . import test_verifactu_stand_in
+from . import test_verifactu_records
+from . import test_verifactu_event
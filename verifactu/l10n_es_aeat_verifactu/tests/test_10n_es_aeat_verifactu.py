@@ -1,6 +1,8 @@
 # Copyright 2024 Aures TIC - Almudena de La Puente <almudena@aurestic.es>
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
 
+import os
+from decimal import Decimal
 from hashlib import sha256
 
 from odoo.addons.l10n_es_aeat.tests.test_l10n_es_aeat_certificate import (
@@ -43,3 +45,63 @@ class TestL10nEsAeatSiiBase(TestL10nEsAeatModBase, TestL10nEsAeatCertificateBase
         sha_hash_code = sha256(verifactu_hash_string.encode("utf-8"))
         hash_code = sha_hash_code.hexdigest().upper()
         self.assertEqual(hash_code, expected_hash)
+
+    def test_verifactu_local_wsdl(self):
+        agency = self.env.ref("l10n_es_aeat.aeat_tax_agency_spain")
+        params = agency._connect_params_verifactu("out_invoice", self.env.company)
+        self.assertTrue(os.path.isfile(params["wsdl"]))
+        self.assertEqual(
+            agency._get_verifactu_local_wsdl("https://example.com/Other.wsdl"),
+            "https://example.com/Other.wsdl",
+        )
+
+
+class TestVerifactuTaxDetails(TestL10nEsAeatModBase):
+    taxes_sale = {
+        # tax code: (base, tax_amount)
+        "S_IVA21B,S_REQ52": (100, 0),
+        "S_IVA_NS": (50, 0),
+        "S_IVA0_SP_I": (40, 0),
+        "S_IVA0_E": (30, 0),
+        "S_IVA0_ISP": (20, 0),
+    }
+
+    def _get_details(self, invoice):
+        return {
+            detail.operation_type or detail.exemption: detail
+            for detail in invoice._get_verifactu_tax_details()[invoice.id]
+        }
+
+    def test_tax_details(self):
+        invoice = self._invoice_sale_create("2024-01-01")
+        details = self._get_details(invoice)
+        self.assertEqual(set(details), {"S1", "N1", "N2", "E2", "S2"})
+        # The equivalence surcharge goes in the line of its VAT
+        self.assertEqual(details["S1"].regime_key, "18")
+        self.assertEqual(details["S1"].fee, Decimal("21.00"))
+        self.assertEqual(details["S1"].surcharge_rate, Decimal("5.20"))
+        self.assertEqual(details["S1"].surcharge_fee, Decimal("5.20"))
+        # Not subject operations are not declared as exempt
+        self.assertEqual(details["N1"].base, Decimal("50.00"))
+        self.assertIsNone(details["N1"].tax_rate)
+        self.assertNotIn("OperacionExenta", details["N1"].to_soap())
+        self.assertEqual(details["N2"].to_soap()["CalificacionOperacion"], "N2")
+        self.assertEqual(details["N2"].regime_key, "01")
+        self.assertEqual(details["E2"].regime_key, "02")
+        self.assertEqual(details["S2"].fee, Decimal("0.00"))
+
+    def test_fiscal_position_regime_key(self):
+        fiscal_position = self.env["account.fiscal.position"].create(
+            {
+                "name": "Criterio de caja",
+                "company_id": self.company.id,
+                "verifactu_regime_key": "07",
+            }
+        )
+        invoice = self._invoice_sale_create(
+            "2024-01-01", {"fiscal_position_id": fiscal_position.id}
+        )
+        self.assertEqual(
+            {detail.regime_key for detail in self._get_details(invoice).values()},
+            {"07"},
+        )
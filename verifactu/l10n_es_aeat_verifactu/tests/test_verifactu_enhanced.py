@@ -2,11 +2,12 @@
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
 import base64
-from unittest.mock import patch
 
 from odoo.tests.common import TransactionCase
 from odoo.exceptions import UserError
 
+from .test_verifactu_queue import accepted_response, patch_verifactu_send
+
 
 class TestVerifactuEnhanced(TransactionCase):
     """Tests para las nuevas funcionalidades de Veri*FACTU"""
@@ -157,7 +158,8 @@ class TestVerifactuEnhanced(TransactionCase):
         ], limit=1)
         
         # Procesar elemento
-        result = queue_item.process_queue_item()
+        with patch_verifactu_send(self.env, side_effect=accepted_response):
+            result = queue_item.process_queue_item()
         self.assertTrue(result)
         
         # Verificar estado
@@ -177,9 +179,7 @@ class TestVerifactuEnhanced(TransactionCase):
         })
         
         # Simular error
-        with patch.object(queue_item, '_send_to_verifactu') as mock_send:
-            mock_send.return_value = {'success': False, 'error': 'Test error'}
-            
+        with patch_verifactu_send(self.env, side_effect=Exception('Test error')):
             queue_item.process_queue_item()
             
             # Verificar reintento
@@ -198,9 +198,7 @@ class TestVerifactuEnhanced(TransactionCase):
         })
         
         # Simular error
-        with patch.object(queue_item, '_send_to_verifactu') as mock_send:
-            mock_send.return_value = {'success': False, 'error': 'Test error'}
-            
+        with patch_verifactu_send(self.env, side_effect=Exception('Test error')):
             queue_item.process_queue_item()
             
             # Verificar que pasa a error
@@ -250,7 +248,8 @@ class TestVerifactuEnhanced(TransactionCase):
             invoices.append(invoice)
         
         # Procesar cola
-        processed = self.env['verifactu.queue'].process_pending_queue()
+        with patch_verifactu_send(self.env, side_effect=accepted_response):
+            processed = self.env['verifactu.queue'].process_pending_queue()
         
         # Verificar que se procesaron elementos
         self.assertGreater(processed, 0)
@@ -0,0 +1,211 @@
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+import io
+import logging
+import os
+import tempfile
+import time
+import tracemalloc
+
+from lxml import etree
+from zeep import Client
+
+from odoo.tests.common import BaseCase, tagged
+
+from odoo.addons.l10n_es_aeat.models.aeat_envelope import (
+    get_envelope_template,
+    get_xml_schema,
+    validate_request,
+)
+
+from ..models.aeat_tax_agency import VERIFACTU_SERVICE_NAME, VERIFACTU_WSDL_PATH
+
+_logger = logging.getLogger(__name__)
+
+OPERATION = "RegFactuSistemaFacturacion"
+
+
+def _registro_alta(number):
+    return {
+        "IDVersion": "1.0",
+        "IDFactura": {
+            "IDEmisorFactura": "B12345678",
+            "NumSerieFactura": "INV/2024/%05d" % number,
+            "FechaExpedicionFactura": "01-01-2024",
+        },
+        "NombreRazonEmisor": "Test Company",
+        "TipoFactura": "F1",
+        "DescripcionOperacion": "Test",
+        "Destinatarios": {
+            "IDDestinatario": [{"NombreRazon": "Test Customer", "NIF": "87654321Y"}]
+        },
+        "Desglose": {
+            "DetalleDesglose": [
+                {
+                    "ClaveRegimen": "01",
+                    "CalificacionOperacion": "S1",
+                    "TipoImpositivo": 21.0,
+                    "BaseImponibleOimporteNoSujeto": 100.0,
+                    "CuotaRepercutida": 21.0,
+                },
+                {
+                    "ClaveRegimen": "01",
+                    "CalificacionOperacion": "S1",
+                    "TipoImpositivo": 10.0,
+                    "BaseImponibleOimporteNoSujeto": 50.0,
+                    "CuotaRepercutida": 5.0,
+                },
+            ]
+        },
+        "CuotaTotal": 26.0,
+        "ImporteTotal": 176.0,
+        "Encadenamiento": {"PrimerRegistro": "S"},
+        "SistemaInformatico": {
+            "NombreRazon": "Test Company",
+            "NIF": "B12345678",
+            "NombreSistemaInformatico": "Odoo",
+            "IdSistemaInformatico": "01",
+            "Version": "1.0",
+            "NumeroInstalacion": "1",
+            "TipoUsoPosibleSoloVerifactu": "S",
+            "TipoUsoPosibleMultiOT": "N",
+            "IndicadorMultiplesOT": "N",
+        },
+        "FechaHoraHusoGenRegistro": "2024-01-01T10:00:00+01:00",
+        "TipoHuella": "01",
+        "Huella": "A" * 64,
+    }
+
+
+def _request(size):
+    return {
+        "Cabecera": {
+            "ObligadoEmision": {"NombreRazon": "Test Company", "NIF": "B12345678"}
+        },
+        "RegistroFactura": [
+            {"RegistroAlta": _registro_alta(number)} for number in range(size)
+        ],
+    }
+
+
+def _normalize(node):
+    """Prefix independent representation of an XML tree"""
+    return (
+        etree.QName(node).text,
+        (node.text or "").strip(),
+        [_normalize(child) for child in node],
+    )
+
+
+class TestVerifactuEnvelopeCommon(BaseCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.client = Client(
+            wsdl=os.path.join(VERIFACTU_WSDL_PATH, "SistemaFacturacion.wsdl")
+        )
+        cls.service = cls.client.bind(VERIFACTU_SERVICE_NAME, "SistemaVerifactu")
+        cls.template = get_envelope_template(cls.service, OPERATION)
+
+    def _zeep_envelope(self, request):
+        return self.service._binding._create(
+            OPERATION, (), request, client=self.client
+        )[0]
+
+
+class TestVerifactuEnvelope(TestVerifactuEnvelopeCommon):
+    def test_template_matches_zeep(self):
+        request = _request(3)
+        self.assertEqual(
+            _normalize(self.template.build(request)),
+            _normalize(self._zeep_envelope(request)),
+        )
+
+    def test_template_is_shared(self):
+        service = self.client.bind(VERIFACTU_SERVICE_NAME, "SistemaVerifactu")
+        self.assertIs(get_envelope_template(service, OPERATION), self.template)
+        self.assertEqual(self.template.headers["Content-Type"], "text/xml; charset=utf-8")
+
+    def test_stream_matches_template(self):
+        request = _request(3)
+        expected = etree.tostring(
+            self.template.build(request), xml_declaration=True, encoding="utf-8"
+        )
+        output = io.BytesIO()
+        request["RegistroFactura"] = iter(request["RegistroFactura"])
+        self.template.write(output, request)
+        # Only the order of the namespace declarations may differ
+        self.assertEqual(len(output.getvalue()), len(expected))
+        self.assertEqual(
+            _normalize(etree.fromstring(output.getvalue())),
+            _normalize(etree.fromstring(expected)),
+        )
+
+    def test_validate_request(self):
+        path = os.path.join(VERIFACTU_WSDL_PATH, "SuministroLR.xsd")
+        schema = get_xml_schema(path)
+        self.assertIs(get_xml_schema(path), schema)
+        request = _request(3)
+        self.assertEqual(validate_request(schema, self.template, request), [])
+        request["RegistroFactura"][1]["RegistroAlta"]["TipoFactura"] = "X9"
+        messages = validate_request(schema, self.template, request)
+        self.assertEqual(len(messages), 1)
+        self.assertIn("TipoFactura", messages[0])
+        self.assertNotIn("{", messages[0])
+
+
+@tagged("-standard", "verifactu_benchmark")
+class TestVerifactuEnvelopeBenchmark(TestVerifactuEnvelopeCommon):
+    """Run with ``--test-tags verifactu_benchmark``"""
+
+    def _measure(self, build, request, rounds=3):
+        best = None
+        for _round in range(rounds):
+            start = time.perf_counter()
+            build(request)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    def test_benchmark_serializers(self):
+        for size in (1, 100, 1000):
+            request = _request(size)
+            zeep_time = self._measure(self._zeep_envelope, request)
+            template_time = self._measure(self.template.build, request)
+            _logger.info(
+                "Veri*FACTU envelope with %s records: zeep %.4fs, "
+                "template %.4fs (x%.1f)",
+                size,
+                zeep_time,
+                template_time,
+                zeep_time / template_time,
+            )
+
+    def _peak_memory(self, write, size):
+        tracemalloc.start()
+        try:
+            write(size)
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    def test_benchmark_memory(self):
+        def build(size):
+            etree.tostring(self.template.build(_request(size)))
+
+        def stream(size):
+            request = _request(0)
+            request["RegistroFactura"] = (
+                {"RegistroAlta": _registro_alta(number)} for number in range(size)
+            )
+            with tempfile.TemporaryFile() as output:
+                self.template.write(output, request)
+
+        for size in (100, 1000):
+            _logger.info(
+                "Veri*FACTU envelope with %s records: peak memory tree %.1f KiB, "
+                "stream %.1f KiB",
+                size,
+                self._peak_memory(build, size) / 1024,
+                self._peak_memory(stream, size) / 1024,
+            )
@@ -0,0 +1,53 @@
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+from odoo import fields
+from odoo.tests.common import TransactionCase
+
+
+class TestVerifactuEvent(TransactionCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.company = cls.env.ref("base.main_company")
+        cls.company.vat = "ES12345678Z"
+        cls.event_obj = cls.env["verifactu.event"]
+
+    def _get_events(self):
+        return self.event_obj.search(
+            [("company_id", "=", self.company.id)], order="sequence"
+        )
+
+    def test_events_buffered_and_chained(self):
+        existing = len(self._get_events())
+        for number in range(3):
+            self.event_obj.log_event("90", f"Evento {number}", company=self.company)
+        # Nothing is written until the transaction commits
+        self.assertEqual(len(self._get_events()), existing)
+        self.env.cr.precommit.run()
+        events = self._get_events()[existing:]
+        self.assertEqual(
+            events.mapped("description"), [f"Evento {number}" for number in range(3)]
+        )
+        self.assertEqual(
+            events.mapped("sequence"),
+            list(range(events[0].sequence, events[0].sequence + 3)),
+        )
+        for previous, event in zip(events, events[1:]):
+            self.assertEqual(event.previous_hash, previous.event_hash)
+        self.assertFalse(self.event_obj.check_integrity(self.company))
+
+        self.env.cr.execute(
+            "UPDATE verifactu_event SET description = 'Alterado' WHERE id = %s",
+            [events[1].id],
+        )
+        self.assertEqual(self.event_obj.check_integrity(self.company), events[1])
+        self.env.cr.precommit.run()
+        self.assertEqual(self._get_events()[-1].event_type, "06")
+
+    def test_month_partition(self):
+        self.env.cr.execute(
+            "SELECT 1 FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE c.relname = %s",
+            [f"verifactu_event_{fields.Date.today():%Y_%m}"],
+        )
+        self.assertTrue(self.env.cr.fetchone())
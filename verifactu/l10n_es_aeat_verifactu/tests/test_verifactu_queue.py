@@ -0,0 +1,684 @@
+# Copyright 2024 Aures TIC
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+import contextlib
+import gzip
+import hashlib
+import io
+import json
+import os
+from datetime import timedelta
+from decimal import Decimal
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes
+from cryptography.x509 import oid
+from lxml import etree
+from requests.exceptions import ReadTimeout
+from zeep import Client
+
+from odoo import fields
+from odoo.exceptions import UserError
+from odoo.tests.common import TransactionCase
+
+from odoo.addons.l10n_es_aeat.models.aeat_client import AeatCredentials
+from odoo.addons.l10n_es_aeat.tests.test_l10n_es_aeat_certificate import (
+    generate_private_key,
+    serialize_key_and_certificates,
+)
+
+from ..models import verifactu_queue
+from ..models.aeat_tax_agency import VERIFACTU_SERVICE_NAME, VERIFACTU_WSDL_PATH
+
+
+def get_verifactu_service():
+    """Service bound from the bundled WSDL, without any certificate"""
+    return Client(
+        wsdl=os.path.join(VERIFACTU_WSDL_PATH, "SistemaFacturacion.wsdl")
+    ).bind(VERIFACTU_SERVICE_NAME, "SistemaVerifactu")
+
+
+def accepted_response(call, template=False, stream=False):
+    """RegFactuSistemaFacturacion answer accepting every record of ``call``"""
+    lines = []
+    for registro in call[3]["RegistroFactura"]:
+        (key, record), = registro.items()
+        invoice_id = record["IDFactura"]
+        cancellation = key == "RegistroAnulacion"
+        suffix = "Anulada" if cancellation else ""
+        lines.append(
+            SimpleNamespace(
+                IDFactura=SimpleNamespace(
+                    NumSerieFactura=invoice_id["NumSerieFactura" + suffix],
+                    FechaExpedicionFactura=invoice_id[
+                        "FechaExpedicionFactura" + suffix
+                    ],
+                ),
+                Operacion=SimpleNamespace(
+                    TipoOperacion="Anulacion" if cancellation else "Alta"
+                ),
+                EstadoRegistro="Correcto",
+                CodigoErrorRegistro=None,
+                DescripcionErrorRegistro=None,
+                RegistroDuplicado=None,
+            )
+        )
+    return SimpleNamespace(CSV="CSV", RespuestaLinea=lines)
+
+
+@contextlib.contextmanager
+def patch_verifactu_send(env, **kwargs):
+    """Build the real batch calls against the bundled WSDL and replace only
+    the SOAP call with a mock configured with ``kwargs``, which is yielded.
+    """
+    with patch.object(
+        type(env["l10n.es.aeat.certificate"]), "get_credentials", return_value=None
+    ), patch.object(
+        type(env["account.move"]),
+        "_connect_aeat",
+        return_value=get_verifactu_service(),
+    ), patch.object(
+        type(env["verifactu.queue"]), "_send_verifactu_call", **kwargs
+    ) as send:
+        yield send
+
+
+class TestVerifactuQueue(TransactionCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.company = cls.env.ref("base.main_company")
+        cls.company.write(
+            {
+                "verifactu_enabled": True,
+                "verifactu_test": True,
+                "vat": "ES12345678Z",
+            }
+        )
+        cls.partner = cls.env["res.partner"].create(
+            {"name": "Test Customer", "vat": "ES87654321Y", "is_company": True}
+        )
+        cls.product = cls.env["product.product"].create(
+            {"name": "Test Product", "type": "service", "list_price": 100.0}
+        )
+        cls.queue_obj = cls.env["verifactu.queue"]
+
+    def _create_invoice(self, partner=None):
+        invoice = self.env["account.move"].create(
+            {
+                "move_type": "out_invoice",
+                "partner_id": (partner or self.partner).id,
+                "company_id": self.company.id,
+                "invoice_line_ids": [
+                    (
+                        0,
+                        0,
+                        {
+                            "product_id": self.product.id,
+                            "quantity": 1,
+                            "price_unit": 100.0,
+                        },
+                    )
+                ],
+            }
+        )
+        invoice.action_post()
+        return invoice
+
+    def _create_unregistered_invoice(self):
+        """Invoice posted before veri*FACTU was enabled"""
+        self.company.verifactu_enabled = False
+        invoice = self._create_invoice()
+        self.company.verifactu_enabled = True
+        return invoice
+
+    def _get_queue_item(self, invoice):
+        return self.queue_obj.search([("invoice_id", "=", invoice.id)], limit=1)
+
+    def test_unregistered_invoices(self):
+        invoice = self._create_invoice()
+        self.assertTrue(invoice.verifactu_enabled)
+        move_obj = self.env["account.move"]
+        self.assertIn(invoice, move_obj._get_verifactu_unregistered(self.company))
+        self.assertEqual(
+            move_obj.search_count(
+                [("id", "=", invoice.id), ("verifactu_enabled", "=", True)]
+            ),
+            1,
+        )
+        invoice.aeat_state = "sent"
+        self.assertNotIn(invoice, move_obj._get_verifactu_unregistered(self.company))
+        # Vendor bills are never registered
+        bill = move_obj.create(
+            {
+                "move_type": "in_invoice",
+                "partner_id": self.partner.id,
+                "company_id": self.company.id,
+                "invoice_date": fields.Date.today(),
+                "invoice_line_ids": [
+                    (0, 0, {"product_id": self.product.id, "price_unit": 100.0})
+                ],
+            }
+        )
+        bill.action_post()
+        self.assertTrue(bill.verifactu_enabled)
+        self.assertNotIn(bill, move_obj._get_verifactu_unregistered(self.company))
+        self.env.cr.execute(
+            "SELECT 1 FROM pg_indexes WHERE indexname = %s",
+            ["account_move_verifactu_pending_index"],
+        )
+        self.assertTrue(self.env.cr.fetchone())
+
+    def test_backfill_invoices(self):
+        invoices = self.env["account.move"]
+        for _i in range(3):
+            invoices |= self._create_unregistered_invoice()
+        self.assertFalse(invoices.verifactu_registry_ids)
+        self.queue_obj.backfill_invoices(self.company, chunk_size=2)
+        items = self.queue_obj.search(
+            [("invoice_id", "in", invoices.ids)], order="record_sequence"
+        )
+        self.assertEqual(items.mapped("invoice_id"), invoices.sorted("name"))
+        self.assertTrue(all(items.mapped("record_hash")))
+        # The invoices show the chained hash of their registry row
+        for item in items:
+            self.assertEqual(item.invoice_id.verifactu_hash, item.record_hash)
+        self.assertFalse(any(invoices.mapped("verifactu_qr_code")))
+        self.assertTrue(self.company.verifactu_backfill_move_id)
+        # Resuming from the checkpoint enqueues nothing twice
+        self.assertEqual(self.queue_obj.backfill_invoices(self.company), 0)
+        self.assertEqual(
+            self.queue_obj.search_count([("invoice_id", "in", invoices.ids)]), 3
+        )
+
+    def test_registry_rows(self):
+        items = self.queue_obj.browse()
+        for _i in range(2):
+            items |= self._get_queue_item(self._create_invoice())
+        first, second = items._sorted_by_chain().mapped("registry_id")
+        self.assertEqual(second.sequence, first.sequence + 1)
+        self.assertEqual(second.previous_hash, first.record_hash)
+        self.assertEqual(second.serial_number, second.invoice_id.name)
+        self.assertEqual(len(second.payload_digest), 64)
+        self.assertEqual(
+            items.mapped("record_hash"), items.mapped("registry_id.record_hash")
+        )
+        with self.assertRaises(UserError):
+            first.write({"record_hash": "A" * 64})
+        with self.assertRaises(UserError):
+            first.unlink()
+        request = items._get_verifactu_batch_request()
+        self.assertEqual(
+            request["RegistroFactura"][1]["RegistroAlta"]["Encadenamiento"][
+                "RegistroAnterior"
+            ]["Huella"],
+            first.record_hash,
+        )
+
+        response = SimpleNamespace(
+            CSV="CSV",
+            RespuestaLinea=[
+                SimpleNamespace(
+                    IDFactura=SimpleNamespace(
+                        NumSerieFactura=item.invoice_id.name,
+                        FechaExpedicionFactura=item.invoice_id._get_document_date(),
+                    ),
+                    Operacion=SimpleNamespace(TipoOperacion="Alta"),
+                    EstadoRegistro="AceptadoConErrores",
+                    CodigoErrorRegistro=1100,
+                    DescripcionErrorRegistro="Valor no permitido",
+                    RegistroDuplicado=None,
+                )
+                for item in items
+            ],
+        )
+        items._apply_send_results(items._parse_verifactu_response(response))
+        self.assertEqual(
+            set(items.mapped("registry_id.aeat_state")), {"AceptadoConErrores"}
+        )
+        self.assertEqual(set(items.mapped("registry_id.aeat_code")), {"1100"})
+        self.assertEqual(set(items.mapped("registry_id.aeat_csv")), {"CSV"})
+
+    def test_lazy_batch_request_chunks(self):
+        items = self.queue_obj.browse()
+        for _i in range(3):
+            items |= self._get_queue_item(self._create_invoice())
+        expected = items._get_verifactu_batch_request()["RegistroFactura"]
+        move_class = type(self.env["account.move"])
+        with patch.object(verifactu_queue, "VERIFACTU_STREAM_CHUNK", 2), patch.object(
+            move_class,
+            "_get_verifactu_records",
+            autospec=True,
+            side_effect=move_class._get_verifactu_records,
+        ) as build:
+            registros = items._get_verifactu_batch_request(lazy=True)[
+                "RegistroFactura"
+            ]
+
+            def built():
+                return [
+                    len(call.args[0]) for call in build.call_args_list if call.args[0]
+                ]
+
+            # Nothing is built until the records are written
+            self.assertEqual(built(), [])
+            self.assertEqual(next(registros), expected[0])
+            self.assertEqual(built(), [2])
+            self.assertEqual(list(registros), expected[1:])
+            self.assertEqual(built(), [2, 1])
+
+    def test_export_registry(self):
+        registry_obj = self.env["verifactu.registry"]
+        for _i in range(3):
+            self._create_invoice()
+        rows = registry_obj.search(
+            [("company_id", "=", self.company.id)], order="sequence"
+        )
+        today = fields.Date.today()
+        output = io.BytesIO()
+        count = registry_obj.export_records(output, self.company, today, today)
+        self.assertEqual(count, len(rows))
+        root = etree.fromstring(gzip.decompress(output.getvalue()))
+        self.assertEqual(
+            [registro.findtext("Huella") for registro in root],
+            rows.mapped("record_hash"),
+        )
+        output = io.BytesIO()
+        registry_obj.export_records(output, self.company, export_format="jsonl")
+        lines = gzip.decompress(output.getvalue()).decode().splitlines()
+        self.assertEqual(json.loads(lines[-1])["Secuencia"], rows[-1].sequence)
+        # Nothing was registered yesterday
+        yesterday = today - timedelta(days=1)
+        self.assertEqual(
+            registry_obj.export_records(
+                io.BytesIO(), self.company, yesterday, yesterday
+            ),
+            0,
+        )
+        attachment = registry_obj.export_attachment(self.company, today, today)
+        self.assertEqual(len(etree.fromstring(gzip.decompress(attachment.raw))), count)
+        # Copied to the filestore as ir.attachment would have stored it
+        self.assertEqual(
+            attachment.store_fname,
+            attachment._get_path(attachment.raw, attachment.checksum)[0],
+        )
+        self.assertEqual(attachment.checksum, hashlib.sha1(attachment.raw).hexdigest())
+        self.assertEqual(attachment.file_size, len(attachment.raw))
+
+    def test_offline_mode_signed(self):
+        private_key = generate_private_key(public_exponent=65537, key_size=2048)
+        name = x509.Name([x509.NameAttribute(oid.NameOID.COMMON_NAME, "Test")])
+        certificate = (
+            x509.CertificateBuilder()
+            .subject_name(name)
+            .issuer_name(name)
+            .public_key(private_key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(fields.Datetime.now() - timedelta(days=1))
+            .not_valid_after(fields.Datetime.now() + timedelta(days=1))
+            .sign(private_key, hashes.SHA256())
+        )
+        credentials = AeatCredentials(
+            None,
+            None,
+            serialize_key_and_certificates(private_key, certificate, b"1234"),
+            b"1234",
+        )
+        service = get_verifactu_service()
+        self.company.verifactu_mode = "offline"
+        with patch.object(
+            type(self.env["l10n.es.aeat.certificate"]),
+            "get_credentials",
+            return_value=credentials,
+        ), patch.object(
+            type(self.env["account.move"]), "_connect_aeat", return_value=service
+        ):
+            items = self.queue_obj.browse()
+            for _i in range(2):
+                items |= self._get_queue_item(self._create_invoice())
+        self.assertEqual(set(items.mapped("state")), {"local"})
+        for registry in items.mapped("registry_id"):
+            signature = etree.fromstring(registry.signature.encode())
+            reference = signature.find(
+                ".//{http://www.w3.org/2000/09/xmldsig#}Reference"
+            )
+            self.assertTrue(reference.get("URI").endswith(registry.record_hash))
+        # Local records are never sent
+        with patch_verifactu_send(self.env) as send:
+            self.queue_obj.process_pending_queue()
+        send.assert_not_called()
+        # Switching to the non veri*FACTU mode is a logged event
+        self.env.cr.precommit.run()
+        self.assertTrue(
+            self.env["verifactu.event"].search_count(
+                [("company_id", "=", self.company.id), ("event_type", "=", "01")]
+            )
+        )
+
+    def test_timeout_marks_unknown(self):
+        item = self._get_queue_item(self._create_invoice())
+        with patch_verifactu_send(self.env, side_effect=ReadTimeout("timeout")):
+            item.process_queue_item()
+        self.assertEqual(item.state, "unknown")
+        self.assertEqual(item.retry_count, 0)
+        # An item in doubt must not be enqueued again
+        self.assertEqual(self.queue_obj.create_queue_item(item.invoice_id.id), item)
+
+    def test_census_rejected_not_sent(self):
+        item = self._get_queue_item(self._create_invoice())
+        other_partner = self.partner.copy({"name": "Other Customer"})
+        next_item = self._get_queue_item(self._create_invoice(other_partner))
+        self.env["l10n.es.aeat.nif.validation"].create(
+            {
+                "nif": "87654321Y",
+                "name": "Test Customer",
+                "name_key": "TEST CUSTOMER",
+                "state": "invalid",
+                "check_date": fields.Datetime.now(),
+                "expiry_date": fields.Datetime.now() + timedelta(days=1),
+            }
+        )
+        with patch_verifactu_send(self.env) as send:
+            self.queue_obj.process_pending_queue()
+        send.assert_not_called()
+        self.assertEqual(item.state, "pending")
+        self.assertEqual(item.retry_count, 1)
+        self.assertIn("87654321Y", item.error_message)
+        # The next record of the chain links to the rejected one: held after it
+        self.assertEqual(next_item.state, "pending")
+        self.assertEqual(next_item.retry_count, 0)
+        self.assertEqual(next_item.scheduled_date, item.scheduled_date)
+        self.assertIn("censo", next_item.error_message)
+
+    def test_schema_invalid_records_split(self):
+        items = self.queue_obj.browse()
+        for _i in range(3):
+            items |= self._get_queue_item(self._create_invoice())
+        items = items._sorted_by_chain()
+        service = get_verifactu_service()
+        for lazy in (False, True):
+            request = items._get_verifactu_batch_request()
+            request["RegistroFactura"][1]["RegistroAlta"]["TipoFactura"] = "X9"
+            if lazy:
+                request["RegistroFactura"] = iter(request["RegistroFactura"])
+            errors = {}
+            checked = items._validate_verifactu_batch_request(service, request, errors)
+            registros = list(checked["RegistroFactura"])
+            # The next record is chained to the invalid one: both are held back
+            self.assertEqual(len(registros), 1)
+            self.assertEqual(list(errors), [items[1].id, items[2].id])
+            self.assertIn("TipoFactura", errors[items[1].id])
+            self.assertIsNone(errors[items[2].id])
+        results = items._get_schema_error_results(errors)
+        self.assertEqual(list(results), [items[1].id, items[2].id])
+        self.assertFalse(results[items[1].id]["success"])
+        self.assertTrue(results[items[2].id]["held"])
+        items.write({"state": "processing"})
+        items[1:]._apply_send_results(results)
+        self.assertEqual(items[1:].mapped("state"), ["pending", "pending"])
+        self.assertEqual(items[1:].mapped("retry_count"), [1, 0])
+        # The held record is not sent before the invalid one is retried
+        self.assertEqual(items[2].scheduled_date, items[1].scheduled_date)
+
+    def test_process_pending_queue_sync(self):
+        items = self.queue_obj.browse()
+        for _i in range(2):
+            items |= self._get_queue_item(self._create_invoice())
+        with patch_verifactu_send(self.env, side_effect=accepted_response) as send:
+            self.queue_obj.process_pending_queue()
+        # One real RegFactuSistemaFacturacion call for the whole batch
+        send.assert_called_once()
+        call = send.call_args[0][0]
+        self.assertEqual(call[2], "RegFactuSistemaFacturacion")
+        self.assertEqual(len(call[3]["RegistroFactura"]), 2)
+        self.assertEqual(set(items.mapped("state")), {"sent"})
+        self.assertEqual(set(items.mapped("invoice_id.aeat_state")), {"sent"})
+        self.assertEqual(set(items.mapped("registry_id.aeat_state")), {"Correcto"})
+
+    def test_process_pending_queue_drained(self):
+        items = self.queue_obj.browse()
+        for _i in range(5):
+            items |= self._get_queue_item(self._create_invoice())
+        items = items._sorted_by_chain()
+        # A record waiting for its retry holds back the rest of its chain
+        items[3].scheduled_date = fields.Datetime.now() + timedelta(hours=1)
+        self.env["ir.config_parameter"].sudo().set_param(
+            "l10n_es_aeat_verifactu.batch_size", "2"
+        )
+        self.assertEqual(self.queue_obj._get_batch_size(), 2)
+        with patch_verifactu_send(self.env, side_effect=accepted_response) as send:
+            self.assertEqual(self.queue_obj.process_pending_queue(), 3)
+        self.assertEqual(
+            [len(call.args[0][3]["RegistroFactura"]) for call in send.call_args_list],
+            [2, 1],
+        )
+        self.assertEqual(
+            items.mapped("state"), ["sent", "sent", "sent", "pending", "pending"]
+        )
+        # Never more than the AEAT limit per request
+        self.env["ir.config_parameter"].sudo().set_param(
+            "l10n_es_aeat_verifactu.batch_size", "5000"
+        )
+        self.assertEqual(self.queue_obj._get_batch_size(), 1000)
+
+    def test_reconcile_unknown_queue(self):
+        items = self.queue_obj.browse()
+        for _i in range(3):
+            items |= self._get_queue_item(self._create_invoice())
+        items.write({"state": "unknown"})
+        accepted, with_errors, missing = items
+        registered = {
+            accepted._get_verifactu_invoice_key(): SimpleNamespace(
+                EstadoRegistro="Correcto", DescripcionErrorRegistro=None
+            ),
+            with_errors._get_verifactu_invoice_key(): SimpleNamespace(
+                EstadoRegistro="AceptadoConErrores",
+                DescripcionErrorRegistro="Error de prueba",
+            ),
+        }
+        with patch.object(
+            type(items), "_query_verifactu_period", return_value=registered
+        ) as query:
+            self.assertEqual(self.queue_obj.reconcile_unknown_queue(), 3)
+        query.assert_called_once()
+        self.assertEqual(accepted.state, "sent")
+        self.assertEqual(accepted.invoice_id.aeat_state, "sent")
+        self.assertEqual(with_errors.state, "sent")
+        self.assertEqual(with_errors.invoice_id.aeat_state, "sent_w_errors")
+        self.assertEqual(with_errors.invoice_id.aeat_send_error, "Error de prueba")
+        self.assertEqual(missing.state, "pending")
+
+    def test_apply_send_results_grouped(self):
+        items = self.queue_obj.browse()
+        for _i in range(4):
+            items |= self._get_queue_item(self._create_invoice())
+        items.write({"state": "processing"})
+        accepted, accepted_2, with_errors, rejected = items
+        results = {
+            accepted.id: {"success": True, "response": "CSV"},
+            accepted_2.id: {"success": True, "response": "CSV"},
+            with_errors.id: {
+                "success": True,
+                "response": "CSV",
+                "aeat_state": "sent_w_errors",
+                "error": "[1100] Valor no permitido",
+            },
+            rejected.id: {"success": False, "error": "[4102] Rechazado"},
+        }
+        items._apply_send_results(results)
+        self.assertEqual((accepted | accepted_2).mapped("state"), ["sent", "sent"])
+        self.assertEqual(
+            (accepted | accepted_2).mapped("invoice_id.aeat_state"), ["sent", "sent"]
+        )
+        self.assertEqual(with_errors.invoice_id.aeat_state, "sent_w_errors")
+        self.assertEqual(rejected.state, "pending")
+        self.assertEqual(rejected.retry_count, 1)
+        self.assertFalse(rejected.invoice_id.aeat_send_failed)
+
+    def test_parse_verifactu_response(self):
+        items = self.queue_obj.browse()
+        for _i in range(4):
+            items |= self._get_queue_item(self._create_invoice())
+        accepted, with_errors, duplicated, rejected = items
+
+        def line(item, state, code=None, description=None, duplicated=None):
+            serial_number, date = item._get_verifactu_invoice_key()
+            return SimpleNamespace(
+                IDFactura=SimpleNamespace(
+                    NumSerieFactura=serial_number, FechaExpedicionFactura=date
+                ),
+                Operacion=SimpleNamespace(TipoOperacion="Alta"),
+                EstadoRegistro=state,
+                CodigoErrorRegistro=code,
+                DescripcionErrorRegistro=description,
+                RegistroDuplicado=duplicated,
+            )
+
+        response = SimpleNamespace(
+            CSV="CSV",
+            RespuestaLinea=[
+                line(accepted, "Correcto"),
+                line(with_errors, "AceptadoConErrores", 1100, "Valor no permitido"),
+                line(duplicated, "Incorrecto", 3000, "Duplicado", duplicated=True),
+            ],
+        )
+        results = (accepted | with_errors | duplicated | rejected)._parse_verifactu_response(
+            response
+        )
+        self.assertEqual(results[accepted.id]["aeat_state"], "sent")
+        self.assertEqual(results[with_errors.id]["aeat_state"], "sent_w_errors")
+        self.assertEqual(
+            results[with_errors.id]["error"], "[1100] Valor no permitido"
+        )
+        self.assertTrue(results[duplicated.id]["success"])
+        self.assertFalse(results[rejected.id]["success"])
+
+    def test_invoice_dicts_batch(self):
+        invoices = self.env["account.move"]
+        for _i in range(3):
+            invoices |= self._create_invoice()
+        inv_dicts = invoices._get_aeat_invoice_dicts()
+        self.assertEqual(set(inv_dicts), set(invoices.ids))
+        for invoice in invoices:
+            inv_dict = inv_dicts[invoice.id]
+            self.assertEqual(
+                inv_dict["IDFactura"],
+                {
+                    "IDEmisorFactura": "12345678Z",
+                    "NumSerieFactura": invoice.name,
+                    "FechaExpedicionFactura": invoice.invoice_date.strftime(
+                        "%d-%m-%Y"
+                    ),
+                },
+            )
+            self.assertEqual(inv_dict["NombreRazonEmisor"], self.company.name)
+            self.assertEqual(inv_dict["TipoFactura"], "F1")
+            self.assertEqual(inv_dict["DescripcionOperacion"], "Test Product")
+            self.assertEqual(
+                inv_dict["Destinatarios"]["IDDestinatario"],
+                [{"NombreRazon": "Test Customer", "NIF": "87654321Y"}],
+            )
+            details = inv_dict["Desglose"]["DetalleDesglose"]
+            self.assertEqual(
+                sum(detail["BaseImponibleOimporteNoSujeto"] for detail in details),
+                Decimal("100.00"),
+            )
+            self.assertEqual(inv_dict["ImporteTotal"], Decimal(str(invoice.amount_total)))
+            self.assertEqual(inv_dict["SistemaInformatico"]["NIF"], "12345678Z")
+            self.assertEqual(inv_dict["Huella"], invoice.verifactu_hash)
+        # Built in batch: the queries do not grow with the number of invoices
+        invoices[0]._get_aeat_invoice_dicts()
+        self.env.invalidate_all()
+        queries = self.cr.sql_log_count
+        invoices[0]._get_aeat_invoice_dicts()
+        single = self.cr.sql_log_count - queries
+        self.env.invalidate_all()
+        with self.assertQueryCount(single):
+            invoices._get_aeat_invoice_dicts()
+
+    def test_cancellation_chain(self):
+        invoices = self.env["account.move"]
+        for _i in range(3):
+            invoices |= self._create_invoice()
+        altas = self.queue_obj.search(
+            [("invoice_id", "in", invoices.ids)], order="record_sequence"
+        )
+        self.assertEqual(len(altas), 3)
+        cancellations = self.queue_obj.create_cancellation_items(invoices)
+        self.assertEqual(set(cancellations.mapped("operation")), {"anulacion"})
+        items = (altas | cancellations).sorted("record_sequence")
+        sequences = items.mapped("record_sequence")
+        self.assertEqual(sequences, list(range(sequences[0], sequences[0] + 6)))
+        # Enqueuing them again does nothing
+        self.assertFalse(self.queue_obj.create_cancellation_items(invoices))
+
+        request = items._get_verifactu_batch_request()
+        registros = request["RegistroFactura"]
+        self.assertEqual(
+            [list(registro) for registro in registros],
+            [["RegistroAlta"]] * 3 + [["RegistroAnulacion"]] * 3,
+        )
+        for previous, registro in zip(registros, registros[1:]):
+            previous = next(iter(previous.values()))
+            registro = next(iter(registro.values()))
+            self.assertEqual(
+                registro["Encadenamiento"]["RegistroAnterior"]["Huella"],
+                previous["Huella"],
+            )
+        first = registros[3]["RegistroAnulacion"]
+        self.assertEqual(
+            first["Huella"], cancellations.sorted("record_sequence")[0].record_hash
+        )
+        self.assertEqual(
+            first["IDFactura"]["NumSerieFacturaAnulada"], items[3].invoice_id.name
+        )
+
+        response = SimpleNamespace(
+            CSV="CSV",
+            RespuestaLinea=[
+                SimpleNamespace(
+                    IDFactura=SimpleNamespace(
+                        NumSerieFactura=invoice.name,
+                        FechaExpedicionFactura=invoice._get_document_date(),
+                    ),
+                    Operacion=SimpleNamespace(TipoOperacion="Anulacion"),
+                    EstadoRegistro="Correcto",
+                    CodigoErrorRegistro=None,
+                    DescripcionErrorRegistro=None,
+                    RegistroDuplicado=None,
+                )
+                for invoice in invoices
+            ],
+        )
+        results = cancellations._parse_verifactu_response(response)
+        cancellations._apply_send_results(results)
+        self.assertEqual(set(invoices.mapped("aeat_state")), {"cancelled"})
+
+    def test_cancellation_sync_send(self):
+        invoice = self._create_invoice()
+        alta = self._get_queue_item(invoice)
+        alta.write({"state": "sent"})
+        cancellation = self.queue_obj.create_cancellation_items(invoice)
+        self.env["ir.config_parameter"].sudo().set_param(
+            "l10n_es_aeat_verifactu.async_send", "False"
+        )
+        with patch_verifactu_send(self.env, side_effect=accepted_response) as send:
+            self.queue_obj.process_pending_queue()
+        send.assert_called_once()
+        registros = send.call_args[0][0][3]["RegistroFactura"]
+        self.assertEqual(
+            [list(registro) for registro in registros], [["RegistroAnulacion"]]
+        )
+        self.assertEqual(
+            registros[0]["RegistroAnulacion"]["Huella"], cancellation.record_hash
+        )
+        self.assertEqual(cancellation.state, "sent")
+        self.assertEqual(cancellation.registry_id.aeat_state, "Correcto")
+        self.assertEqual(invoice.aeat_state, "cancelled")
+
+    def test_cancellation_requires_registration(self):
+        invoice = self._create_unregistered_invoice()
+        with self.assertRaises(UserError):
+            self.queue_obj.create_cancellation_items(invoice)
@@ -0,0 +1,148 @@
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+import os
+from decimal import Decimal
+
+from lxml import etree
+
+from odoo.tests.common import BaseCase
+
+from ..models.aeat_tax_agency import VERIFACTU_WSDL_PATH
+from ..models.verifactu_records import (
+    CancellationRecord,
+    Chaining,
+    ComputerSystem,
+    InvoiceId,
+    Party,
+    RegistrationRecord,
+    TaxDetail,
+    to_amount,
+)
+from .test_verifactu_envelope import TestVerifactuEnvelopeCommon
+
+
+def _registration_record(number=1):
+    system = ComputerSystem(
+        name="Test Company",
+        nif="B12345678",
+        system_name="Odoo",
+        system_id="OD",
+        version="16.0",
+        installation_number="1",
+    )
+    return RegistrationRecord(
+        invoice_id=InvoiceId(
+            issuer_nif="B12345678",
+            serial_number="INV/2024/%05d" % number,
+            date="01-01-2024",
+        ),
+        issuer_name="Test Company",
+        invoice_type="F1",
+        description="Test",
+        recipients=[Party(name="Test Customer", nif="87654321Y")],
+        details=[
+            TaxDetail(
+                regime_key="01",
+                operation_type="S1",
+                tax_rate=21.0,
+                base=3 * 3.77,
+                fee=3 * 3.77 * 0.21,
+            ),
+            TaxDetail(regime_key="01", exemption="E1", base=10),
+        ],
+        total_fee=2.3751,
+        total_amount=23.685,
+        chaining=Chaining(),
+        system=system,
+        generated_at="2024-01-01T10:00:00+01:00",
+        hash="A" * 64,
+    )
+
+
+class TestVerifactuRecordsFields(BaseCase):
+    def test_amounts_quantized(self):
+        record = _registration_record()
+        self.assertEqual(record.total_fee, Decimal("2.38"))
+        self.assertEqual(record.total_amount, Decimal("23.69"))
+        self.assertEqual(record.details[0].base, Decimal("11.31"))
+        self.assertEqual(to_amount(1.005), Decimal("1.01"))
+
+    def test_slots(self):
+        record = _registration_record()
+        self.assertFalse(hasattr(record, "__dict__"))
+        with self.assertRaises(TypeError):
+            InvoiceId(issuer_nif="B12345678", unknown=True)
+
+    def test_compute_hash(self):
+        # Example of the AEAT hash specification, also in test_verifactu_hash_code
+        record = RegistrationRecord(
+            invoice_id=InvoiceId(
+                issuer_nif="89890001K", serial_number="12345678/G33", date="01-01-2024"
+            ),
+            invoice_type="F1",
+            total_fee=12.35,
+            total_amount=123.45,
+            chaining=Chaining(),
+            generated_at="2024-01-01T19:20:30+01:00",
+        )
+        self.assertEqual(
+            record.compute_hash(),
+            "3C464DAF61ACB827C65FDA19F352A4E3BDC2C640E9E9FC4CC058073F38F12F60",
+        )
+
+    def test_digest(self):
+        record = _registration_record()
+        self.assertEqual(record.digest(), _registration_record().digest())
+        self.assertNotEqual(record.digest(), _registration_record(2).digest())
+        # Unlike the hash, it covers the recipients
+        changed = _registration_record()
+        changed.recipients = [Party(name="Other Customer", nif="11111111H")]
+        self.assertEqual(changed.compute_hash(), record.compute_hash())
+        self.assertNotEqual(changed.digest(), record.digest())
+
+    def test_texts_truncated(self):
+        record = RegistrationRecord(issuer_name="X" * 200, description="Y" * 600)
+        self.assertEqual(len(record.issuer_name), 120)
+        self.assertEqual(len(record.description), 500)
+
+    def test_to_soap(self):
+        res = _registration_record().to_soap()
+        self.assertEqual(res["IDFactura"]["IDEmisorFactura"], "B12345678")
+        self.assertNotIn("PeriodoLiquidacion", res)
+        self.assertEqual(res["Encadenamiento"], {"PrimerRegistro": "S"})
+        exempt = res["Desglose"]["DetalleDesglose"][1]
+        self.assertEqual(exempt["OperacionExenta"], "E1")
+        self.assertNotIn("CuotaRepercutida", exempt)
+        previous = _registration_record(2)
+        cancellation = CancellationRecord(
+            invoice_id=previous.invoice_id,
+            chaining=Chaining(previous_id=previous.invoice_id, previous_hash="B" * 64),
+            system=previous.system,
+            generated_at="2024-01-02T10:00:00+01:00",
+            hash="C" * 64,
+        ).to_soap()
+        self.assertEqual(
+            cancellation["IDFactura"]["NumSerieFacturaAnulada"], "INV/2024/00002"
+        )
+        self.assertEqual(
+            cancellation["Encadenamiento"]["RegistroAnterior"]["Huella"], "B" * 64
+        )
+
+
+class TestVerifactuRecordsSchema(TestVerifactuEnvelopeCommon):
+    def test_records_match_schema(self):
+        schema = etree.XMLSchema(
+            etree.parse(os.path.join(VERIFACTU_WSDL_PATH, "SuministroLR.xsd"))
+        )
+        request = {
+            "Cabecera": {
+                "ObligadoEmision": {"NombreRazon": "Test Company", "NIF": "B12345678"}
+            },
+            "RegistroFactura": [
+                {"RegistroAlta": _registration_record(number).to_soap()}
+                for number in range(3)
+            ],
+        }
+        envelope = self.template.build(request)
+        body = envelope.find("{http://schemas.xmlsoap.org/soap/envelope/}Body")
+        schema.assertValid(body[0])
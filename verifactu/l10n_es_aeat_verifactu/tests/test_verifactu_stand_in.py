@@ -0,0 +1,200 @@
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+import os
+import threading
+from unittest.mock import patch
+
+import requests
+from zeep import Client
+from zeep.exceptions import Fault
+
+from odoo.tests.common import BaseCase
+
+from odoo.addons.l10n_es_aeat.models.aeat_envelope import send_envelope_stream
+from odoo.addons.l10n_es_aeat.models.aeat_metrics import (
+    AeatMetricsPlugin,
+    get_call_metrics,
+    reset_call_metrics,
+)
+from odoo.addons.l10n_es_aeat.models.aeat_nif_validation import (
+    build_nif_validation_request,
+    parse_nif_validation_response,
+)
+
+from ..models.aeat_tax_agency import VERIFACTU_SERVICE_NAME, VERIFACTU_WSDL_PATH
+from ..tools.aeat_stand_in import StandInConfig, make_server
+from .test_verifactu_envelope import _request
+
+
+def _registro_anulacion(number):
+    return {
+        "IDVersion": "1.0",
+        "IDFactura": {
+            "IDEmisorFacturaAnulada": "B12345678",
+            "NumSerieFacturaAnulada": "INV/2024/%05d" % number,
+            "FechaExpedicionFacturaAnulada": "01-01-2024",
+        },
+        "Encadenamiento": {"PrimerRegistro": "S"},
+        "SistemaInformatico": _request(1)["RegistroFactura"][0]["RegistroAlta"][
+            "SistemaInformatico"
+        ],
+        "FechaHoraHusoGenRegistro": "2024-01-01T10:00:00+01:00",
+        "TipoHuella": "01",
+        "Huella": "A" * 64,
+    }
+
+
+class TestVerifactuStandIn(BaseCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = make_server(
+            config=StandInConfig(error_rate=0.5, page_size=2, seed=1)
+        )
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.address = "http://127.0.0.1:%s/" % cls.server.server_address[1]
+        client = Client(
+            wsdl=os.path.join(VERIFACTU_WSDL_PATH, "SistemaFacturacion.wsdl"),
+            plugins=[AeatMetricsPlugin()],
+        )
+        port = client._get_port(
+            client._get_service(VERIFACTU_SERVICE_NAME), "SistemaVerifactu"
+        )
+        cls.service = client.create_service(port.binding.name, cls.address)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        super().setUp()
+        self.server.stand_in.registry.clear()
+        self.server.stand_in.next_send.clear()
+        self.server.stand_in.random.seed(1)
+
+    def test_register_and_duplicate(self):
+        res = self.service.RegFactuSistemaFacturacion(**_request(6))
+        states = [line.EstadoRegistro for line in res.RespuestaLinea]
+        self.assertEqual(len(states), 6)
+        self.assertIn("Incorrecto", states)
+        self.assertEqual(res.EstadoEnvio, "ParcialmenteCorrecto")
+        self.assertEqual(res.TiempoEsperaEnvio, "60")
+        self.assertTrue(res.CSV)
+        accepted = states.index("Correcto")
+        res = self.service.RegFactuSistemaFacturacion(**_request(accepted + 1))
+        duplicated = res.RespuestaLinea[accepted]
+        self.assertEqual(duplicated.CodigoErrorRegistro, 3000)
+        self.assertEqual(duplicated.RegistroDuplicado.EstadoRegistroDuplicado, "Correcta")
+
+    def test_cancellation(self):
+        self.server.stand_in.config.error_rate = 0.0
+        try:
+            self.service.RegFactuSistemaFacturacion(**_request(2))
+            request = _request(0)
+            request["RegistroFactura"] = [
+                {"RegistroAnulacion": _registro_anulacion(number)}
+                for number in (0, 0, 5)
+            ]
+            res = self.service.RegFactuSistemaFacturacion(**request)
+        finally:
+            self.server.stand_in.config.error_rate = 0.5
+        self.assertEqual(
+            [
+                (
+                    line.IDFactura.NumSerieFactura,
+                    line.Operacion.TipoOperacion,
+                    line.EstadoRegistro,
+                )
+                for line in res.RespuestaLinea
+            ],
+            [
+                ("INV/2024/00000", "Anulacion", "Correcto"),
+                # Already cancelled, and never registered
+                ("INV/2024/00000", "Anulacion", "Incorrecto"),
+                ("INV/2024/00005", "Anulacion", "Incorrecto"),
+            ],
+        )
+        self.assertEqual(res.RespuestaLinea[2].CodigoErrorRegistro, 3002)
+
+    def test_unexpected_error_answered(self):
+        reset_call_metrics()
+        with patch.object(
+            self.server.stand_in, "register", side_effect=KeyError("boom")
+        ), self.assertRaisesRegex(Fault, "KeyError"):
+            self.service.RegFactuSistemaFacturacion(**_request(1))
+        metrics = get_call_metrics()["RegFactuSistemaFacturacion"]
+        self.assertEqual(metrics["count"], 0)
+        self.assertEqual(metrics["errors"], 1)
+        self.assertIn("KeyError", metrics["last_error"])
+
+    def test_streamed_envelope(self):
+        reset_call_metrics()
+        request = _request(5)
+        request["RegistroFactura"] = (record for record in request["RegistroFactura"])
+        res = send_envelope_stream(
+            self.service, "RegFactuSistemaFacturacion", request
+        )
+        self.assertEqual(len(res.RespuestaLinea), 5)
+        metrics = get_call_metrics()["RegFactuSistemaFacturacion"]
+        self.assertEqual(metrics["count"], 1)
+        self.assertTrue(metrics["bytes_sent"])
+
+    def test_query_paginated(self):
+        res = self.service.RegFactuSistemaFacturacion(**_request(6))
+        accepted = sum(line.EstadoRegistro != "Incorrecto" for line in res.RespuestaLinea)
+        query = {
+            "Cabecera": dict(_request(0)["Cabecera"], IDVersion="1.0"),
+            "FiltroConsulta": {
+                "PeriodoImputacion": {"Ejercicio": 2024, "Periodo": "01"}
+            },
+        }
+        records = []
+        while True:
+            res = self.service.ConsultaFactuSistemaFacturacion(**query)
+            records += res.RegistroRespuestaConsultaFactuSistemaFacturacion
+            if res.IndicadorPaginacion != "S":
+                break
+            query["FiltroConsulta"]["ClavePaginacion"] = res.ClavePaginacion
+        self.assertEqual(len(records), accepted)
+
+    def test_throttle(self):
+        self.server.stand_in.config.throttle = True
+        try:
+            self.service.RegFactuSistemaFacturacion(**_request(1))
+            with self.assertRaisesRegex(Fault, "4118"):
+                self.service.RegFactuSistemaFacturacion(**_request(1))
+        finally:
+            self.server.stand_in.config.throttle = False
+
+    def test_census_check(self):
+        self.server.stand_in.config.unidentified_nifs = {"00000000T"}
+        try:
+            response = requests.post(
+                self.address,
+                data=build_nif_validation_request(
+                    [("12345678Z", "Test Customer"), ("00000000T", "Unknown")]
+                ),
+                timeout=10,
+            )
+        finally:
+            self.server.stand_in.config.unidentified_nifs = set()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            parse_nif_validation_response(response.content),
+            [
+                ("12345678Z", "TEST CUSTOMER", "IDENTIFICADO"),
+                ("00000000T", "", "NO IDENTIFICADO"),
+            ],
+        )
+
+    def test_schema_validation(self):
+        response = requests.post(
+            self.address,
+            data=b'<env:Envelope xmlns:env="http://schemas.xmlsoap.org/soap/envelope/">'
+            b"<env:Body><Unknown/></env:Body></env:Envelope>",
+            timeout=10,
+        )
+        self.assertEqual(response.status_code, 500)
+        self.assertIn(b"4102", response.content)
@@ -0,0 +1,463 @@
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+"""Local stand-in for the AEAT VeriFACTU SOAP service, for offline load tests.
+
+It serves the ``SistemaVerifactu`` binding of the bundled WSDL: incoming
+envelopes are validated against the bundled XSD and answered with realistic
+per record responses built by zeep from the same contract.
+
+Implemented operations:
+
+* ``RegFactuSistemaFacturacion``: every record is registered in memory and
+  answered ``Correcto``, ``AceptadoConErrores`` or ``Incorrecto`` according to
+  the configured rates. Records already registered are rejected as duplicates
+  with their ``RegistroDuplicado`` information, as the AEAT does.
+* ``ConsultaFactuSistemaFacturacion``: paginated query of the records
+  registered for the issuer and period.
+* ``VNifV2``: census check of NIF and name pairs, as used by the
+  ``l10n.es.aeat.nif.validation`` cache. Every pair is identified except the
+  NIFs configured as unidentified. Set the stand-in address in the
+  ``l10n_es_aeat.nif_validation_url`` system parameter to use it.
+
+Latency, error rates, ``TiempoEsperaEnvio`` and throttling (rejecting a
+submission of an issuer before its waiting time has elapsed) are configurable.
+The error codes are those of the AEAT documentation for the same situations,
+but their descriptions are not meant to be exact.
+
+Run it with::
+
+    python l10n_es_aeat_verifactu/tools/aeat_stand_in.py --port 8765
+
+and set ``http://127.0.0.1:8765/`` as "SuministroInformacion Test Address" of
+the tax agency, with the company in VeriFACTU test mode.
+"""
+import argparse
+import itertools
+import logging
+import os
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from lxml import etree
+
+_logger = logging.getLogger(__name__)
+
+try:
+    from zeep import Client
+except (ImportError, IOError) as err:
+    _logger.debug(err)
+
+WSDL_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "wsdl"
+)
+SERVICE_NAME = "sfVerifactu"
+PORT_NAME = "SistemaVerifactu"
+SOAP_ENV_NS = "http://schemas.xmlsoap.org/soap/envelope/"
+# Schema of the body of each operation
+OPERATION_SCHEMAS = {
+    "RegFactuSistemaFacturacion": "SuministroLR.xsd",
+    "ConsultaFactuSistemaFacturacion": "ConsultaLR.xsd",
+}
+ERROR_SCHEMA = 4102
+ERROR_THROTTLED = 4118
+ERROR_RECORD = 1100
+WARNING_RECORD = 2000
+ERROR_DUPLICATED = 3000
+ERROR_NOT_REGISTERED = 3002
+VNIF_BASE_NS = (
+    "http://www2.agenciatributaria.gob.es/static_files/common/internet/dep/"
+    "aplicaciones/es/aeat/burt/jdit/ws/"
+)
+VNIF_REQUEST_NS = VNIF_BASE_NS + "VNifV2Ent.xsd"
+VNIF_RESPONSE_NS = VNIF_BASE_NS + "VNifV2Sal.xsd"
+
+
+class StandInConfig:
+    """Behaviour of the stand-in server.
+
+    :param latency: ``(min, max)`` seconds each request takes.
+    :param error_rate: share of the records answered ``Incorrecto``.
+    :param warning_rate: share of the records answered ``AceptadoConErrores``.
+    :param fault_rate: share of the requests answered with a SOAP fault.
+    :param wait_time: ``TiempoEsperaEnvio`` returned, in seconds.
+    :param throttle: reject the submissions of an issuer sent before its
+        ``TiempoEsperaEnvio`` has elapsed.
+    :param page_size: records per page of the consultation.
+    :param unidentified_nifs: NIFs answered ``NO IDENTIFICADO`` by the census.
+    :param seed: seed of the random generator, for reproducible runs.
+    """
+
+    def __init__(
+        self,
+        latency=(0.0, 0.0),
+        error_rate=0.0,
+        warning_rate=0.0,
+        fault_rate=0.0,
+        wait_time=60,
+        throttle=False,
+        page_size=10000,
+        unidentified_nifs=(),
+        seed=None,
+    ):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.warning_rate = warning_rate
+        self.fault_rate = fault_rate
+        self.wait_time = wait_time
+        self.throttle = throttle
+        self.page_size = page_size
+        self.unidentified_nifs = set(unidentified_nifs)
+        self.seed = seed
+
+
+class AeatFault(Exception):
+    def __init__(self, code, message):
+        super().__init__(f"Codigo[{code}].{message}")
+
+
+class VerifactuStandIn:
+    """Request processing of the stand-in, independent of the HTTP server."""
+
+    def __init__(self, config=None):
+        self.config = config or StandInConfig()
+        self.random = random.Random(self.config.seed)
+        client = Client(wsdl=os.path.join(WSDL_PATH, "SistemaFacturacion.wsdl"))
+        self.binding = client.bind(SERVICE_NAME, PORT_NAME)._binding
+        self.schemas = {
+            operation: etree.XMLSchema(etree.parse(os.path.join(WSDL_PATH, xsd)))
+            for operation, xsd in OPERATION_SCHEMAS.items()
+        }
+        self.operations = {
+            self.binding.get(operation).input.body.qname.text: operation
+            for operation in OPERATION_SCHEMAS
+        }
+        # {(NIF emisor, NumSerieFactura, FechaExpedicionFactura): record data}
+        self.registry = {}
+        self.next_send = {}
+        self.lock = threading.Lock()
+        self.request_ids = itertools.count(1)
+
+    def handle(self, content):
+        """Process a request body and return ``(status, response body)``."""
+        low, high = self.config.latency
+        if high:
+            time.sleep(self.random.uniform(low, high))
+        try:
+            envelope = etree.fromstring(content)
+            body = envelope.find(f"{{{SOAP_ENV_NS}}}Body")
+            request = body[0] if body is not None and len(body) else None
+            census_tag = f"{{{VNIF_REQUEST_NS}}}VNifV2Ent"
+            if request is not None and request.tag == census_tag:
+                return 200, self.check_census(request)
+            operation = request is not None and self.operations.get(request.tag)
+            if not operation:
+                raise AeatFault(ERROR_SCHEMA, "Operacion no soportada")
+            schema = self.schemas[operation]
+            if not schema.validate(request):
+                raise AeatFault(
+                    ERROR_SCHEMA,
+                    f"El XML no cumple el esquema: {schema.error_log.last_error}",
+                )
+            if self.random.random() < self.config.fault_rate:
+                raise AeatFault(9999, "Error interno simulado")
+            operation_obj = self.binding.get(operation)
+            values = operation_obj.input.deserialize(envelope)
+            if operation == "RegFactuSistemaFacturacion":
+                response = self.register(values)
+            else:
+                response = self.query(values)
+            serialized = operation_obj.output.serialize(**response)
+            return 200, etree.tostring(serialized.content, xml_declaration=True)
+        except AeatFault as fault:
+            return 500, self._fault(str(fault))
+        except etree.XMLSyntaxError as error:
+            return 500, self._fault(f"Codigo[{ERROR_SCHEMA}].{error}")
+        except Exception as error:
+            # Answered anyway, so that the client does not wait for a
+            # response from a dead handler thread
+            _logger.exception("Stand-in request failed")
+            return 500, self._fault(f"{type(error).__name__}: {error}", "env:Server")
+
+    def _fault(self, message, code="env:Client"):
+        envelope = etree.Element(f"{{{SOAP_ENV_NS}}}Envelope", nsmap={"env": SOAP_ENV_NS})
+        body = etree.SubElement(envelope, f"{{{SOAP_ENV_NS}}}Body")
+        fault = etree.SubElement(body, f"{{{SOAP_ENV_NS}}}Fault")
+        etree.SubElement(fault, "faultcode").text = code
+        etree.SubElement(fault, "faultstring").text = message
+        return etree.tostring(envelope, xml_declaration=True)
+
+    def _now(self):
+        return datetime.now(timezone.utc).replace(microsecond=0)
+
+    def _line(self, id_factura, operation, state, code=None, description=None):
+        line = {
+            "IDFactura": id_factura,
+            "Operacion": {"TipoOperacion": operation},
+            "EstadoRegistro": state,
+        }
+        if code:
+            line["CodigoErrorRegistro"] = code
+            line["DescripcionErrorRegistro"] = description
+        return line
+
+    def _register_record(self, record, request_id, now):
+        alta = record.RegistroAlta
+        if alta is not None:
+            id_factura = alta.IDFactura
+            operation = "Alta"
+            key = (
+                id_factura.IDEmisorFactura,
+                id_factura.NumSerieFactura,
+                id_factura.FechaExpedicionFactura,
+            )
+        else:
+            # IDFacturaExpedidaBajaType names its fields after the cancellation
+            id_factura = record.RegistroAnulacion.IDFactura
+            operation = "Anulacion"
+            key = (
+                id_factura.IDEmisorFacturaAnulada,
+                id_factura.NumSerieFacturaAnulada,
+                id_factura.FechaExpedicionFacturaAnulada,
+            )
+        line_id = {
+            "IDEmisorFactura": key[0],
+            "NumSerieFactura": key[1],
+            "FechaExpedicionFactura": key[2],
+        }
+        registered = self.registry.get(key)
+        if operation == "Anulacion":
+            if not registered or registered["state"] == "Anulado":
+                return self._line(
+                    line_id,
+                    operation,
+                    "Incorrecto",
+                    ERROR_NOT_REGISTERED,
+                    "No existe el registro de facturacion a anular",
+                )
+            registered.update(state="Anulado", timestamp=now)
+            return self._line(line_id, operation, "Correcto")
+        if registered and not (alta.Subsanacion == "S"):
+            line = self._line(
+                line_id,
+                operation,
+                "Incorrecto",
+                ERROR_DUPLICATED,
+                "Registro de facturacion duplicado",
+            )
+            line["RegistroDuplicado"] = {
+                "IdPeticionRegistroDuplicado": registered["request_id"],
+                "EstadoRegistroDuplicado": {
+                    "Correcto": "Correcta",
+                    "AceptadoConErrores": "AceptadaConErrores",
+                    "Anulado": "Anulada",
+                }[registered["state"]],
+            }
+            return line
+        draw = self.random.random()
+        if draw < self.config.error_rate:
+            return self._line(
+                line_id,
+                operation,
+                "Incorrecto",
+                ERROR_RECORD,
+                "Valor o tipo incorrecto del campo",
+            )
+        state, code, description = "Correcto", None, None
+        if draw < self.config.error_rate + self.config.warning_rate:
+            state, code, description = (
+                "AceptadoConErrores",
+                WARNING_RECORD,
+                "Registro aceptado con errores",
+            )
+        self.registry[key] = {
+            "state": state,
+            "code": code,
+            "description": description,
+            "request_id": request_id,
+            "timestamp": now,
+            "name": alta.NombreRazonEmisor,
+        }
+        return self._line(line_id, operation, state, code, description)
+
+    def register(self, values):
+        header = values.Cabecera
+        nif = header.ObligadoEmision.NIF
+        now = self._now()
+        with self.lock:
+            if self.config.throttle and self.next_send.get(nif, 0) > time.monotonic():
+                raise AeatFault(
+                    ERROR_THROTTLED,
+                    "No se ha respetado el tiempo de espera entre envios",
+                )
+            self.next_send[nif] = time.monotonic() + self.config.wait_time
+            request_id = "%020d" % next(self.request_ids)
+            lines = [
+                self._register_record(record, request_id, now)
+                for record in values.RegistroFactura
+            ]
+        rejected = sum(line["EstadoRegistro"] == "Incorrecto" for line in lines)
+        if not rejected:
+            status = "Correcto"
+        elif rejected == len(lines):
+            status = "Incorrecto"
+        else:
+            status = "ParcialmenteCorrecto"
+        response = {
+            "Cabecera": header,
+            "TiempoEsperaEnvio": self.config.wait_time,
+            "EstadoEnvio": status,
+            "RespuestaLinea": lines,
+        }
+        if status != "Incorrecto":
+            response["CSV"] = "STANDIN%s" % request_id
+            response["DatosPresentacion"] = {
+                "NIFPresentador": nif,
+                "TimestampPresentacion": now,
+            }
+        return response
+
+    def query(self, values):
+        nif = values.Cabecera.ObligadoEmision.NIF
+        period = values.FiltroConsulta.PeriodoImputacion
+        after = values.FiltroConsulta.ClavePaginacion
+        after_key = after and (
+            after.IDEmisorFactura,
+            after.NumSerieFactura,
+            after.FechaExpedicionFactura,
+        )
+        with self.lock:
+            keys = sorted(
+                key
+                for key in self.registry
+                if key[0] == nif
+                and key[2][6:] == str(period.Ejercicio)
+                and key[2][3:5] == period.Periodo
+                and (not after_key or key > after_key)
+            )
+            page = keys[: self.config.page_size]
+            records = [
+                {
+                    "IDFactura": {
+                        "IDEmisorFactura": key[0],
+                        "NumSerieFactura": key[1],
+                        "FechaExpedicionFactura": key[2],
+                    },
+                    "DatosRegistroFacturacion": {
+                        "NombreRazonEmisor": self.registry[key]["name"]
+                    },
+                    "EstadoRegistro": {
+                        "TimestampUltimaModificacion": self.registry[key]["timestamp"],
+                        "EstadoRegistro": self.registry[key]["state"],
+                        "CodigoErrorRegistro": self.registry[key]["code"],
+                        "DescripcionErrorRegistro": self.registry[key]["description"],
+                    },
+                }
+                for key in page
+            ]
+        more = len(keys) > len(page)
+        response = {
+            "Cabecera": values.Cabecera,
+            "PeriodoImputacion": {
+                "Ejercicio": period.Ejercicio,
+                "Periodo": period.Periodo,
+            },
+            "IndicadorPaginacion": "S" if more else "N",
+            "ResultadoConsulta": "ConDatos" if records else "SinDatos",
+            "RegistroRespuestaConsultaFactuSistemaFacturacion": records,
+        }
+        if more:
+            response["ClavePaginacion"] = records[-1]["IDFactura"]
+        return response
+
+    def check_census(self, request):
+        """Answer a ``VNifV2Ent`` request, a result per ``Contribuyente``."""
+        envelope = etree.Element(
+            f"{{{SOAP_ENV_NS}}}Envelope",
+            nsmap={"env": SOAP_ENV_NS, "VNifV2Sal": VNIF_RESPONSE_NS},
+        )
+        body = etree.SubElement(envelope, f"{{{SOAP_ENV_NS}}}Body")
+        response = etree.SubElement(body, f"{{{VNIF_RESPONSE_NS}}}VNifV2Sal")
+        for taxpayer in request.iter(f"{{{VNIF_REQUEST_NS}}}Contribuyente"):
+            nif = taxpayer.findtext(f"{{{VNIF_REQUEST_NS}}}Nif")
+            identified = nif not in self.config.unidentified_nifs
+            result = etree.SubElement(response, f"{{{VNIF_RESPONSE_NS}}}Contribuyente")
+            etree.SubElement(result, f"{{{VNIF_RESPONSE_NS}}}Nif").text = nif
+            etree.SubElement(result, f"{{{VNIF_RESPONSE_NS}}}Nombre").text = (
+                (taxpayer.findtext(f"{{{VNIF_REQUEST_NS}}}Nombre") or "").upper()
+                if identified
+                else ""
+            )
+            etree.SubElement(result, f"{{{VNIF_RESPONSE_NS}}}Resultado").text = (
+                "IDENTIFICADO" if identified else "NO IDENTIFICADO"
+            )
+        return etree.tostring(envelope, xml_declaration=True, encoding="UTF-8")
+
+
+def make_server(host="127.0.0.1", port=0, config=None):
+    """Return a threaded HTTP server running the stand-in. Its
+    ``server_address`` gives the port actually bound when ``port`` is 0.
+    """
+    stand_in = VerifactuStandIn(config)
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            status, body = stand_in.handle(self.rfile.read(length))
+            self.send_response(status)
+            self.send_header("Content-Type", "text/xml; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            _logger.debug(format, *args)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    server.stand_in = stand_in
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--min-latency", type=float, default=0.0)
+    parser.add_argument("--max-latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--warning-rate", type=float, default=0.0)
+    parser.add_argument("--fault-rate", type=float, default=0.0)
+    parser.add_argument("--wait-time", type=int, default=60)
+    parser.add_argument("--throttle", action="store_true")
+    parser.add_argument("--page-size", type=int, default=10000)
+    parser.add_argument(
+        "--unidentified-nif", action="append", default=[], dest="unidentified_nifs"
+    )
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    config = StandInConfig(
+        latency=(args.min_latency, args.max_latency),
+        error_rate=args.error_rate,
+        warning_rate=args.warning_rate,
+        fault_rate=args.fault_rate,
+        wait_time=args.wait_time,
+        throttle=args.throttle,
+        page_size=args.page_size,
+        unidentified_nifs=args.unidentified_nifs,
+        seed=args.seed,
+    )
+    server = make_server(args.host, args.port, config)
+    _logger.info("AEAT stand-in listening on http://%s:%s/", *server.server_address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
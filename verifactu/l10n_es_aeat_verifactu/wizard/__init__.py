@@ -0,0 +1 @@
+from . import verifactu_registry_export
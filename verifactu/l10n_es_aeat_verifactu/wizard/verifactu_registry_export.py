@@ -0,0 +1,35 @@
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+from odoo import fields, models
+
+
+class VerifactuRegistryExport(models.TransientModel):
+    """Exportación del registro de facturación para una inspección"""
+
+    _name = "verifactu.registry.export"
+    _description = "Exportación del registro de facturación Veri*FACTU"
+
+    company_ids = fields.Many2many(
+        "res.company",
+        string="Compañías",
+        required=True,
+        default=lambda self: self.env.company,
+    )
+    date_from = fields.Date(string="Desde")
+    date_to = fields.Date(string="Hasta")
+    export_format = fields.Selection([
+        ('xml', 'XML'),
+        ('jsonl', 'JSON Lines'),
+    ], string="Formato", default='xml', required=True)
+
+    def action_export(self):
+        """Genera el fichero como adjunto y lo descarga"""
+        self.ensure_one()
+        attachment = self.env['verifactu.registry'].export_attachment(
+            self.company_ids, self.date_from, self.date_to, self.export_format
+        )
+        return {
+            'type': 'ir.actions.act_url',
+            'url': f"/web/content/{attachment.id}?download=true",
+            'target': 'self',
+        }